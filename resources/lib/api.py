@@ -5,7 +5,11 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import copy
+import json
 import os.path
+from heapq import heappush, heappushpop
+from time import time
 
 import constants
 import utils
@@ -189,38 +193,9 @@ JSON_MAP = {
     },
 }
 
-QUERY_LIMITS = {
-    'start': 0,
-    'end': constants.UNDEFINED
-}
-
-FILTER_TITLE = {
-    'field': 'title',
-    'operator': 'is',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NOT_TITLE = {
-    'field': 'title',
-    'operator': 'isnot',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NOT_FILE = {
-    'field': 'filename',
-    'operator': 'doesnotcontain',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NOT_PATH = {
-    'field': 'path',
-    'operator': 'doesnotcontain',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NOT_FILEPATH = {
-    'or': [
-        FILTER_NOT_FILE,
-        FILTER_NOT_PATH
-    ]
-}
-
+# Filters and sorts defined as module level constants are static and must not
+# be modified. Filters that depend on a video are created by the filter_*
+# functions below, which return a new filter each time they are called.
 FILTER_INPROGRESS = {
     'field': 'inprogress',
     'operator': 'true',
@@ -243,115 +218,16 @@ FILTER_REGULAR_SEASON = {
     'value': str(constants.SPECIALS)
 }
 FILTER_REGULAR_SEASON_INPROGRESS = {
-    'and': [
+    'and': (
         FILTER_REGULAR_SEASON,
         FILTER_INPROGRESS
-    ]
+    )
 }
 FILTER_REGULAR_SEASON_WATCHED = {
-    'and': [
+    'and': (
         FILTER_REGULAR_SEASON,
         FILTER_WATCHED
-    ]
-}
-FILTER_THIS_SEASON = {
-    'field': 'season',
-    'operator': 'is',
-    'value': constants.UNDEFINED_STR
-}
-
-FILTER_THIS_EPISODE = {
-    'field': 'episode',
-    'operator': 'is',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NEXT_EPISODE = {
-    'field': 'episode',
-    'operator': 'greaterthan',
-    'value': constants.UNDEFINED_STR
-}
-
-FILTER_AIRED = {
-    'field': 'airdate',
-    'operator': 'startswith',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_NEXT_AIRED = {
-    'field': 'airdate',
-    'operator': 'after',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_UPNEXT_AIRED = {
-    'or': [
-        FILTER_NEXT_AIRED,
-        {'and': [
-            FILTER_AIRED,
-            FILTER_NEXT_EPISODE
-        ]}
-    ]
-}
-FILTER_UNWATCHED_UPNEXT_AIRED = {
-    'and': [
-        FILTER_UNWATCHED,
-        FILTER_UPNEXT_AIRED
-    ]
-}
-
-FILTER_EPISODE = {
-    'and': [
-        FILTER_THIS_SEASON,
-        FILTER_THIS_EPISODE
-    ]
-}
-FILTER_UPNEXT_EPISODE = {
-    'and': [
-        FILTER_THIS_SEASON,
-        FILTER_NEXT_EPISODE
-    ]
-}
-FILTER_UNWATCHED_UPNEXT_EPISODE = {
-    'and': [
-        FILTER_UNWATCHED,
-        FILTER_THIS_SEASON,
-        FILTER_NEXT_EPISODE
-    ]
-}
-
-FILTER_GENRE = {
-    'field': 'genre',
-    'operator': 'contains',
-    'value': [constants.UNDEFINED_STR]
-}
-FILTER_UNWATCHED_GENRE = {
-    'and': [
-        FILTER_UNWATCHED,
-        FILTER_GENRE
-    ]
-}
-
-FILTER_SET = {
-    'field': 'set',
-    'operator': 'is',
-    'value': constants.UNDEFINED_STR
-}
-
-FILTER_NEXT_MOVIE = {
-    'field': 'year',
-    'operator': 'after',
-    'value': constants.UNDEFINED_STR
-}
-FILTER_UPNEXT_MOVIE = {
-    'and': [
-        FILTER_SET,
-        FILTER_NEXT_MOVIE
-    ]
-}
-FILTER_UNWATCHED_UPNEXT_MOVIE = {
-    'and': [
-        FILTER_UNWATCHED,
-        FILTER_SET,
-        FILTER_NEXT_MOVIE
-    ]
+    )
 }
 
 SORT_YEAR = {
@@ -383,6 +259,156 @@ _CACHE = {
     'playlistid': None
 }
 
+# Cache of video info details from Kodi library. Invalidated by the service
+# when the library is updated, and by other processes when the service changes
+# the value of LIBRARY_UPDATE_PROPERTY_NAME
+_DETAILS_CACHE = utils.ExpiringCache(maxsize=constants.LIBRARY_CACHE_SIZE,
+                                     ttl=constants.LIBRARY_CACHE_TTL)
+_LIBRARY_UPDATE = [None]
+
+
+def filter_field(field, operator, value=''):
+    return {
+        'field': field,
+        'operator': operator,
+        'value': value
+    }
+
+
+def filter_and(*filters):
+    return {'and': filters}
+
+
+def filter_or(*filters):
+    return {'or': filters}
+
+
+def filter_title(title):
+    return filter_field('title', 'is', title)
+
+
+def filter_not_filepath(filepath):
+    """Filter to check that both filename and path are different to those of
+       filepath, to deal with different file naming schemes e.g.
+       Season 1/Episode 1.mkv
+       Season 1/Episode 1/video.mkv
+       Season 1/Episode 1-2-3.mkv"""
+
+    path, filename = os.path.split(filepath)
+    return filter_or(
+        filter_field('filename', 'doesnotcontain', filename),
+        filter_field('path', 'doesnotcontain', path)
+    )
+
+
+def filter_episode(season, episode):
+    return filter_and(
+        filter_field('season', 'is', str(season)),
+        filter_field('episode', 'is', str(episode))
+    )
+
+
+def filter_upnext_episode(episode, unwatched_only=False):
+    """Filter for episodes after episode, in the same season"""
+
+    filters = (
+        filter_field('season', 'is', str(episode['season'])),
+        filter_field('episode', 'greaterthan', str(episode['episode']))
+    )
+    if unwatched_only:
+        return filter_and(FILTER_UNWATCHED, *filters)
+    return filter_and(*filters)
+
+
+def filter_upnext_aired(episode, unwatched_only=False):
+    """Filter for episodes that aired after episode, or on the same day but
+       numbered after episode"""
+
+    aired = utils.iso_datetime(episode['firstaired'])
+    filters = filter_or(
+        filter_field('airdate', 'after', aired),
+        filter_and(
+            filter_field('airdate', 'startswith', aired.split()[0]),
+            filter_field('episode', 'greaterthan', str(episode['episode']))
+        )
+    )
+    if unwatched_only:
+        return filter_and(FILTER_UNWATCHED, filters)
+    return filters
+
+
+def filter_genre(genres, unwatched_only=False):
+    filters = filter_field('genre', 'contains', list(genres))
+    if unwatched_only:
+        return filter_and(FILTER_UNWATCHED, filters)
+    return filters
+
+
+def filter_set(title):
+    return filter_field('set', 'is', title)
+
+
+def filter_upnext_movie(movie, unwatched_only=False):
+    """Filter for movies in the same set as movie, released after movie"""
+
+    filters = (
+        filter_set(movie['set']),
+        filter_field('year', 'after', str(movie['year']))
+    )
+    if unwatched_only:
+        return filter_and(FILTER_UNWATCHED, *filters)
+    return filter_and(*filters)
+
+
+class LibraryQuery(object):
+    """Immutable template for JSONRPC library queries. Params of the template
+       are serialised once and the cached JSON is shared by every request
+       created from the template. Each request is a new payload so queries
+       can be created and sent concurrently, or batched together"""
+
+    __slots__ = (
+        'method',
+        'params',
+        '_json',
+    )
+
+    def __init__(self, method, params=None):
+        self.method = method
+        self.params = params or {}
+        self._json = json.dumps(self.params, default=tuple)[1:-1]
+
+    def update(self, **params):
+        """Returns a new template with additional params"""
+
+        return LibraryQuery(self.method, dict(self.params, **params))
+
+    def request(self, **params):
+        """Returns a new JSONRPC request using the template params and any
+           additional params, which are serialised when the request is sent"""
+
+        if any(param in self.params for param in params):
+            return {'method': self.method,
+                    'params': dict(self.params, **params)}
+
+        return {'method': self.method,
+                'params': utils.JSONParams(self._json, params)}
+
+
+_QUERIES = {}
+
+
+def _library_query(detail_type, properties):
+    """Returns the query template used to get properties from Kodi library,
+       stored for reuse by subsequent queries"""
+
+    key = (detail_type['get_method'], frozenset(properties))
+    query = _QUERIES.get(key)
+    if query is None:
+        query = _QUERIES.setdefault(key, LibraryQuery(
+            detail_type['get_method'], {'properties': properties}
+        ))
+    return query
+
 
 def cache_invalidate():
     _CACHE.update(_CACHE.fromkeys(_CACHE))
@@ -767,17 +793,7 @@ def get_next_episode_from_library(episode=constants.UNDEFINED,
             utils.LOGWARNING)
         return episode
 
-    (path, filename) = os.path.split(episode['file'])
-    FILTER_NOT_FILE['value'] = filename
-    FILTER_NOT_PATH['value'] = path
-    filters = [
-        # Check that both next filename and path are different to current
-        # to deal with different file naming schemes e.g.
-        # Season 1/Episode 1.mkv
-        # Season 1/Episode 1/video.mkv
-        # Season 1/Episode 1-2-3.mkv
-        FILTER_NOT_FILEPATH
-    ]
+    filters = [filter_not_filepath(episode['file'])]
 
     if unwatched_only:
         # Exclude watched episodes
@@ -787,18 +803,12 @@ def get_next_episode_from_library(episode=constants.UNDEFINED,
         sort = SORT_RANDOM
     elif next_season:
         sort = SORT_DATE
-        FILTER_NEXT_EPISODE['value'] = str(episode['episode'])
-        aired = utils.iso_datetime(episode['firstaired'])
-        FILTER_AIRED['value'] = aired.split()[0]
-        FILTER_NEXT_AIRED['value'] = aired
-        filters.append(FILTER_UPNEXT_AIRED)
+        filters.append(filter_upnext_aired(episode))
     else:
         sort = SORT_EPISODE
-        FILTER_THIS_SEASON['value'] = str(episode['season'])
-        FILTER_NEXT_EPISODE['value'] = str(episode['episode'])
-        filters.append(FILTER_UPNEXT_EPISODE)
+        filters.append(filter_upnext_episode(episode))
 
-    filters = {'and': filters}
+    filters = filter_and(*filters)
 
     result, _ = get_videos_from_library(db_type='episodes',
                                         limit=1,
@@ -833,13 +843,10 @@ def get_next_movie_from_library(movie=constants.UNDEFINED,
         log('No next movie found, invalid movie setid', utils.LOGWARNING)
         return None
 
-    (path, filename) = os.path.split(movie['file'])
-    FILTER_NOT_FILE['value'] = filename
-    FILTER_NOT_PATH['value'] = path
-    filters = [FILTER_NOT_FILEPATH]
-
-    FILTER_SET['value'] = movie['set']
-    filters.append(FILTER_SET)
+    filters = [
+        filter_not_filepath(movie['file']),
+        filter_set(movie['set'])
+    ]
 
     if unwatched_only:
         filters.append(FILTER_UNWATCHED)
@@ -848,10 +855,9 @@ def get_next_movie_from_library(movie=constants.UNDEFINED,
         sort = SORT_RANDOM
     else:
         sort = SORT_YEAR
-        FILTER_NEXT_MOVIE['value'] = str(movie['year'])
-        filters.append(FILTER_NEXT_MOVIE)
+        filters.append(filter_field('year', 'after', str(movie['year'])))
 
-    filters = {'and': filters}
+    filters = filter_and(*filters)
 
     movie, _ = get_videos_from_library(db_type='movies',
                                        limit=1,
@@ -904,11 +910,10 @@ def get_from_library(db_type=None, db_id=constants.UNDEFINED, item=None):
 def get_tvshowid(title):
     """Function to search Kodi library for tshowid by title"""
 
-    FILTER_TITLE['value'] = title
     tvshow, _ = get_videos_from_library(db_type='tvshows',
                                         limit=1,
                                         properties=[],
-                                        filters=FILTER_TITLE)
+                                        filters=filter_title(title))
 
     if not tvshow:
         log('showtitle "{0}" not found in library'.format(title),
@@ -924,13 +929,10 @@ def get_episodeid(tvshowid, season, episode):
     """Function to search Kodi library for episodeid by tvshowid, season, and
        episode"""
 
-    FILTER_THIS_SEASON['value'] = str(season)
-    FILTER_THIS_EPISODE['value'] = str(episode)
-
     result, _ = get_videos_from_library(db_type='episodes',
                                         limit=1,
                                         properties=[],
-                                        filters=FILTER_EPISODE,
+                                        filters=filter_episode(season, episode),
                                         params={'tvshowid': tvshowid})
 
     if not result:
@@ -946,37 +948,136 @@ def get_episodeid(tvshowid, season, episode):
     return episodeid
 
 
-def get_details_from_library(db_type=None,
-                             db_id=constants.UNDEFINED,
-                             item=None,
-                             properties=None):
-    """Function to retrieve video info details from Kodi library"""
+def _details_request(db_type=None,
+                     db_id=constants.UNDEFINED,
+                     item=None,
+                     properties=None):
+    """Function to create JSONRPC request used to retrieve video info details
+       from Kodi library. Also returns the key used to cache the details"""
 
     if item:
         db_type = item['type']
         db_id = item['id']
 
     if not db_type or db_id == constants.UNDEFINED:
-        return None, None
+        return None, None, None
 
     detail_type = JSON_MAP.get(db_type)
     if detail_type and 'id_name' not in detail_type:
         detail_type = JSON_MAP.get(db_type[:-1])
     if not detail_type:
-        return None, None
+        return None, None, None
 
     if properties is None:
         properties = detail_type['properties']
     elif isinstance(properties, (set, frozenset)):
         properties = detail_type['properties'] | properties
 
-    result = utils.jsonrpc(method=detail_type['get_method'],
-                           params={detail_type['id_name']: db_id,
-                                   'properties': properties})
+    request = _library_query(detail_type, properties).request(
+        **{detail_type['id_name']: db_id}
+    )
+    key = (detail_type['id_name'], db_id, frozenset(properties))
+    return request, detail_type, key
+
+
+def _details_result(response, detail_type, key=None):
+    """Function to extract video info details from JSONRPC response, and store
+       a copy in the library details cache"""
 
-    result = result.get('result', {}).get(detail_type['result'], {})
+    result = response.get('result', {}).get(detail_type['result'], {})
     if result and 'mapping' in detail_type:
         map_properties(result, mapping=detail_type['mapping'])
+    if result and key:
+        _DETAILS_CACHE.set(key, copy.deepcopy(result))
+    return result
+
+
+def _details_cached(key):
+    """Function to get a copy of video info details from the library details
+       cache. Cache is cleared if the service has flagged a library update
+       that has not yet been seen by this process e.g. by the plugin"""
+
+    update = utils.get_property(constants.LIBRARY_UPDATE_PROPERTY_NAME)
+    if update != _LIBRARY_UPDATE[0]:
+        _LIBRARY_UPDATE[0] = update
+        _DETAILS_CACHE.invalidate()
+        return None
+
+    result = _DETAILS_CACHE.get(key)
+    return copy.deepcopy(result) if result else None
+
+
+def library_cache_invalidate(db_type=None, db_id=constants.UNDEFINED):
+    """Function to remove cached details of an updated or removed video, and
+       related details of its tvshow or episodes, or all cached details if
+       no video is specified. Other processes are flagged to clear their
+       cache by changing a window property"""
+
+    if not db_type or db_id == constants.UNDEFINED:
+        num_removed = _DETAILS_CACHE.invalidate()
+
+    elif db_type == 'episode':
+        tvshowids = {
+            utils.get_int(details, 'tvshowid')
+            for details in _DETAILS_CACHE.values(
+                lambda key, _: key[:2] == ('episodeid', db_id)
+            )
+        }
+        # Watched state of tvshow changes with that of its episodes. Remove
+        # details of all tvshows if the tvshowid of the episode is not known
+        num_removed = _DETAILS_CACHE.invalidate(
+            lambda key, _: key[:2] == ('episodeid', db_id) or (
+                key[0] == 'tvshowid'
+                and (not tvshowids or key[1] in tvshowids)
+            )
+        )
+
+    elif db_type == 'tvshow':
+        num_removed = _DETAILS_CACHE.invalidate(
+            lambda key, details: key[:2] == ('tvshowid', db_id) or (
+                key[0] == 'episodeid'
+                and utils.get_int(details, 'tvshowid') == db_id
+            )
+        )
+
+    elif db_type == 'season':
+        num_removed = _DETAILS_CACHE.invalidate(
+            lambda key, _: key[0] in ('tvshowid', 'episodeid')
+        )
+
+    else:
+        id_name = JSON_MAP.get(db_type, {}).get('id_name')
+        num_removed = _DETAILS_CACHE.invalidate(
+            lambda key, _: key[:2] == (id_name, db_id)
+        )
+
+    update = '{0:.6f}'.format(time())
+    _LIBRARY_UPDATE[0] = update
+    utils.set_property(constants.LIBRARY_UPDATE_PROPERTY_NAME, update)
+    log('Library cache: {0} entries removed for {1}'.format(
+        num_removed, '{0} {1}'.format(db_type, db_id) if db_type else 'all'
+    ))
+    return num_removed
+
+
+def get_details_from_library(db_type=None,
+                             db_id=constants.UNDEFINED,
+                             item=None,
+                             properties=None,
+                             cached=True):
+    """Function to retrieve video info details from Kodi library, or from the
+       library details cache if cached is True and details have been cached"""
+
+    request, detail_type, key = _details_request(db_type, db_id, item,
+                                                 properties)
+    if not request:
+        return None, None
+
+    result = _details_cached(key) if cached else None
+    if result:
+        return result, detail_type
+
+    result = _details_result(utils.jsonrpc(**request), detail_type, key)
     return result, detail_type
 
 
@@ -984,7 +1085,8 @@ def handle_just_watched(item, reset_playcount=False, reset_resume=True):
     """Function to update playcount and resume point of just watched video"""
 
     details = get_details_from_library(item=item,
-                                       properties=['playcount', 'resume'])
+                                       properties=['playcount', 'resume'],
+                                       cached=False)
     details, detail_type = details
 
     if not details:
@@ -1021,109 +1123,157 @@ def handle_just_watched(item, reset_playcount=False, reset_resume=True):
     ), utils.LOGDEBUG)
 
 
+def _get_batch_from_library(requests):
+    """Function to send requests, created by _videos_request or
+       _details_request, to Kodi library as a single batched JSONRPC call.
+       Returns the responses in the same order as the requests"""
+
+    if not requests:
+        return []
+    return utils.jsonrpc(batch=[request for request, _ in requests])
+
+
 def get_upnext_episodes_from_library(limit=25,  # pylint: disable=too-many-locals
                                      next_season=True,
-                                     unwatched_only=False):
-    """Function to get in-progress and next episode details from Kodi library"""
+                                     unwatched_only=False,
+                                     tvshowid=None):
+    """Function to get in-progress and next episode details from Kodi library.
+       Library queries are batched so that the number of JSONRPC calls does
+       not depend on the number of episodes. Results can be restricted to a
+       single tvshow by providing its tvshowid"""
 
     if next_season:
         filters = [
             FILTER_INPROGRESS,
             FILTER_WATCHED,
-            (FILTER_UNWATCHED_UPNEXT_AIRED if unwatched_only
-             else FILTER_UPNEXT_AIRED)
+            filter_upnext_aired
         ]
         sort = SORT_DATE
     else:
         filters = [
             FILTER_REGULAR_SEASON_INPROGRESS,
             FILTER_REGULAR_SEASON_WATCHED,
-            (FILTER_UNWATCHED_UPNEXT_EPISODE if unwatched_only
-             else FILTER_UPNEXT_EPISODE)
+            filter_upnext_episode
         ]
         sort = SORT_EPISODE
 
-    inprogress, _ = get_videos_from_library(db_type='episodes',
-                                            limit=limit,
-                                            sort=SORT_LASTPLAYED,
-                                            filters=filters[0])
-
-    watched, _ = get_videos_from_library(db_type='episodes',
-                                         limit=limit,
-                                         sort=SORT_LASTPLAYED,
-                                         filters=filters[1])
+    params = {'tvshowid': tvshowid} if tvshowid else None
+    inprogress, watched = [
+        _videos_result(response, JSON_MAP['episodes'])
+        for response in _get_batch_from_library([
+            _videos_request(db_type='episodes',
+                            limit=limit,
+                            sort=SORT_LASTPLAYED,
+                            filters=filters[0],
+                            params=params),
+            _videos_request(db_type='episodes',
+                            limit=limit,
+                            sort=SORT_LASTPLAYED,
+                            filters=filters[1],
+                            params=params),
+        ])
+    ]
 
     episodes = utils.merge_iterable(inprogress, watched,
                                     sort='lastplayed', unique='episodeid')
 
-    upnext_episodes = []
+    # Only the most recently played episode of each tvshow is used
+    requests = []
+    candidates = []
     tvshow_index = set()
     for episode in episodes:
         tvshowid = episode['tvshowid']
         if tvshowid in tvshow_index:
             continue
+        tvshow_index.add(tvshowid)
 
         resume = episode['resume']
-        if 0 < resume['position'] < 0.9 * resume['total']:
-            upnext_episode = episode
+        use_next = not 0 < resume['position'] < 0.9 * resume['total']
+        if use_next:
+            requests.append(_videos_request(
+                db_type='episodes',
+                limit=1,
+                sort=sort,
+                filters=filters[2](episode, unwatched_only),
+                params={'tvshowid': tvshowid}
+            ))
+
+        # Only request tvshow details that have not already been cached
+        request, detail_type, key = _details_request(db_type='tvshow',
+                                                     db_id=tvshowid)
+        tvshow_details = _details_cached(key)
+        if not tvshow_details:
+            requests.append((request, detail_type))
+        candidates.append((episode, use_next, tvshow_details, key))
+
+    responses = iter(_get_batch_from_library(requests))
+    upnext_episodes = []
+    for episode, use_next, tvshow_details, key in candidates:
+        if use_next:
+            upnext_episode = _videos_result(next(responses),
+                                            JSON_MAP['episodes'],
+                                            limit=1)
         else:
-            FILTER_THIS_SEASON['value'] = str(episode['season'])
-            FILTER_NEXT_EPISODE['value'] = str(episode['episode'])
-            aired = utils.iso_datetime(episode['firstaired'])
-            FILTER_AIRED['value'] = aired.split()[0]
-            FILTER_NEXT_AIRED['value'] = aired
-
-            upnext_episode, _ = get_videos_from_library(db_type='episodes',
-                                                        limit=1,
-                                                        sort=sort,
-                                                        filters=filters[2],
-                                                        params={'tvshowid':
-                                                                tvshowid})
-
-            if not upnext_episode:
-                tvshow_index.add(tvshowid)
-                continue
+            upnext_episode = episode
+        if not tvshow_details:
+            tvshow_details = _details_result(next(responses),
+                                             JSON_MAP['tvshow'],
+                                             key)
+
+        if not upnext_episode:
+            continue
 
         # Restore current episode lastplayed for sorting of next-up episode
         upnext_episode['lastplayed'] = episode['lastplayed']
         art_fallbacks(upnext_episode, art_map=EPISODE_ART_MAP, replace=False)
         # Combine tvshow details with episode details
-        tvshow_details, _ = get_details_from_library(db_type='tvshow',
-                                                     db_id=tvshowid)
         tvshow_details.update(upnext_episode)
         upnext_episodes.append(tvshow_details)
-        tvshow_index.add(tvshowid)
 
     return upnext_episodes
 
 
-def get_upnext_movies_from_library(limit=25,
+def get_upnext_movies_from_library(limit=25,  # pylint: disable=too-many-branches
                                    movie_sets=True,
-                                   unwatched_only=False):
-    """Function to get in-progress and next movie details from Kodi library"""
-
-    inprogress, _ = get_videos_from_library(db_type='movies',
-                                            limit=limit,
-                                            sort=SORT_LASTPLAYED,
-                                            filters=FILTER_INPROGRESS)
+                                   unwatched_only=False,
+                                   filters=None):
+    """Function to get in-progress and next movie details from Kodi library.
+       Library queries are batched so that the number of JSONRPC calls does
+       not depend on the number of movies. Results can be restricted to
+       movies matching additional filters e.g. movies in a single set"""
+
+    if filters:
+        filters = [
+            filter_and(FILTER_INPROGRESS, filters),
+            filter_and(FILTER_WATCHED, filters)
+        ]
+    else:
+        filters = [FILTER_INPROGRESS, FILTER_WATCHED]
 
+    requests = [
+        _videos_request(db_type='movies',
+                        limit=limit,
+                        sort=SORT_LASTPLAYED,
+                        filters=filters[0])
+    ]
     if movie_sets:
-        watched, _ = get_videos_from_library(db_type='movies',
-                                             limit=limit,
-                                             sort=SORT_LASTPLAYED,
-                                             filters=FILTER_WATCHED)
-
-        movies = utils.merge_iterable(inprogress, watched,
+        requests.append(_videos_request(db_type='movies',
+                                        limit=limit,
+                                        sort=SORT_LASTPLAYED,
+                                        filters=filters[1]))
+
+    movies = [
+        _videos_result(response, JSON_MAP['movies'])
+        for response in _get_batch_from_library(requests)
+    ]
+    if movie_sets:
+        movies = utils.merge_iterable(*movies,
                                       sort='lastplayed', unique='movieid')
     else:
-        movies = inprogress
-
-    filters = (
-        FILTER_UNWATCHED_UPNEXT_MOVIE if unwatched_only
-        else FILTER_UPNEXT_MOVIE
-    )
+        movies = movies[0]
 
-    upnext_movies = []
+    requests = []
+    candidates = []
     set_index = set()
     for movie in movies:
         setid = movie['setid'] or constants.UNDEFINED
@@ -1132,42 +1282,51 @@ def get_upnext_movies_from_library(limit=25,
 
         resume = movie['resume']
         if 0 < resume['position'] <= 0.9 * resume['total']:
-            upnext_movie = movie
+            candidates.append((movie, False))
         elif movie_sets and setid != constants.UNDEFINED:
-            FILTER_SET['value'] = movie['set']
-            FILTER_NEXT_MOVIE['value'] = str(movie['year'])
-
-            upnext_movie, _ = get_videos_from_library(db_type='movies',
-                                                      limit=1,
-                                                      sort=SORT_YEAR,
-                                                      filters=filters)
+            requests.append(_videos_request(
+                db_type='movies',
+                limit=1,
+                sort=SORT_YEAR,
+                filters=filter_upnext_movie(movie, unwatched_only)
+            ))
+            candidates.append((movie, True))
+        else:
+            continue
+        set_index.add(setid)
 
+    responses = iter(_get_batch_from_library(requests))
+    upnext_movies = []
+    for movie, use_next in candidates:
+        if use_next:
+            upnext_movie = _videos_result(next(responses),
+                                          JSON_MAP['movies'],
+                                          limit=1)
             if not upnext_movie:
-                set_index.add(setid)
                 continue
         else:
-            continue
+            upnext_movie = movie
 
         # Restore current movie lastplayed for sorting of next-up movie
         upnext_movie['lastplayed'] = movie['lastplayed']
         art_fallbacks(upnext_movie)
         upnext_movies.append(upnext_movie)
-        set_index.add(setid)
 
     return upnext_movies
 
 
-def get_videos_from_library(db_type,  # pylint: disable=too-many-arguments
-                            limit=25,
-                            sort=None,
-                            properties=None,
-                            filters=None,
-                            params=None):
-    """Function to get videos from Kodi library"""
+def _videos_request(db_type,  # pylint: disable=too-many-arguments
+                    limit=25,
+                    sort=None,
+                    properties=None,
+                    filters=None,
+                    params=None):
+    """Function to create JSONRPC request used to get videos from Kodi
+       library"""
 
     detail_type = JSON_MAP.get(db_type)
     if not detail_type:
-        return None
+        return None, None
 
     _params = {}
 
@@ -1175,7 +1334,6 @@ def get_videos_from_library(db_type,  # pylint: disable=too-many-arguments
         properties = detail_type['properties']
     elif isinstance(properties, (set, frozenset)):
         properties = detail_type['properties'] | properties
-    _params['properties'] = properties
 
     if filters is not None:
         _params['filter'] = filters
@@ -1183,8 +1341,7 @@ def get_videos_from_library(db_type,  # pylint: disable=too-many-arguments
     if isinstance(limit, dict):
         _params['limits'] = limit
     elif limit is not None:
-        QUERY_LIMITS['end'] = limit
-        _params['limits'] = QUERY_LIMITS
+        _params['limits'] = {'start': 0, 'end': limit}
 
     if sort is not None:
         _params['sort'] = sort
@@ -1192,15 +1349,84 @@ def get_videos_from_library(db_type,  # pylint: disable=too-many-arguments
     if params is not None:
         _params.update(params)
 
-    videos = utils.jsonrpc(method=detail_type['get_method'],
-                           params=_params)
-    videos = videos.get('result', {}).get(detail_type['result'], [])
+    request = _library_query(detail_type, properties).request(**_params)
+    return request, detail_type
+
+
+def _videos_result(response, detail_type, limit=25):
+    """Function to extract videos from JSONRPC response"""
+
+    videos = response.get('result', {}).get(detail_type['result'], [])
 
     if videos and limit == 1:
-        return videos[0], detail_type
+        return videos[0]
+    return videos
+
+
+def get_videos_from_library(db_type,  # pylint: disable=too-many-arguments
+                            limit=25,
+                            sort=None,
+                            properties=None,
+                            filters=None,
+                            params=None):
+    """Function to get videos from Kodi library"""
+
+    request, detail_type = _videos_request(db_type, limit, sort, properties,
+                                           filters, params)
+    if not request:
+        return None
+
+    videos = _videos_result(utils.jsonrpc(**request), detail_type, limit)
     return videos, detail_type
 
 
+def iter_videos_from_library(db_type,  # pylint: disable=too-many-arguments,too-many-locals
+                             chunk_size=250,
+                             sort=None,
+                             properties=None,
+                             filters=None,
+                             params=None,
+                             stop=None):
+    """Generator to page through videos from Kodi library in chunks of up to
+       chunk_size videos, yielding each video and its detail type. Once half
+       of a chunk has been processed the next chunk is requested in a separate
+       thread, unless stop() returns True, in which case the next chunk is
+       only requested if processing continues past the end of the chunk"""
+
+    def _get_chunk(start, result):
+        result[:] = get_videos_from_library(
+            db_type=db_type,
+            limit={'start': start, 'end': start + chunk_size},
+            sort=sort,
+            properties=properties,
+            filters=filters,
+            params=params
+        ) or ([], None)
+
+    result = [[], None]
+    _get_chunk(0, result)
+    start = 0
+    while True:
+        videos, detail_type = result
+        start += chunk_size
+        has_next = chunk_size and len(videos) == chunk_size
+        result = [[], None]
+        prefetch = None
+
+        for idx, video in enumerate(videos):
+            if (has_next and idx == chunk_size // 2
+                    and not (stop and stop())):
+                prefetch = utils.run_threaded(_get_chunk, args=(start, result))
+            yield video, detail_type
+
+        if not has_next:
+            return
+        if prefetch:
+            prefetch.join()
+        else:
+            _get_chunk(start, result)
+
+
 class InfoTagComparator(object):
     __slots__ = (
         'cast_crew',
@@ -1287,7 +1513,7 @@ class InfoTagComparator(object):
             (self.K_TAGS + self.K_SET_NAME) / 5
         )
 
-    def compare(self, infotags,  # pylint: disable=too-many-arguments, too-many-branches, too-many-locals
+    def compare(self, infotags,  # pylint: disable=too-many-branches, too-many-locals
                 _set=set,
                 _get=dict.get,
                 _len=len,
@@ -1369,7 +1595,7 @@ class InfoTagComparator(object):
         return 0
 
     @classmethod
-    def tokenise(cls, values, split=_token_split,  # pylint: disable=too-many-arguments,
+    def tokenise(cls, values, split=_token_split,
                  _empty=frozenset((None, )),
                  _add=set.add,
                  _len=len,
@@ -1448,65 +1674,76 @@ def get_similar_from_library(db_type,  # pylint: disable=too-many-arguments, too
     selected = []
     video_index = set()
 
+    def _select(video, similarity):
+        video['__similarity__'] = similarity
+        if return_all:
+            selected.append(video)
+            return
+        # Only the most similar videos are kept, in a min-heap of size limit.
+        # Order of selection is used to prefer videos found earlier i.e. those
+        # with a higher rating, over later videos with the same similarity
+        entry = (similarity, -len(video_index), video)
+        if len(selected) < limit:
+            heappush(selected, entry)
+        else:
+            heappushpop(selected, entry)
+
     id_name = 'movieid' if db_type == 'movies' else 'tvshowid'
     if id_name in original:
         video_index.add(original[id_name])
 
     if infotags.set_name and db_type == 'movies':
-        FILTER_SET['value'] = original['set']
         similar, _ = get_videos_from_library(db_type=db_type,
                                              limit=None,
                                              sort=SORT_YEAR,
-                                             filters=FILTER_SET)
+                                             filters=filter_set(original['set']))
         for video in similar:
             db_id = video[id_name]
             if db_id in video_index:
                 continue
             video_index.add(db_id)
             art_fallbacks(video)
-            video['__similarity__'] = InfoTagComparator.MAX_SIMILARITY
-            selected.append(video)
-
-    if not infotags.genres:
-        return original, selected
-
-    chunk_size = limit * 10
-    chunk_limit = {
-        'start': 0,
-        'end': chunk_size,
-    }
-
-    FILTER_GENRE['value'] = infotags.genres
-    unwatched_only = FILTER_UNWATCHED_GENRE if unwatched_only else FILTER_GENRE
-    while True:
-        similar, detail_type = get_videos_from_library(db_type=db_type,
-                                                       limit=chunk_limit,
-                                                       sort=SORT_RATING,
-                                                       properties=properties,
-                                                       filters=unwatched_only)
-
-        for video in similar:
+            _select(video, InfoTagComparator.MAX_SIMILARITY)
+
+    if infotags.genres:
+        chunk_size = limit * 10
+        count = infotags.count
+        checked = [count['__sum__'], len(video_index)]
+
+        def _stop():
+            """Next chunk is not prefetched if the rate at which similar videos
+               have been found since the last check indicates that the limit
+               will be reached within the remaining half of the chunk"""
+
+            found = count['__sum__'] - checked[0]
+            compared = len(video_index) - checked[1]
+            checked[:] = count['__sum__'], len(video_index)
+            expected = found * (chunk_size - chunk_size // 2) / max(1, compared)
+            return count['__sum__'] + expected >= count['__len__'] * limit
+
+        videos = iter_videos_from_library(
+            db_type=db_type,
+            chunk_size=chunk_size,
+            sort=SORT_RATING,
+            properties=properties,
+            filters=filter_genre(infotags.genres, unwatched_only),
+            stop=_stop
+        )
+        for video, detail_type in videos:
             db_id = video[id_name]
             if db_id in video_index:
                 continue
             video_index.add(db_id)
             similarity = infotags.compare(video)
             if similarity is None:
+                videos.close()
                 break
             if similarity:
                 art_fallbacks(video)
                 if 'mapping' in detail_type:
                     map_properties(video, mapping=detail_type['mapping'])
-                video['__similarity__'] = similarity
-                selected.append(video)
-        else:
-            if chunk_size and len(similar) == chunk_size:
-                chunk_limit['start'] += chunk_size
-                chunk_limit['end'] += chunk_size
-                continue
-        break
+                _select(video, similarity)
 
     if return_all:
         return original, selected
-    selected = utils.merge_iterable(selected, sort='__similarity__')
-    return original, selected[:limit]
+    return original, [video for _, _, video in sorted(selected, reverse=True)]
@@ -13,6 +13,14 @@ WIDGET_RELOAD_PROPERTY_NAME = 'UpNext.Widgets.Reload'
 WIDGET_RELOAD_PARAM_STRING = '?reload=$INFO[Window({0}).Property({1})]'.format(
     WINDOW_HOME, WIDGET_RELOAD_PROPERTY_NAME
 )
+LIBRARY_UPDATE_PROPERTY_NAME = 'UpNext.Library.Update'
+
+LIBRARY_CACHE_SIZE = 256
+LIBRARY_CACHE_TTL = 600
+
+LIBRARY_INDEX_PROPERTY_NAME = 'UpNext.Library.Index'
+# Maximum number of index entries of each type, same as maximum widget size
+LIBRARY_INDEX_SIZE = 100
 
 PLAY_CTRL_ID = 3012
 CLOSE_CTRL_ID = 3013
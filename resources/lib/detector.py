@@ -3,12 +3,24 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import io
 import json
+import mmap
+import os
+import struct
 import timeit
+import zlib
+from binascii import hexlify, unhexlify
+from bisect import bisect_left, bisect_right
+from contextlib import closing
+from functools import partial
+from math import isnan
+from operator import itemgetter
 
 import constants
 import file_utils
 import image_utils
+import statichelper
 import utils
 import xbmc
 from settings import SETTINGS
@@ -26,6 +38,153 @@ except ImportError:
         Full as QueueFull,
     )
 
+try:
+    from multiprocessing import (
+        get_all_start_methods,
+        get_context,
+        TimeoutError as PoolTimeout,
+    )
+    from multiprocessing.sharedctypes import RawArray
+    # Worker processes must be forked to inherit shared frame buffers, and to
+    # avoid re-launching Kodi as a child process
+    _FORK_CONTEXT = (
+        get_context('fork') if 'fork' in get_all_start_methods() else None
+    )
+except ImportError:
+    _FORK_CONTEXT = None
+
+    class PoolTimeout(Exception):
+        """Placeholder for multiprocessing.TimeoutError, which is never
+           raised as worker processes are not used without multiprocessing"""
+
+# Limits of the adaptive capture interval in seconds, and the range of
+# similarity below the detect level over which the interval is increased from
+# the minimum to the maximum interval
+_CAPTURE_INTERVAL_MIN = 1
+_CAPTURE_INTERVAL_MAX = 3
+_CAPTURE_SIMILARITY_RANGE = 20
+# Weighting of latest frame processing time in moving average processing time
+_PROCESSING_TIME_WEIGHT = 0.2
+
+# Stages of frame evaluation, in order of increasing processing cost. Later
+# stages only run if a match was not found by earlier stages.
+_STAGES = ('image', 'episodes', 'filtered')
+
+# Shared frame buffers, inherited by forked detector worker processes
+_PROCESS_FRAMES = []
+
+# Hashes from previously played episodes of the most recently played group,
+# loaded in the background and reused for subsequent episodes in the group
+_STORE_CACHE = {}
+_STORE_CACHE_LOCK = utils.create_lock()
+
+# Binary hash store file format. A fixed size header of format identifier,
+# store version, hash width, hash height, number of hash records and number of
+# timestamps, followed by an array of hash records and an array of timestamps.
+# Hash records consist of (time_to_end, time_from_start, group_idx) and the
+# packed hash value, timestamps consist of (group_idx, timestamp).
+# Journal files consist of blocks in the same format, with a different format
+# identifier and each followed by a CRC32 checksum of the block, appended
+# as each episode is stored. Journal blocks are merged into the store file
+# when the journal grows larger than the store file.
+_STORE_IDENTIFIER = b'UNHS'
+_STORE_JOURNAL_IDENTIFIER = b'UNHJ'
+_STORE_HEADER = struct.Struct('<4sdHHII')
+_STORE_TIMESTAMP = struct.Struct('<id')
+_STORE_CHECKSUM = struct.Struct('<I')
+_STORE_JOURNAL_MIN_SIZE = 64 * 1024
+_STORE_SUFFIXES = ('.bin', '.journal', '.json')
+
+try:
+    _bytes_to_int = int.from_bytes
+
+    def _int_to_bytes(value, length):
+        return value.to_bytes(length, 'big')
+except AttributeError:
+    def _bytes_to_int(data, byteorder='big'):  # pylint: disable=unused-argument
+        return int(hexlify(data), 16) if data else 0
+
+    def _int_to_bytes(value, length):
+        return unhexlify('{0:0{1}x}'.format(value, 2 * length))
+
+try:
+    _popcount = int.bit_count
+except AttributeError:
+    def _popcount(val):
+        return bin(val).count('1')
+
+
+def _iter_unpack(record_format, data, start, end):
+    """Unpack consecutive records from data[start:end] without copying data.
+       Used instead of Struct.iter_unpack, which is not available in Python 2
+       and can not be used with mmap objects without a memoryview"""
+
+    unpack_from = record_format.unpack_from
+    for offset in range(start, end, record_format.size):
+        yield unpack_from(data, offset)
+
+
+class PackedHash(object):
+    """Class to store an image hash as integer bitmasks of set pixels and
+       ignored pixels. The first pixel of the hash is the most significant bit
+       of each bitmask"""
+
+    __slots__ = (
+        'size',
+        'value',
+        'ignore',
+        'zero',
+        'num_set',
+        'num_ignore',
+        'num_zero',
+    )
+
+    def __init__(self, value=0, ignore=0, size=0):
+        self.size = size
+        self.value = value
+        self.ignore = ignore
+        self.zero = ((1 << size) - 1) & ~(value | ignore)
+        self.num_set = _popcount(value)
+        self.num_ignore = _popcount(ignore)
+        self.num_zero = size - self.num_set - self.num_ignore
+
+    def __eq__(self, other):
+        if not isinstance(other, PackedHash):
+            return NotImplemented
+        return (self.size == other.size
+                and self.value == other.value
+                and self.ignore == other.ignore)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash((self.size, self.value, self.ignore))
+
+    def __iter__(self):
+        for bit in range(self.size - 1, -1, -1):
+            if (self.ignore >> bit) & 1:
+                yield None
+            else:
+                yield (self.value >> bit) & 1
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def from_tuple(cls, image_hash):
+        value = 0
+        ignore = 0
+        for bit_val in image_hash:
+            value <<= 1
+            ignore <<= 1
+            if bit_val is None:
+                ignore |= 1
+            elif bit_val:
+                value |= 1
+        return cls(value, ignore, len(image_hash))
+
 
 class UpNextHashStore(object):
     """Class to store/save/load hashes used by UpNextDetector"""
@@ -36,27 +195,28 @@ class UpNextHashStore(object):
         'group_name',
         'group_idx',
         'data',
-        'timestamps'
+        'timestamps',
+        '_index',
+        '_journal_size',
+        '_pruned',
     )
 
     def __init__(self, **kwargs):
-        self.version = kwargs.get('version', 0.2)
+        self.version = kwargs.get('version', 0.3)
         self.hash_size = kwargs.get('hash_size', (8, 8))
         item = kwargs.get('item', {})
         self.group_name = item.get('group_name', '')
         self.group_idx = item.get('group_idx', constants.UNDEFINED)
         self.data = kwargs.get('data', {})
         self.timestamps = kwargs.get('timestamps', {self.group_idx: None})
-
-    @staticmethod
-    def int_to_hash(val, hash_size):
-        return tuple([  # pylint: disable=consider-using-generator
-            1 if bit_val == "1" else 0
-            for bit_val in bin(val)[2:].zfill(hash_size)
-        ])
+        self._index = None
+        self._journal_size = None
+        self._pruned = False
 
     @staticmethod
     def hash_to_int(image_hash):
+        if isinstance(image_hash, PackedHash):
+            return image_hash.value
         return sum(
             (bit_val or 0) << i
             for i, bit_val in enumerate(reversed(image_hash))
@@ -94,16 +254,209 @@ class UpNextHashStore(object):
         # New video is being played, invalidate old hashes
         return False
 
+    def add(self, hash_index, image_hash):
+        self.data[hash_index] = image_hash
+        self._index = None
+
+    def update(self, hashes=None, timestamps=None):
+        if hashes:
+            self.data.update(hashes)
+        if timestamps:
+            self.timestamps.update(timestamps)
+        self._index = None
+
+    def set_timestamp(self, group_idx, timestamp):
+        self.timestamps[group_idx] = timestamp
+        self._index = None
+
     def invalidate(self):
         self.group_name = ''
         self.group_idx = constants.UNDEFINED
 
-    def load(self, identifier):
+    def prune(self, group_idx, limit):
+        """Discard hashes and timestamps of all stored episodes other than the
+           limit number of episodes nearest to the reference episode, with
+           later episodes retained in preference to earlier episodes"""
+
+        if not limit:
+            return False
+
+        episodes = {hash_index[2] for hash_index in self.data}
+        episodes.update(self.timestamps)
+        episodes.discard(constants.UNDEFINED)
+        if len(episodes) <= limit:
+            return False
+
+        retained = set(sorted(
+            episodes,
+            key=lambda episode: (abs(episode - group_idx), -episode)
+        )[:limit])
+        retained.add(constants.UNDEFINED)
+        self.data = {
+            hash_index: image_hash
+            for hash_index, image_hash in self.data.items()
+            if hash_index[2] in retained
+        }
+        self.timestamps = {
+            episode: timestamp
+            for episode, timestamp in self.timestamps.items()
+            if episode in retained
+        }
+        self.log('Pruned {0} stored episodes'.format(
+            len(episodes) - len(retained) + 1
+        ))
+
+        # Store file must be rewritten to remove pruned episodes
+        self._index = None
+        self._pruned = True
+        return True
+
+    @classmethod
+    def prefetch(cls, item):
+        """Load stored hashes for the group of the item in a separate thread,
+           unless already loaded or being loaded"""
+
+        group_name = item.get('group_name')
+        if (not SETTINGS.detector_save_path or not group_name
+                or item.get('group_idx') == constants.UNDEFINED):
+            return None
+
+        with _STORE_CACHE_LOCK:
+            cached = _STORE_CACHE.get(group_name)
+            if cached:
+                return cached[1]
+
+            store = cls()
+            # Only the store for the most recent group is kept
+            _STORE_CACHE.clear()
+            _STORE_CACHE[group_name] = (
+                utils.run_threaded(store.load, args=(group_name,)),
+                store
+            )
+        return store
+
+    @classmethod
+    def fetch(cls, group_name, hash_size):
+        """Get stored hashes for a group, waiting for hashes to be loaded if
+           prefetched, or loading them now if not"""
+
+        with _STORE_CACHE_LOCK:
+            cached = _STORE_CACHE.get(group_name)
+            if not cached:
+                store = cls(hash_size=hash_size)
+                store.load(group_name)
+                _STORE_CACHE.clear()
+                _STORE_CACHE[group_name] = (None, store)
+                return store
+
+        loader, store = cached
+        if loader:
+            loader.join()
+        if not store.data:
+            store.hash_size = hash_size
+        return store
+
+    @classmethod
+    def evict(cls, limit, retain=None):  # pylint: disable=too-many-locals
+        """Remove all stored files of least recently used groups, until the
+           total size of stored files is within the limit"""
+
+        save_path = SETTINGS.detector_save_path
+        if not limit or not save_path:
+            return 0
+        if retain:
+            retain = os.path.splitext(os.path.basename(
+                file_utils.get_legal_filename(
+                    retain, prefix=save_path, suffix='.bin'
+                )
+            ))[0]
+
+        groups = {}
+        total_size = 0
+        try:
+            filenames = os.listdir(save_path)
+        except (IOError, OSError):
+            return 0
+        for filename in filenames:
+            identifier, suffix = os.path.splitext(filename)
+            if suffix not in _STORE_SUFFIXES:
+                continue
+            target = os.path.join(save_path, filename)
+            try:
+                stat = os.stat(target)
+            except (IOError, OSError):
+                continue
+            total_size += stat.st_size
+            if identifier == retain:
+                continue
+            group = groups.setdefault(identifier, [0, 0, []])
+            group[0] += stat.st_size
+            group[1] = max(group[1], stat.st_mtime)
+            group[2].append(target)
+
+        num_evicted = 0
+        for group_size, _, targets in sorted(
+                groups.values(), key=itemgetter(1)
+        ):
+            if total_size <= limit:
+                break
+            for target in targets:
+                try:
+                    os.remove(target)
+                except (IOError, OSError):
+                    pass
+            total_size -= group_size
+            num_evicted += 1
+
+        if num_evicted:
+            cls.log('Evicted {0} stored groups'.format(num_evicted))
+        return num_evicted
+
+    def _get_index(self):
+        """Index of hashes for each episode, sorted by time from start and by
+           time to end, and the first and last episodes. Index is created when
+           needed and discarded when the stored hashes or episodes change"""
+
+        index = self._index
+        if index is not None:
+            return index
+
+        episodes = {}
+        for hash_index in self.data:
+            episodes.setdefault(hash_index[2], []).append(hash_index)
+
+        for group_idx, hash_indexes in episodes.items():
+            by_start_time = sorted(hash_indexes, key=itemgetter(1))
+            by_end_time = sorted(hash_indexes, key=itemgetter(0))
+            episodes[group_idx] = (
+                [hash_index[1] for hash_index in by_start_time],
+                by_start_time,
+                [hash_index[0] for hash_index in by_end_time],
+                by_end_time,
+            )
+
+        index = (
+            episodes,
+            {min(self.timestamps), max(self.timestamps)}
+            if self.timestamps else set()
+        )
+        self._index = index
+        return index
+
+    @staticmethod
+    def _get_record_format(hash_size, _cache={}):  # pylint: disable=dangerous-default-value
+        record_format = _cache.get(hash_size)
+        if not record_format:
+            record_format = struct.Struct('<iii{0}s'.format((hash_size + 7) // 8))
+            _cache[hash_size] = record_format
+        return record_format
+
+    def _load_json(self, identifier):
         target = file_utils.get_legal_filename(
             identifier, prefix=SETTINGS.detector_save_path, suffix='.json'
         )
         try:
-            with open(target, mode='r', encoding='utf-8') as target_file:
+            with io.open(target, mode='r', encoding='utf-8') as target_file:
                 hashes = json.load(target_file)
         except (IOError, OSError, TypeError, ValueError):
             self.log('Could not load stored hashes from {0}'.format(target))
@@ -112,13 +465,14 @@ class UpNextHashStore(object):
         if not hashes:
             return False
 
+        self._index = None
         self.version = float(hashes.get('version', self.version))
         self.hash_size = hashes.get('hash_size', self.hash_size)
         if 'data' in hashes:
             hash_size = self.hash_size[0] * self.hash_size[1]
             self.data = {
                 tuple([utils.get_int(i) for i in key[1:-1].split(', ')]):  # pylint: disable=consider-using-generator
-                self.int_to_hash(hashes['data'][key], hash_size)
+                PackedHash(hashes['data'][key], size=hash_size)
                 for key in hashes['data']
             }
         if 'timestamps' in hashes:
@@ -129,64 +483,268 @@ class UpNextHashStore(object):
             }
 
         self.log('Hashes loaded from {0}'.format(target))
+
+        # Migrate to binary format and remove old file if successful
+        if self.save(identifier):
+            try:
+                os.remove(target)
+            except (IOError, OSError):
+                pass
         return True
 
-    def save(self, identifier):
-        output = {
-            'version': self.version,
-            'hash_size': self.hash_size,
-            'data': {
-                str(hash_index): self.hash_to_int(self.data[hash_index])
-                for hash_index in self.data
-                if hash_index[-1] != constants.UNDEFINED
-            },
-            'timestamps': self.timestamps
+    @classmethod
+    def _pack(cls, hash_size, hashes, timestamps, version,
+              identifier=_STORE_IDENTIFIER):
+        num_pixels = hash_size[0] * hash_size[1]
+        record_format = cls._get_record_format(num_pixels)
+        num_bytes = record_format.size - 12
+
+        # Records are sorted by episode and then by time from start of episode.
+        # Hashes of a different size can not be compared and are not stored.
+        records = sorted(
+            (hash_index for hash_index, image_hash in hashes.items()
+             if hash_index[-1] != constants.UNDEFINED
+             and len(image_hash) == num_pixels),
+            key=lambda hash_index: (hash_index[2], hash_index[1], hash_index[0])
+        )
+
+        output = bytearray(_STORE_HEADER.pack(
+            identifier,
+            version,
+            hash_size[0],
+            hash_size[1],
+            len(records),
+            len(timestamps)
+        ))
+        for hash_index in records:
+            output += record_format.pack(
+                hash_index[0],
+                hash_index[1],
+                hash_index[2],
+                _int_to_bytes(cls.hash_to_int(hashes[hash_index]), num_bytes)
+            )
+        for group_idx, timestamp in timestamps.items():
+            output += _STORE_TIMESTAMP.pack(
+                group_idx, float('nan') if timestamp is None else timestamp
+            )
+
+        return output
+
+    @classmethod
+    def _unpack(cls, data, offset=0, identifier=_STORE_IDENTIFIER):  # pylint: disable=too-many-locals
+        (block_identifier, version, width, height,
+         num_records, num_timestamps) = _STORE_HEADER.unpack_from(data, offset)
+        if block_identifier != identifier:
+            raise ValueError(block_identifier)
+
+        hash_size = width * height
+        record_format = cls._get_record_format(hash_size)
+        records_start = offset + _STORE_HEADER.size
+        records_end = records_start + num_records * record_format.size
+        timestamps_end = records_end + num_timestamps * _STORE_TIMESTAMP.size
+        if timestamps_end > len(data):
+            raise ValueError(timestamps_end)
+
+        hashes = {
+            (time_to_end, time_from_start, group_idx):
+                PackedHash(_bytes_to_int(packed_hash, 'big'), size=hash_size)
+            for time_to_end, time_from_start, group_idx, packed_hash
+            in _iter_unpack(record_format, data, records_start, records_end)
         }
+        timestamps = {
+            group_idx: None if isnan(timestamp) else timestamp
+            for group_idx, timestamp
+            in _iter_unpack(_STORE_TIMESTAMP, data, records_end, timestamps_end)
+        }
+
+        return version, [width, height], hashes, timestamps, timestamps_end
 
+    def _load_journal(self, identifier):
         target = file_utils.get_legal_filename(
-            identifier, prefix=SETTINGS.detector_save_path, suffix='.json'
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.journal'
         )
+        self._journal_size = 0
         try:
-            with open(target, mode='w', encoding='utf-8') as target_file:
-                json.dump(output, target_file, indent=4)
-                self.log('Hashes saved to {0}'.format(target))
-        except (IOError, OSError, TypeError, ValueError):
+            with open(target, mode='rb') as target_file, closing(mmap.mmap(
+                    target_file.fileno(), 0, access=mmap.ACCESS_READ
+            )) as data:
+                offset = 0
+                data_size = len(data)
+                while offset < data_size:
+                    try:
+                        version, hash_size, hashes, timestamps, end = (
+                            self._unpack(
+                                data, offset, _STORE_JOURNAL_IDENTIFIER
+                            )
+                        )
+                        checksum = _STORE_CHECKSUM.unpack_from(data, end)[0]
+                    except (TypeError, ValueError, struct.error):
+                        break
+                    if checksum != zlib.crc32(data[offset:end]) & 0xffffffff:
+                        break
+
+                    self.version = version
+                    self.hash_size = hash_size
+                    self.data.update(hashes)
+                    self.timestamps.update(timestamps)
+                    offset = end + _STORE_CHECKSUM.size
+        except (IOError, OSError, ValueError):
+            return False
+
+        # Incomplete data from an interrupted write is discarded on next append
+        if offset < data_size:
+            self.log('Incomplete data in {0}'.format(target), utils.LOGWARNING)
+
+        self._index = None
+        self._journal_size = offset
+        return offset > 0
+
+    def append(self, identifier, hashes, timestamps):
+        """Append new hashes and timestamps to the journal file, rather than
+           saving all hashes. Journal is merged into the store file when it
+           becomes larger than the store file"""
+
+        output = self._pack(
+            self.hash_size, hashes, timestamps, self.version,
+            _STORE_JOURNAL_IDENTIFIER
+        )
+        output += _STORE_CHECKSUM.pack(zlib.crc32(output) & 0xffffffff)
+
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.journal'
+        )
+        try:
+            with open(target, mode='ab') as target_file:
+                if self._journal_size is not None:
+                    target_file.truncate(self._journal_size)
+                target_file.write(output)
+                journal_size = target_file.tell()
+        except (IOError, OSError):
             self.log('Could not save hashes to {0}'.format(target),
                      utils.LOGWARNING)
-        return output
+            return False
+        self.log('Hashes saved to {0}'.format(target))
+
+        # Hashes not loaded from store file, can't merge journal into it
+        if self._journal_size is None:
+            return True
+        self._journal_size = journal_size
+
+        try:
+            store_size = os.path.getsize(file_utils.get_legal_filename(
+                identifier, prefix=SETTINGS.detector_save_path, suffix='.bin'
+            ))
+        except (IOError, OSError):
+            store_size = 0
+        if self._pruned or (
+                journal_size > max(_STORE_JOURNAL_MIN_SIZE, store_size)
+        ):
+            self.compact(identifier)
+        return True
+
+    def compact(self, identifier):
+        """Merge journal into store file by saving all loaded hashes to the
+           store file and then removing the journal"""
+
+        if not self.save(identifier):
+            return False
+
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.journal'
+        )
+        try:
+            os.remove(target)
+        except (IOError, OSError):
+            pass
+        self._journal_size = 0
+        return True
+
+    def load(self, identifier):
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.bin'
+        )
+        try:
+            with open(target, mode='rb') as target_file, closing(mmap.mmap(
+                    target_file.fileno(), 0, access=mmap.ACCESS_READ
+            )) as data:
+                self.version, self.hash_size, self.data, self.timestamps, _ = (
+                    self._unpack(data)
+                )
+            # Update modified time to track least recently used store files
+            os.utime(target, None)
+            self._index = None
+            loaded = True
+            self.log('Hashes loaded from {0}'.format(target))
+        except (IOError, OSError):
+            # Stored hashes not found, try to load and migrate old format
+            loaded = self._load_json(identifier)
+        except (TypeError, ValueError, struct.error):
+            self.log('Could not load stored hashes from {0}'.format(target))
+            loaded = False
+
+        # Update with hashes from any episodes stored since last merge
+        return self._load_journal(identifier) or loaded
+
+    def save(self, identifier):
+        output = self._pack(
+            self.hash_size, self.data, self.timestamps, self.version
+        )
+
+        # Write to temporary file first to avoid corrupting stored hashes
+        target = file_utils.get_legal_filename(
+            identifier, prefix=SETTINGS.detector_save_path, suffix='.bin'
+        )
+        try:
+            with open(target + '.tmp', mode='wb') as target_file:
+                target_file.write(output)
+            file_utils.replace_file(target + '.tmp', target)
+        except (IOError, OSError):
+            self.log('Could not save hashes to {0}'.format(target),
+                     utils.LOGWARNING)
+            return False
+
+        self._pruned = False
+        self.log('Hashes saved to {0}'.format(target))
+        return True
 
-    def window(self, hash_index,
+    def window(self, hash_index,  # pylint: disable=too-many-locals
                size=SETTINGS.detect_matches, all_episodes=False):
         """Get sets of hashes, either from all episodes or only from the first
         and last episodes, where the timestamps are approximately equal (+/- an
         adjustable offset) to the timestamps of the reference hash index"""
 
         end_time, start_time, episode = hash_index
+        episodes, first_and_last_episodes = self._get_index()
 
         if all_episodes:
-            excluded_episodes = [constants.UNDEFINED]
-            selected_episodes = self.timestamps.keys()
+            excluded_episodes = (constants.UNDEFINED, )
+            selected_episodes = self.timestamps
         else:
-            excluded_episodes = [constants.UNDEFINED, episode]
-            selected_episodes = {min(self.timestamps), max(self.timestamps)}
-
-        # Matching time period from start of file
-        min_start_time = start_time - size
-        max_start_time = start_time + size
-        # Matching time period from end of file
-        min_end_time = end_time - size
-        max_end_time = end_time + size
-
-        return {
-            hash_index: self.data[hash_index]
-            for hash_index in self.data
-            if hash_index[2] in selected_episodes
-            and hash_index[2] not in excluded_episodes
-            and (
-                min_start_time <= hash_index[1] <= max_start_time
-                or min_end_time <= hash_index[0] <= max_end_time
+            excluded_episodes = (constants.UNDEFINED, episode)
+            selected_episodes = first_and_last_episodes
+
+        hashes = {}
+        for group_idx in selected_episodes:
+            if group_idx in excluded_episodes or group_idx not in episodes:
+                continue
+
+            start_times, by_start_time, end_times, by_end_time = (
+                episodes[group_idx]
             )
-        }
+            # Matching time period from start of file
+            for match_index in by_start_time[
+                    bisect_left(start_times, start_time - size):
+                    bisect_right(start_times, start_time + size)
+            ]:
+                hashes[match_index] = self.data[match_index]
+            # Matching time period from end of file
+            for match_index in by_end_time[
+                    bisect_left(end_times, end_time - size):
+                    bisect_right(end_times, end_time + size)
+            ]:
+                hashes[match_index] = self.data[match_index]
+
+        return hashes
 
 
 class UpNextDetector(object):
@@ -205,7 +763,12 @@ class UpNextDetector(object):
         'capture_interval',
         'hash_index',
         'match_counts',
+        'processing_time',
+        'stage_stats',
         # Worker pool
+        'frames',
+        'frame_images',
+        'pool',
         'queue',
         'workers',
         # Signals
@@ -222,6 +785,9 @@ class UpNextDetector(object):
         self.state = state
         self.queue = None
         self.workers = None
+        self.pool = None
+        self.frames = None
+        self.frame_images = None
 
         self.match_counts = {
             'hits': 0,
@@ -235,23 +801,25 @@ class UpNextDetector(object):
         self._sigstop = utils.create_event()
         self._sigterm = utils.create_event()
 
-    @staticmethod
-    def _and(bit1, bit2):
-        return 1 if (bit1 and bit2) else 0
-
-    @staticmethod
-    def _eq_biased(bit1, bit2):
-        return (bit1 == bit2) * (1 if bit2 else 0.5)
-
-    @staticmethod
-    def _mul(bit1, bit2):
-        return bit1 * bit2
-
-    @staticmethod
-    def _xor(bit1, bit2):
-        # bit1 and bit2 are bools
-        # bit1 may be None
-        return 0 if bit1 is None or bit1 == bit2 else 1
+    @classmethod
+    def _get_credits_hashes(cls, hash_size, _cache={}):  # pylint: disable=dangerous-default-value
+        """Representative end credits hashes, with small, large, and full
+           padding, packed once for each hash size and reused by all detector
+           instances"""
+
+        hash_size = tuple(hash_size)
+        credits_hashes = _cache.get(hash_size)
+        if credits_hashes:
+            return credits_hashes
+
+        credits_hashes = tuple(
+            PackedHash.from_tuple(cls._generate_initial_hash(
+                *hash_size,
+                pad_height=pad_height
+            ))
+            for pad_height in (hash_size[1] // 4, hash_size[1] // 8, 0)
+        )
+        return _cache.setdefault(hash_size, credits_hashes)
 
     @staticmethod
     def _generate_initial_hash(hash_width, hash_height, pad_height=0):
@@ -300,74 +868,188 @@ class UpNextDetector(object):
         )
 
     @staticmethod
-    def _generate_mask(image_hash):
-        fuzzy_value = None
-        masked_value = 0
-
-        mask = len(image_hash) / image_hash.count(masked_value)
-        fuzzy_mask = 0.25
-        min_mask = 0.25
+    def _create_hash(image, hash_size, output_file=None, _plans={}):  # pylint: disable=dangerous-default-value
+        hash_size = tuple(hash_size)
+        plan = _plans.get((hash_size, output_file))
+        if not plan:
+            plan = _plans.setdefault(
+                (hash_size, output_file),
+                image_utils.compile_queue(
+                    queue=[
+                        [image_utils.resize, hash_size],
+                        [image_utils.points_of_interest],
+                        [image_utils.export_bits],
+                    ],
+                    save_file=output_file
+                )
+            )
 
-        return tuple(
-            mask if bit == masked_value else
-            fuzzy_mask if bit == fuzzy_value else
-            min_mask
-            for bit in image_hash
-        )
+        return PackedHash(plan(image), size=hash_size[0] * hash_size[1])
 
-    @staticmethod
-    def _create_hash(image, hash_size, output_file=None):
-        image_hash = image_utils.process(
-            image,
+    @classmethod
+    def _create_image_hashes(cls, frames, hash_size):
+        """Create images and image hashes for a batch of captured frames. Hash
+           creation steps are run once for the whole batch where possible.
+           Output is the same as _create_image and _create_hash for each
+           frame"""
+
+        images = [
+            cls._create_image(image_data, image_size)
+            for image_data, image_size in frames
+        ]
+        image_hashes = image_utils.process_batch(
+            images,
             queue=[
                 [image_utils.resize, hash_size],
                 [image_utils.points_of_interest],
-                [image_utils.export_data],
-            ],
-            save_file=output_file
+                [image_utils.export_bits],
+            ]
         )
 
-        return image_hash
+        num_pixels = hash_size[0] * hash_size[1]
+        return [
+            (image, PackedHash(image_hash, size=num_pixels))
+            for image, image_hash in zip(images, image_hashes)
+        ]
 
     @classmethod
-    def _create_images(cls, image_data, image_size):
-        image = image_utils.process(
-            image_data,
-            queue=[
-                [image_utils.import_data, image_size, False],
-                [image_utils.resize, cls._get_video_capture_resolution()],
-                [image_utils.saturation],
-                [image_utils.auto_level, 5, 95, (0.33, None)],
-            ],
-            save_file='1_image'
+    def _create_filtered_hashes(cls, image, hash_size, _plans={}):  # pylint: disable=dangerous-default-value
+        filtered_image = cls._create_filtered_image(image)
+
+        plan = _plans.get('3_expanded')
+        if not plan:
+            plan = _plans.setdefault(
+                '3_expanded',
+                image_utils.compile_queue(
+                    queue=[
+                        [image_utils.entropy_compare,
+                         image_utils.image_input(1), 1.10]
+                    ],
+                    save_file='3_expanded'
+                )
+            )
+        possible_credits, expanded_image = plan(image, filtered_image)
+
+        filtered_hash = cls._create_hash(filtered_image, hash_size)
+        expanded_hash = (
+            cls._create_hash(expanded_image, hash_size)
+            if possible_credits else None
         )
 
-        filtered_image = image_utils.process(
-            image,
-            queue=[
-                [image_utils.posterise, 3],
-                [image_utils.adaptive_filter, (8, 1, True),
-                 image_utils.auto_level, (5, 95, (0.33, None))],
-                [image_utils.apply_filter,
-                 'UnsharpMask,20,400,64', 'TRIM'],
-                [image_utils.apply_filter,
-                 'RankFilter,5,50', 'TRIM', None, 'difference'],
-                [image_utils.detail_reduce, image, 50],
-                [image_utils.apply_filter,
-                 'GaussianBlur,5', 'TRIM', None, 'multiply'],
-                [image_utils.auto_threshold],
-            ],
-            save_file='2_filter'
-        ) if SETTINGS.detector_filter else image
-
-        return image, filtered_image
+        return filtered_hash, expanded_hash
 
     @classmethod
-    def _hash_fuzz(cls, image_hash, masking_hash, factor=5):
-        weights = cls._generate_mask(masking_hash)
+    def _create_hashes(cls, image_data, image_size, hash_size, stage=None):
+        """Create image hash, filtered hash, and expanded hash. Only the
+           image hash is created for the image stage, and only the filtered
+           and expanded hashes are created for the filtered stage"""
+
+        image = cls._create_image(image_data, image_size)
+        if stage == 'filtered':
+            return cls._create_filtered_hashes(image, hash_size)
+
+        image_hash = cls._create_hash(image, hash_size)
+        if stage == 'image':
+            return (image_hash, )
+
+        return (image_hash, ) + cls._create_filtered_hashes(image, hash_size)
+
+    def _create_hashes_in_process(self, frame_idx, image_data, image_size,
+                                  stage=None):
+        """Method to create image hashes in a worker process. Captured image
+           data is copied to a shared frame buffer, and only hash values are
+           returned from the worker process. Image created for the image stage
+           is kept in the frame buffer and reused by the filtered stage of the
+           same frame"""
+
+        frame = memoryview(self.frames[frame_idx]).cast('B')
+        data_size = len(image_data)
+        if data_size > len(frame):
+            return self._create_hashes(
+                image_data, image_size, self.hashes.hash_size, stage
+            )
+        if stage == 'filtered':
+            stored_size = self.frame_images[frame_idx]
+        else:
+            frame[:data_size] = image_data
+            stored_size = None
+        self.frame_images[frame_idx] = None
+
+        hash_size = self.hashes.hash_size
+        hashes, self.frame_images[frame_idx] = self.pool.apply_async(
+            _process_worker,
+            (frame_idx, data_size, image_size, hash_size, stage, stored_size)
+        ).get(2 * SETTINGS.detector_threads * self.capture_interval)
+
+        num_pixels = hash_size[0] * hash_size[1]
+        return tuple(
+            None if image_hash is None
+            else PackedHash(image_hash, size=num_pixels)
+            for image_hash in hashes
+        )
+
+    @classmethod
+    def _create_image(cls, image_data, image_size, _plans={}):  # pylint: disable=dangerous-default-value
+        # Plans are compiled once for each captured image size and reused
+        image_size = tuple(image_size)
+        plan = _plans.get(image_size)
+        if not plan:
+            plan = _plans.setdefault(image_size, image_utils.compile_queue(
+                queue=[
+                    [image_utils.import_data, image_size, False],
+                    [image_utils.resize, cls._get_video_capture_resolution()],
+                    [image_utils.saturation],
+                    [image_utils.auto_level, 5, 95, (0.33, None)],
+                ],
+                save_file='1_image'
+            ))
+
+        return plan(image_data)
+
+    @staticmethod
+    def _create_filtered_image(image, _plans={}):  # pylint: disable=dangerous-default-value
+        if not SETTINGS.detector_filter:
+            return image
+
+        plan = _plans.get('2_filter')
+        if not plan:
+            plan = _plans.setdefault('2_filter', image_utils.compile_queue(
+                queue=[
+                    [image_utils.posterise, 3],
+                    [image_utils.adaptive_filter, (8, 1, True),
+                     image_utils.auto_level, (5, 95, (0.33, None))],
+                    [image_utils.apply_filter,
+                     'UnsharpMask,20,400,64', 'TRIM'],
+                    [image_utils.apply_filter,
+                     'RankFilter,5,50', 'TRIM', None, 'difference'],
+                    [image_utils.detail_reduce, image_utils.image_input(0), 50],
+                    [image_utils.apply_filter,
+                     'GaussianBlur,5', 'TRIM', None, 'multiply'],
+                    [image_utils.auto_threshold],
+                ],
+                save_file='2_filter'
+            ))
 
-        significant_bits = sum(map(cls._mul, image_hash, weights))
-        significance = 100 * significant_bits / len(image_hash)
+        return plan(image)
+
+    @classmethod
+    def _create_images(cls, image_data, image_size):
+        image = cls._create_image(image_data, image_size)
+        return image, cls._create_filtered_image(image)
+
+    @staticmethod
+    def _hash_fuzz(image_hash, masking_hash, factor=5):
+        # Unset pixels in the masking hash are weighted by the inverse of the
+        # proportion of unset pixels, all other pixels have a fixed weighting
+        mask = masking_hash.size / masking_hash.num_zero
+        fuzzy_mask = 0.25
+
+        significant_bits = _popcount(image_hash.value & masking_hash.zero)
+        significant_bits = (
+            mask * significant_bits
+            + fuzzy_mask * (image_hash.num_set - significant_bits)
+        )
+        significance = 100 * significant_bits / image_hash.size
         delta = significance - SETTINGS.detect_significance
 
         return factor * delta / SETTINGS.detect_significance
@@ -382,20 +1064,26 @@ class UpNextDetector(object):
 
         compare_hash = filtered_hash or image_hash
 
-        num_pixels = len(baseline_hash)
-        if num_pixels != len(compare_hash):
+        num_pixels = baseline_hash.size
+        if num_pixels != compare_hash.size:
             return 0
 
-        # Check whether each pixel is equal
-        bits_eq = sum(map(cls._eq_biased, baseline_hash, compare_hash))
-        bits_xor = tuple(map(cls._xor, baseline_hash, compare_hash))
-        bits_xor_baseline = sum(map(cls._and, bits_xor, baseline_hash))
-        bits_xor_compare = sum(map(cls._and, bits_xor, compare_hash))
+        # Check whether each pixel is equal. Equal set pixels are given full
+        # weighting, equal unset or ignored pixels are given half weighting
+        bits_set = _popcount(baseline_hash.value & compare_hash.value)
+        bits_eq = bits_set + (
+            _popcount(baseline_hash.zero & compare_hash.zero)
+            + _popcount(baseline_hash.ignore & compare_hash.ignore)
+        ) / 2
+        # Pixels set in the baseline hash but not in the compare hash
+        bits_xor_baseline = baseline_hash.num_set - bits_set
+        # Pixels set in the compare hash but unset in the baseline hash
+        bits_xor_compare = _popcount(baseline_hash.zero & compare_hash.value)
 
         weighted_total = (
             num_pixels
-            - baseline_hash.count(None)
-            - (min(baseline_hash.count(0), compare_hash.count(0)) / 2)
+            - baseline_hash.num_ignore
+            - (min(baseline_hash.num_zero, compare_hash.num_zero) / 2)
         )
         bit_compare = bits_eq - bits_xor_baseline - bits_xor_compare
 
@@ -438,7 +1126,8 @@ class UpNextDetector(object):
         num_bits = size[0] * size[1]
         row_length = size[0]
 
-        hashes = [image_hash if image_hash and len(image_hash) == num_bits
+        hashes = [tuple(image_hash)
+                  if image_hash and len(image_hash) == num_bits
                   else (0, ) * num_bits
                   for image_hash in hashes]
 
@@ -460,9 +1149,18 @@ class UpNextDetector(object):
     def log(cls, msg, level=utils.LOGDEBUG):
         utils.log(msg, name=cls.__name__, level=level)
 
-    def _evaluate_similarity(self, image, filtered_image, hash_size):
+    def _evaluate_similarity(self, image_hash, create_hashes, timings):
+        """Staged evaluation of frame similarity. Current hash is checked if
+           blank, then compared to previous hash and other episode hashes, and
+           only then are filtered hashes created by create_hashes and compared
+           to representative end credits hashes. Later stages are skipped if
+           a match is found, unless debugging"""
+
         is_match = False
         possible_match = False
+        filtered_hash = None
+        expanded_hash = None
+        matched_stage = None
 
         stats = {
             # Similarity to representative end credits hash
@@ -475,21 +1173,45 @@ class UpNextDetector(object):
             'episodes': constants.UNDEFINED
         }
 
-        possible_credits, expanded_image = image_utils.process(
-            image,
-            queue=[
-                [image_utils.entropy_compare, filtered_image, 1.10]
-            ],
-            save_file='3_expanded'
+        # Match if current hash is blank
+        is_match = not image_hash.value
+        if is_match:
+            matched_stage = 'image'
+        # Unless debugging, return if match found, otherwise continue checking
+        if is_match and not SETTINGS.detector_debug:
+            self._hash_match_hit()
+            return stats, filtered_hash, expanded_hash
+
+        stage_start = timeit.default_timer()
+        # Calculate similarity between current hash and previous hash
+        stats['previous'] = self._hash_similarity(
+            self.hashes.data.get(self.hash_index['previous']),
+            image_hash
         )
+        # Possible match if current hash matches previous hash
+        possible_match = stats['previous'] >= SETTINGS.detect_level
 
-        image_hash = self._create_hash(image, hash_size)
-        filtered_hash = self._create_hash(filtered_image, hash_size)
-        expanded_hash = None
+        old_hashes = self.past_hashes.window(self.hash_index['current'])
+        for self.hash_index['episodes'], old_hash in old_hashes.items():
+            stats['episodes'] = self._hash_similarity(
+                old_hash,
+                image_hash
+            )
+            # Match if current hash matches other episode hashes
+            if stats['episodes'] >= SETTINGS.detect_level:
+                is_match = True
+                matched_stage = matched_stage or 'episodes'
+                break
+        timings['episodes'] = timeit.default_timer() - stage_start
 
-        if possible_credits:
-            expanded_hash = self._create_hash(expanded_image, hash_size)
+        # Unless debugging, return if match found, otherwise continue checking
+        if is_match and not SETTINGS.detector_debug:
+            self._hash_match_hit()
+            return stats, filtered_hash, expanded_hash
 
+        stage_start = timeit.default_timer()
+        filtered_hash, expanded_hash = create_hashes()
+        if expanded_hash is not None:
             # Calculate similarity between current hash and representative hash
             stats['credits'] = max(self._hash_similarity(
                 self.hashes.data.get(self.hash_index['credits_small']),
@@ -511,48 +1233,22 @@ class UpNextDetector(object):
             ) / self._hash_similarity(
                 filtered_hash, image_hash, expanded_hash
             )
+        timings['filtered'] = timeit.default_timer() - stage_start
+
+        # Match if current hash matches representative hash, or if detection
+        # estimate indicates result was relevant
+        if (stats['credits'] >= SETTINGS.detect_level or (
+                possible_match
+                and stats['detected'] >= (
+                    SETTINGS.detect_level
+                    - (0.004 * stats['previous'] * stats['credits'])
+                )
+        )):
+            is_match = True
+            matched_stage = matched_stage or 'filtered'
 
-        # Match if current hash matches representative hash or if current hash
-        # is blank
-        is_match = (
-            not any(image_hash)
-            or stats['credits'] >= SETTINGS.detect_level
-        )
-        # Unless debugging, return if match found, otherwise continue checking
-        if is_match and not SETTINGS.detector_debug:
-            self._hash_match_hit()
-            return stats, (image_hash, filtered_hash, expanded_hash)
-
-        # Calculate similarity between current hash and previous hash
-        stats['previous'] = self._hash_similarity(
-            self.hashes.data.get(self.hash_index['previous']),
-            image_hash
-        )
-        # Possible match if current hash matches previous hash
-        possible_match = stats['previous'] >= SETTINGS.detect_level
-        # Match if detection estimate indicates result was relevant
-        is_match = is_match or (
-            possible_match and
-            stats['detected'] >= (
-                SETTINGS.detect_level -
-                (0.004 * stats['previous'] * stats['credits'])
-            )
-        )
-        # Unless debugging, return if match found, otherwise continue checking
-        if is_match and not SETTINGS.detector_debug:
-            self._hash_match_hit()
-            return stats, (image_hash, filtered_hash, expanded_hash)
-
-        old_hashes = self.past_hashes.window(self.hash_index['current'])
-        for self.hash_index['episodes'], old_hash in old_hashes.items():
-            stats['episodes'] = self._hash_similarity(
-                old_hash,
-                image_hash
-            )
-            # Match if current hash matches other episode hashes
-            if stats['episodes'] >= SETTINGS.detect_level:
-                is_match = True
-                break
+        if SETTINGS.detector_debug:
+            self._update_stage_stats(timings, matched_stage)
 
         # Increment the number of matches
         if is_match:
@@ -561,7 +1257,88 @@ class UpNextDetector(object):
         elif not possible_match:
             self._hash_match_miss()
 
-        return stats, (image_hash, filtered_hash, expanded_hash)
+        return stats, filtered_hash, expanded_hash
+
+    def _update_stage_stats(self, timings, matched_stage):
+        with self._lock:
+            for stage, stage_time in timings.items():
+                stage_stats = self.stage_stats[stage]
+                stage_stats[0] += 1
+                stage_stats[1] += stage == matched_stage
+                stage_stats[2] += stage_time
+
+    def _log_stage_stats(self):
+        for stage in _STAGES:
+            num_frames, num_matches, total_time = self.stage_stats[stage]
+            self.log('Stage {0}: {1} frames, {2} matched, {3:.1f}ms'.format(
+                stage,
+                num_frames,
+                num_matches,
+                1000 * total_time / num_frames if num_frames else 0
+            ))
+
+    def _save_process_stats(self):
+        """Log time taken by each image processing step, slowest steps first,
+           and save the summary as json to the detector save path"""
+
+        process_stats = image_utils.get_process_stats(reset=True)
+        for name, step_stats in sorted(process_stats.items(),
+                                       key=lambda item: item[1]['total_time'],
+                                       reverse=True):
+            self.log('Step {0}: {1[count]} calls, {1[wall_time]:.2f}ms wall, '
+                     '{1[cpu_time]:.2f}ms CPU, p50 {1[p50]:.2f}ms, '
+                     'p90 {1[p90]:.2f}ms, {1[output_size]} bytes'.format(
+                         name, step_stats
+                     ))
+
+        if not process_stats or not SETTINGS.detector_save_path:
+            return
+
+        target = file_utils.get_legal_filename(
+            'process_stats', prefix=SETTINGS.detector_save_path, suffix='.json'
+        )
+        try:
+            with io.open(target, mode='w', encoding='utf-8') as target_file:
+                # Python 2 json.dump writes str, io text file requires unicode
+                target_file.write(statichelper.from_bytes(json.dumps(
+                    process_stats, indent=4, sort_keys=True
+                )))
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not save processing stats to {0}'.format(target),
+                     utils.LOGWARNING)
+            return
+        self.log('Processing stats saved to {0}'.format(target))
+
+    def _update_capture_interval(self, stats, processing_time):
+        """Capture less often while captured frames are dissimilar to end
+           credits, and at the minimum interval once matches are found. The
+           minimum interval is limited by the average frame processing time
+           and the number of matches required is scaled to keep the same
+           detection period"""
+
+        with self._lock:
+            self.processing_time += _PROCESSING_TIME_WEIGHT * (
+                processing_time - self.processing_time
+            )
+            min_interval = max(
+                _CAPTURE_INTERVAL_MIN,
+                self.processing_time / max(1, SETTINGS.detector_threads - 1)
+            )
+
+            if self.match_counts['hits']:
+                capture_interval = min_interval
+            else:
+                scale = (
+                    SETTINGS.detect_level - max(stats.values())
+                ) / _CAPTURE_SIMILARITY_RANGE
+                capture_interval = max(min_interval, min_interval + (
+                    _CAPTURE_INTERVAL_MAX - min_interval
+                ) * min(1, max(0, scale)))
+
+            self.capture_interval = capture_interval
+            self.match_number = max(1, int(
+                SETTINGS.detect_matches / capture_interval
+            ))
 
     def _hash_match_hit(self):
         with self._lock:
@@ -585,8 +1362,12 @@ class UpNextDetector(object):
             self.match_counts['detected'] = False
 
     def _init_hashes(self):
-        # Set minimum capture interval to decrease capture rate
-        self.capture_interval = 1
+        # Start at minimum capture interval, adjusted as frames are processed
+        self.capture_interval = _CAPTURE_INTERVAL_MIN
+        self.processing_time = 0
+        # Number of frames evaluated, frames matched, and evaluation time for
+        # each stage of frame evaluation
+        self.stage_stats = {stage: [0, 0, 0] for stage in _STAGES}
 
         self.hash_index = {
             # Hash indexes are tuples containing the following data:
@@ -617,31 +1398,30 @@ class UpNextDetector(object):
             # Representative hash of centred end credits text on a dark
             # background stored as first hash. Masked significance weights
             # stored as second hash.
-            data={
-                self.hash_index['credits_small']: self._generate_initial_hash(
-                    *hash_size,
-                    pad_height=(hash_size[1] // 4)
-                ),
-                self.hash_index['credits_large']: self._generate_initial_hash(
-                    *hash_size,
-                    pad_height=(hash_size[1] // 8)
-                ),
-                self.hash_index['credits_full']: self._generate_initial_hash(
-                    *hash_size
-                ),
-            },
+            data=dict(zip(
+                (self.hash_index['credits_small'],
+                 self.hash_index['credits_large'],
+                 self.hash_index['credits_full']),
+                self._get_credits_hashes(hash_size)
+            )),
         )
 
         # Hashes from previously played episodes
-        self.past_hashes = UpNextHashStore(hash_size=hash_size)
         if SETTINGS.detector_save_path and self.hashes.is_valid():
-            self.past_hashes.load(self.hashes.group_name)
+            self.past_hashes = UpNextHashStore.fetch(
+                self.hashes.group_name, hash_size
+            )
+            self.past_hashes.prune(
+                self.hashes.group_idx, SETTINGS.detector_episode_limit
+            )
+        else:
+            self.past_hashes = UpNextHashStore(hash_size=hash_size)
 
         # Number of consecutive frame matches required for a positive detection
         # Set to 5s of captured frames as default
-        self.match_number = int(
+        self.match_number = max(1, int(
             SETTINGS.detect_matches / self.capture_interval
-        )
+        ))
         # Number of consecutive frame mismatches required to reset match count
         # Set to 3 frames to account for bad frame capture
         self.mismatch_number = SETTINGS.detect_mismatches
@@ -666,7 +1446,7 @@ class UpNextDetector(object):
     def _queue_push(self, queue=None):
         queue = queue or self.queue
         try:
-            capturer, size = self._queue_pull(queue)
+            capturer, size, _ = self._queue_pull(queue)
             capturer.capture(*size)
             abort = False
         except TypeError:
@@ -675,9 +1455,15 @@ class UpNextDetector(object):
         while not (abort or self._sigterm.is_set() or self._sigstop.is_set()):
             loop_start = timeit.default_timer()
 
+            # Snapshot of player state is taken once per captured frame and
+            # passed to workers with the frame, rather than each worker
+            # querying the player. Speed changes and seeks restart detector.
             with utils.ContextManager(self, 'player') as check_fail:
                 if check_fail is AttributeError:
                     raise check_fail
+                play_time = self.player.getTime()
+                player_state = (play_time, self.player.getTotalTime())
+                # Only capture if playing at normal speed
                 check_fail = self.player.get_speed() < 1
             if check_fail:
                 self.log('Stop capture: nothing playing')
@@ -703,7 +1489,8 @@ class UpNextDetector(object):
                 capturer = xbmc.RenderCapture()
 
             try:
-                queue.put((image_data, size), timeout=self.capture_interval)
+                queue.put((image_data, size, player_state),
+                          timeout=self.capture_interval)
                 capturer.capture(*size)
 
                 loop_time = timeit.default_timer() - loop_start
@@ -732,6 +1519,19 @@ class UpNextDetector(object):
 
         return queue.get(timeout=timeout)
 
+    def _queue_pull_batch(self, queue=None, timeout=None):
+        """Pull next frame from queue, waiting if required, along with any
+           other frames that are already waiting to be processed"""
+
+        queue = queue or self.queue
+        frames = [self._queue_pull(queue, timeout)]
+        while queue and frames[-1] is not None:
+            try:
+                frames.append(queue.get_nowait())
+            except QueueEmpty:
+                break
+        return frames
+
     def _queue_task_done(self, queue=None):
         queue = queue or self.queue
         if not queue or not queue.unfinished_tasks:
@@ -739,8 +1539,42 @@ class UpNextDetector(object):
 
         queue.task_done()
 
+    def _pool_create(self, num_workers):
+        if not SETTINGS.detector_processes:
+            return
+
+        if not _FORK_CONTEXT:
+            self.log('Worker processes not supported, using threads',
+                     utils.LOGWARNING)
+            return
+
+        # Frame buffers sized for the maximum capture data limit. Must be
+        # created before worker processes are forked
+        self.frames = [
+            RawArray('B', 4 * 8 * 1024 * SETTINGS.detector_data_limit)
+            for _ in range(num_workers)
+        ]
+        self.frame_images = [None] * num_workers
+        self.pool = _FORK_CONTEXT.Pool(
+            processes=num_workers,
+            initializer=_process_worker_init,
+            initargs=(self.frames, )
+        )
+
+    def _pool_release(self):
+        if not self.pool:
+            return
+
+        self.pool.terminate()
+        self.pool.join()
+        del self.pool
+        self.pool = None
+        del self.frames
+        self.frames = None
+        self.frame_images = None
+
     @utils.Profiler(enabled=SETTINGS.detector_debug, lazy=True)
-    def _worker(self):
+    def _worker(self, frame_idx=0):
         """Detection loop captures Kodi render buffer every 1s to create an
            image hash. Hash is compared to the previous hash to determine
            whether current frame of video is similar to the previous frame.
@@ -754,81 +1588,154 @@ class UpNextDetector(object):
         queue = self.queue
 
         while not (self._sigterm.is_set() or self._sigstop.is_set()):
-            with utils.ContextManager(self, 'player') as check_fail:
-                if check_fail is AttributeError:
-                    raise check_fail
-                play_time = self.player.getTime()
-                self.hash_index['current'] = (
-                    int(self.player.getTotalTime() - play_time),
-                    int(play_time),
-                    self.hashes.group_idx
-                )
-                # Only capture if playing at normal speed
-                check_fail = self.player.get_speed() < 1
-            if check_fail:
-                self.log('No file is playing')
-                break
-
             try:
-                image_data, size = self._queue_pull(queue,
-                                                    SETTINGS.detector_threads)
-                if not isinstance(image_data, (bytes, bytearray)):
-                    raise QueueEmpty
-            except TypeError:
-                self.log('Queue empty - exiting')
-                break
+                frames = self._queue_pull_batch(
+                    queue, SETTINGS.detector_threads
+                )
             except QueueEmpty:
                 self.log('Queue empty - retry')
                 continue
 
-            image, filtered_image = self._create_images(image_data, size)
+            # Frames are evaluated in capture order. Invalid frames are skipped
+            # and a None item signals that workers should exit
+            exiting = frames[-1] is None
+            frames = sorted(
+                [frame for frame in frames
+                 if frame and isinstance(frame[0], (bytes, bytearray))],
+                key=lambda frame: frame[2][0]
+            )
+
+            # Create images and image hashes for all frames together if more
+            # than one frame is waiting to be processed
+            if len(frames) > 1 and not self.pool:
+                process_start = timeit.default_timer()
+                created = self._create_image_hashes(
+                    [(image_data, size) for image_data, size, _ in frames],
+                    self.hashes.hash_size
+                )
+                process_time = (
+                    (timeit.default_timer() - process_start) / len(frames)
+                )
+                created = [
+                    (image, image_hash, process_time)
+                    for image, image_hash in created
+                ]
+            else:
+                created = [None] * len(frames)
+
+            for frame, hashes in zip(frames, created):
+                self._worker_evaluate(queue, frame_idx, frame, hashes)
+
+            if exiting:
+                self.log('Queue empty - exiting')
+                break
+
+        self._queue_task_done(queue)
+
+    def _worker_evaluate(self, queue, frame_idx, frame, hashes=None):  # pylint: disable=too-many-locals
+        """Evaluate a single captured frame. Image and image hash are created
+           here unless already created as part of a batch of frames. Returns
+           time taken for each stage of evaluation"""
+
+        image_data, size, player_state = frame
+
+        # Use snapshot of player state from when frame was captured
+        play_time, total_time = player_state
+        self.hash_index['current'] = (
+            int(total_time - play_time),
+            int(play_time),
+            self.hashes.group_idx
+        )
+
+        process_start = timeit.default_timer()
+        try:
+            # Filtered hashes are only created if needed
+            if hashes:
+                image, image_hash, process_time = hashes
+                process_start -= process_time
+                create_hashes = partial(
+                    self._create_filtered_hashes,
+                    image, self.hashes.hash_size
+                )
+            elif self.pool:
+                image_hash = self._create_hashes_in_process(
+                    frame_idx, image_data, size, 'image'
+                )[0]
+                create_hashes = partial(
+                    self._create_hashes_in_process,
+                    frame_idx, image_data, size, 'filtered'
+                )
+            else:
+                image = self._create_image(image_data, size)
+                image_hash = self._create_hash(image, self.hashes.hash_size)
+                create_hashes = partial(
+                    self._create_filtered_hashes,
+                    image, self.hashes.hash_size
+                )
+            timings = {'image': timeit.default_timer() - process_start}
 
             # Check if current hash matches with previous hash, typical end
             # credits hash, or other episode hashes
-            stats, hashes = self._evaluate_similarity(
-                image, filtered_image, self.hashes.hash_size
+            stats, filtered_hash, expanded_hash = self._evaluate_similarity(
+                image_hash, create_hashes, timings
             )
-            image_hash, filtered_hash, expanded_hash = hashes
-
-            if SETTINGS.detector_debug:
-                self.log('Match: {0[hits]}/{1}, Miss: {0[misses]}/{2}'.format(
-                    self.match_counts, self.match_number, self.mismatch_number
-                ))
-
-                self._print_hashes(
-                    [filtered_hash,
-                     expanded_hash,
-                     self.hashes.data.get(self.hash_index['credits_small']),
-                     self.hashes.data.get(self.hash_index['credits_large']),
-                     self.hashes.data.get(self.hash_index['credits_full'])],
-                    size=self.hashes.hash_size,
-                    prefix=(
-                        '{0:.1f}% similar to typical credits, '
-                        '{1:.1f}% similarity in detected credits'
-                    ).format(stats['credits'], stats['detected'])
-                )
+        except PoolTimeout:
+            self.log('Worker process timed out', utils.LOGWARNING)
+            self._queue_task_done(queue)
+            return None
 
-                self._print_hashes(
-                    [self.hashes.data.get(self.hash_index['previous']),
-                     image_hash,
-                     self.past_hashes.data.get(self.hash_index['episodes'])],
-                    size=self.hashes.hash_size,
-                    prefix=(
-                        '{0:.1f}% similar to previous hash, '
-                        '{1:.1f}% similar to other episodes'
-                    ).format(stats['previous'], stats['episodes'])
-                )
+        self._update_capture_interval(
+            stats, timeit.default_timer() - process_start
+        )
+
+        if SETTINGS.detector_debug:
+            self.log('Match: {0[hits]}/{1}, Miss: {0[misses]}/{2}, '
+                     'Interval: {3:.2f}s, Stages: {4}'.format(
+                         self.match_counts,
+                         self.match_number,
+                         self.mismatch_number,
+                         self.capture_interval,
+                         ', '.join(
+                             '{0} {1:.1f}ms'.format(
+                                 stage, 1000 * timings[stage]
+                             )
+                             for stage in _STAGES if stage in timings
+                         )
+                     ))
+
+            self._print_hashes(
+                [filtered_hash,
+                 expanded_hash,
+                 self.hashes.data.get(self.hash_index['credits_small']),
+                 self.hashes.data.get(self.hash_index['credits_large']),
+                 self.hashes.data.get(self.hash_index['credits_full'])],
+                size=self.hashes.hash_size,
+                prefix=(
+                    '{0:.1f}% similar to typical credits, '
+                    '{1:.1f}% similarity in detected credits'
+                ).format(stats['credits'], stats['detected'])
+            )
 
-            # Store current hash for comparison with next video frame
-            self.hashes.data[self.hash_index['current']] = image_hash
-            self.hash_index['previous'] = self.hash_index['current']
+            self._print_hashes(
+                [self.hashes.data.get(self.hash_index['previous']),
+                 image_hash,
+                 self.past_hashes.data.get(self.hash_index['episodes'])],
+                size=self.hashes.hash_size,
+                prefix=(
+                    '{0:.1f}% similar to previous hash, '
+                    '{1:.1f}% similar to other episodes'
+                ).format(stats['previous'], stats['episodes'])
+            )
 
-            # Store timestamps if credits are detected
-            self.update_timestamp(play_time)
+        # Store current hash for comparison with next video frame
+        self.hashes.add(self.hash_index['current'], image_hash)
+        self.hash_index['previous'] = self.hash_index['current']
 
-            self._queue_task_done(queue)
+        # Store timestamps if credits are detected
+        self.update_timestamp(play_time)
 
         self._queue_task_done(queue)
+        return timings
 
     def _worker_release(self):
         if not self.workers or not self.queue:
@@ -882,7 +1789,7 @@ class UpNextDetector(object):
 
     def reset(self):
         self._hash_match_reset()
-        self.hashes.timestamps[self.hashes.group_idx] = None
+        self.hashes.set_timestamp(self.hashes.group_idx, None)
         self.hash_index['detected_at'] = None
 
     def start(self, restart=False):
@@ -913,21 +1820,30 @@ class UpNextDetector(object):
                 xbmc.RenderCapture(),
                 self._get_video_capture_resolution(
                     max_size=SETTINGS.detector_data_limit
-                )
+                ),
+                None
             ])
+            self._pool_create(SETTINGS.detector_threads - 1)
             self.workers = [utils.run_threaded(self._queue_push,
                                                kwargs={'queue': queue})]
             self.workers += [
                 utils.run_threaded(self._worker,
-                                   delay=start_delay * self.capture_interval)
+                                   delay=start_delay * self.capture_interval,
+                                   kwargs={'frame_idx': start_delay})
                 for start_delay in range(SETTINGS.detector_threads - 1)
             ]
             self._running.set()
 
         queue.join()
         self._worker_release()
+        with self._lock:
+            self._pool_release()
 
         self.log('Stopped')
+        if SETTINGS.detector_debug:
+            self._log_stage_stats()
+        if SETTINGS.detector_debug_stats:
+            self._save_process_stats()
         self._running.clear()
         self._sigstop.clear()
         self._sigterm.clear()
@@ -946,6 +1862,7 @@ class UpNextDetector(object):
 
         # Free references/resources
         with self._lock:
+            self._pool_release()
             del self.workers
             self.workers = None
             del self.queue
@@ -966,15 +1883,29 @@ class UpNextDetector(object):
             return
 
         self.past_hashes.hash_size = self.hashes.hash_size
-        self.past_hashes.timestamps.update(self.hashes.timestamps)
         # If credit were detected only store the previous +/- 5s of hashes to
         # reduce false positives when comparing to other episodes
-        self.past_hashes.data.update(self.hashes.window(
+        hashes = self.hashes.window(
             self.hash_index['detected_at'], all_episodes=True
-        ) if self.match_counts['detected'] else self.hashes.data)
+        ) if self.match_counts['detected'] else self.hashes.data
+        self.past_hashes.update(
+            hashes=hashes, timestamps=self.hashes.timestamps
+        )
+        self.past_hashes.prune(
+            self.hashes.group_idx, SETTINGS.detector_episode_limit
+        )
 
+        # Only the hashes from this episode need to be saved
         if SETTINGS.detector_save_path:
-            self.past_hashes.save(self.hashes.group_name)
+            self.past_hashes.append(
+                self.hashes.group_name, hashes, self.hashes.timestamps
+            )
+            # Remove least recently used stored files in the background
+            if SETTINGS.detector_storage_limit:
+                utils.run_threaded(UpNextHashStore.evict, kwargs={
+                    'limit': SETTINGS.detector_storage_limit,
+                    'retain': self.hashes.group_name,
+                })
 
     def update_timestamp(self, play_time):
         # Timestamp already stored or credits not detected
@@ -984,6 +1915,50 @@ class UpNextDetector(object):
         with self._lock:
             self.log('Credits detected')
             self.hash_index['detected_at'] = self.hash_index['current']
-            self.hashes.timestamps[self.hashes.group_idx] = play_time
+            self.hashes.set_timestamp(self.hashes.group_idx, play_time)
             self.state.set_detected_popup_time(play_time)
             utils.event('upnext_credits_detected', internal=True)
+
+
+def _process_worker_init(frames):
+    """Initialises a detector worker process with the shared frame buffers
+       inherited from the parent process"""
+
+    _PROCESS_FRAMES[:] = frames
+
+
+def _process_worker(frame_idx, data_size, image_size, hash_size,  # pylint: disable=too-many-arguments
+                    stage=None, stored_size=None):
+    """Creates image hashes from captured image data in a shared frame buffer.
+       Only hash values are returned to the parent process. Image created for
+       the image stage replaces the captured image data in the frame buffer,
+       and its size is returned so that the filtered stage does not need to
+       create the image again"""
+
+    frame = memoryview(_PROCESS_FRAMES[frame_idx]).cast('B')
+    cls = UpNextDetector
+    if stage == 'image':
+        image = cls._create_image(frame[:data_size], image_size)  # pylint: disable=protected-access
+        hashes = (cls._create_hash(image, hash_size), )  # pylint: disable=protected-access
+        image_data = image.tobytes() if image.mode == 'L' else None
+        if image_data and len(image_data) <= len(frame):
+            frame[:len(image_data)] = image_data
+            stored_size = image.size
+        else:
+            stored_size = None
+    elif stage == 'filtered' and stored_size:
+        image = image_utils.import_data(
+            frame[:stored_size[0] * stored_size[1]], stored_size, mode='L'
+        )
+        hashes = cls._create_filtered_hashes(image, hash_size)  # pylint: disable=protected-access
+        stored_size = None
+    else:
+        hashes = cls._create_hashes(  # pylint: disable=protected-access
+            frame[:data_size], image_size, hash_size, stage
+        )
+        stored_size = None
+
+    return tuple(
+        None if image_hash is None else image_hash.value
+        for image_hash in hashes
+    ), stored_size
@@ -77,6 +77,18 @@ def make_legal_path(path):
     return ''
 
 
+def replace_file(source, target):
+    """Rename source file to target file, replacing target file if it exists"""
+
+    try:
+        os.replace(source, target)
+    except AttributeError:
+        # Python 2 os.rename does not replace an existing file on Windows
+        if os.name == 'nt' and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
+
+
 def sanitise(string):
     """Replace characters in a string, that are not valid for a Windows path,
        with an underscore"""
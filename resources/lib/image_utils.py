@@ -4,12 +4,47 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+from collections import deque
+from threading import Lock
+from timeit import default_timer as _timer
 from PIL import Image, ImageChops, ImageDraw, ImageFilter
 from settings import SETTINGS
 
-_PRECOMPUTED = {
-    '_STACK': [],
-}
+# NumPy is optional. If available it is used to vectorise the parts of the
+# image processing pipeline that would otherwise be run as Python loops. PIL is
+# still used for operations that are already implemented in C e.g. applying a
+# single LUT to a whole image, as they are as fast or faster than NumPy.
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
+
+# Cache of precomputed LUTs, masks, boxes and filters, keyed by method and
+# image size. Elements are not modified once added, and can be shared between
+# threads concurrently running process()
+_PRECOMPUTED = {}
+_PRECOMPUTED_LOCK = Lock()
+
+# Statistics for each step run by process(), keyed by step name. Only recorded
+# if enabled, as timing each step adds overhead to every call of process()
+_PROCESS_STATS = {}
+_PROCESS_STATS_LOCK = Lock()
+# Number of recent calls of each step used for wall time histograms
+_PROCESS_STATS_WINDOW = 256
+# Upper bounds of wall time histogram bins in ms, with a final overflow bin
+_PROCESS_STATS_BINS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# CPU time of the calling thread if available, otherwise of the process
+try:
+    from time import thread_time as _cpu_timer
+except ImportError:
+    try:
+        from time import process_time as _cpu_timer
+    except ImportError:
+        from time import clock as _cpu_timer
+
+# Translation table used to convert binary pixel values to a string of bits
+_BITS_TABLE = bytes(bytearray([48, 49] + list(range(2, 256))))
 
 
 try:
@@ -20,6 +55,122 @@ except NameError:
     _SPLIT = str.split
 
 
+class _ProcessContext(object):  # pylint: disable=too-few-public-methods
+    """Intermediate state of a single invocation of process(), kept separate
+       from other concurrent invocations"""
+
+    __slots__ = ('inputs', 'stack', )
+
+    def __init__(self, inputs=()):
+        self.inputs = inputs
+        self.stack = []
+
+
+class _ProcessPlan(object):  # pylint: disable=too-few-public-methods
+    """Queue of process() steps compiled into a reusable plan. Methods,
+       arguments, debug output filenames and stats names are resolved once
+       when compiled, leaving only image stack and input fetchers to be
+       resolved each time the plan is run"""
+
+    __slots__ = ('steps', )
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    def __call__(self, data, *inputs):  # pylint: disable=too-many-locals
+        _isinstance = isinstance
+        _list = list
+        _save = Image.Image.save
+
+        context = _ProcessContext((data, ) + inputs)
+        _append = context.stack.append
+        output = None
+
+        for method, args, fetchers, save_file, stats_name in self.steps:
+            if fetchers:
+                args = _list(args)
+                for idx in fetchers:
+                    args[idx] = args[idx](context)
+
+            if stats_name:
+                wall_start = _timer()
+                cpu_start = _cpu_timer()
+                output = method(data, *args)
+                _record_step(stats_name,
+                             _timer() - wall_start,
+                             _cpu_timer() - cpu_start,
+                             output)
+            else:
+                output = method(data, *args)
+            _append(output)
+
+            if _isinstance(output, Image.Image):
+                data = output
+            elif output:
+                data = output
+                continue
+            else:
+                continue
+
+            if not save_file:
+                continue
+
+            try:
+                _save(data, _FORMAT(
+                    '{0}{1}.bmp', SETTINGS.detector_save_path, save_file
+                ))
+            except (IOError, OSError):
+                pass
+
+        return output
+
+
+class _StepStats(object):
+    """Running totals of wall time, CPU time and output size of a process()
+       step, along with wall times of the most recent calls"""
+
+    __slots__ = ('count', 'cpu_time', 'output_size', 'recent', 'wall_time')
+
+    def __init__(self):
+        self.count = 0
+        self.cpu_time = 0
+        self.output_size = 0
+        self.recent = deque(maxlen=_PROCESS_STATS_WINDOW)
+        self.wall_time = 0
+
+    def add(self, wall_time, cpu_time, output_size):
+        self.count += 1
+        self.cpu_time += cpu_time
+        self.output_size += output_size
+        self.recent.append(wall_time)
+        self.wall_time += wall_time
+
+    def summary(self):
+        recent = sorted(self.recent)
+        histogram = [0] * (len(_PROCESS_STATS_BINS) + 1)
+        for wall_time in recent:
+            histogram[next((
+                idx for idx, limit in enumerate(_PROCESS_STATS_BINS)
+                if 1000 * wall_time <= limit
+            ), -1)] += 1
+
+        return {
+            'count': self.count,
+            # Mean times in ms and mean output size in bytes
+            'wall_time': 1000 * self.wall_time / self.count,
+            'cpu_time': 1000 * self.cpu_time / self.count,
+            'output_size': self.output_size // self.count,
+            # Total wall time in ms
+            'total_time': 1000 * self.wall_time,
+            'p50': 1000 * recent[len(recent) // 2],
+            'p90': 1000 * recent[9 * len(recent) // 10],
+            'histogram': [
+                list(histogram_bin) for histogram_bin
+                in zip(_PROCESS_STATS_BINS + (None, ), histogram)
+            ],
+        }
+
+
 def _bit_depth_lut(bit_depth, scale=None, _int=int):
     num_levels = 2 ** bit_depth
     bit_mask = ~((2 ** (8 - bit_depth)) - 1)
@@ -80,6 +231,65 @@ def _border_mask(size, border_colour, fill_colour, *box):
     return element
 
 
+def _condition_lut(inclusions, exclusions):
+    """Lookup table of conditional_filter() rules, indexed by filtered value
+       multiplied by 256 plus pixel value, that is 255 where a pixel is kept
+       and 0 otherwise. Rules are evaluated once for every possible pair of
+       values, in the same way as they would be for each pixel"""
+
+    inclusions = _tuple_of_tuples(inclusions)
+    exclusions = _tuple_of_tuples(exclusions)
+    key = ('CONDITION_LUT', inclusions, exclusions)
+    lut = _PRECOMPUTED.get(key)
+    if lut is not None:
+        return lut
+
+    def _matches(rules, pixel, aggregate):
+        for local_min, local_max, percent_lo, percent_hi in rules:
+            if not local_max >= aggregate > local_min:
+                continue
+            if not aggregate or percent_hi >= pixel / aggregate > percent_lo:
+                return True
+        return False
+
+    lut = bytes(bytearray(
+        255 if (_matches(inclusions, pixel, aggregate)
+                and not _matches(exclusions, pixel, aggregate)) else 0
+        for aggregate in range(256)
+        for pixel in range(256)
+    ))
+
+    with _PRECOMPUTED_LOCK:
+        return _PRECOMPUTED.setdefault(key, lut)
+
+
+def _condition_mask(image, aggregate_image, inclusions, exclusions):
+    """Mask of pixels kept by conditional_filter() rules"""
+
+    lut = _condition_lut(inclusions, exclusions)
+
+    if _np:
+        lut = _np.frombuffer(lut, dtype=_np.uint8).reshape(256, 256)
+        return Image.fromarray(
+            lut[_np.asarray(aggregate_image), _np.asarray(image)]
+        )
+
+    return Image.frombytes('L', image.size, bytes(bytearray(
+        lut[(aggregate << 8) | pixel]
+        for pixel, aggregate in zip(image.getdata(), aggregate_image.getdata())
+    )))
+
+
+def _export_bits_batch(data, _int=int):
+    """Batch equivalent of export_bits for a stacked array of images"""
+
+    lut = _np.array(_precompute('BIT_DEPTH_LUT,1,0.0078125'), dtype=_np.uint8)
+    return [
+        _int(bits.tobytes().translate(_BITS_TABLE), 2)
+        for bits in lut.take(data.reshape(data.shape[0], -1))
+    ]
+
+
 def _fade_mask(size, level_start, level_stop, steps, power, box,  # pylint: disable=too-many-arguments, too-many-locals
                _format=_FORMAT, _int=int, _max=max,
                _paste=Image.Image.paste):
@@ -131,6 +341,197 @@ def _fade_mask(size, level_start, level_stop, steps, power, box,  # pylint: disa
     return element
 
 
+def _auto_level_luts(histograms, min_value=0, max_value=100,
+                     clip=(0, None)):
+    """Vectorised equivalent of auto_level that returns a LUT for each row of a
+       2D array of image histograms, rather than a levelled image"""
+
+    levels = histograms > 0
+    if max_value - min_value == 100:
+        min_values = levels.argmax(axis=1)
+        max_values = 255 - levels[:, ::-1].argmax(axis=1)
+
+    else:
+        cum_levels = levels.cumsum(axis=1)
+        percentage = cum_levels[:, -1] / 100
+
+        max_values = _np.maximum(max_value, min_value + (1 / percentage))
+        max_values = (max_values * percentage).astype(int) - 1
+        max_values = (cum_levels > max_values[:, None]).argmax(axis=1)
+
+        min_values = (min_value * percentage).astype(int)
+        min_values = (cum_levels > min_values[:, None]).argmax(axis=1)
+
+    indices = _np.arange(256)
+    unchanged = min_values >= max_values
+
+    if clip[0] < 1:
+        offset = 0
+        if clip[1] == 0:
+            scale = max_values
+        elif clip[1] == 1:
+            scale = 255 - min_values
+            offset = min_values
+        else:
+            scale = 255
+
+        # Ignore invalid LUTs of unchanged images, they are replaced below
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            scale = 1 / _np.maximum(clip[0], (max_values - min_values) / scale)
+            offset = scale * (min_values - offset)
+
+            luts = (scale[:, None] * indices - offset[:, None]).astype(int)
+        luts = luts.clip(0, 255)
+
+    else:
+        luts = indices.clip(min_values[:, None], max_values[:, None])
+
+    luts[unchanged] = indices
+    return luts.astype(_np.uint8)
+
+
+def _adaptive_cover(length, segment_length, border, segments):
+    """Returns, for each pixel along one axis, the index of and offset into
+       each of the overlapping segments that cover it, in increasing segment
+       order. Pixels covered by fewer segments are marked as invalid"""
+
+    tile_length = segment_length + 2 * border
+    positions = _np.arange(length) + border
+    first = _np.maximum(0, -((tile_length - 1 - positions) // segment_length))
+    last = _np.minimum(segments - 1, positions // segment_length)
+
+    cover = []
+    for step in range(int((last - first).max()) + 1):
+        indices = first + step
+        valid = indices <= last
+        offsets = (positions - indices * segment_length).clip(0, tile_length - 1)
+        cover.append((indices.clip(0, segments - 1), offsets, valid))
+    return cover
+
+
+def _adaptive_geometry(size, segments, border, mask):  # pylint: disable=too-many-locals
+    """Precomputed indexes and masks used by _adaptive_auto_level for an image
+       size, number of segments, segment border, and segment mask. Stored with
+       other precomputed elements for reuse with each new image"""
+
+    key = ('ADAPTIVE_GEOMETRY', size, segments, border, mask is not None)
+    geometry = _PRECOMPUTED.get(key)
+    if geometry is not None:
+        return geometry
+
+    width, height = size
+    left_border, top_border = border
+    segment_width = width // segments
+    segment_height = height // segments
+    tile_width = segment_width + 2 * left_border
+    tile_height = segment_height + 2 * top_border
+
+    # Grid of cells formed by the edges of all segments, in padded image
+    # coordinates, the index of the cell that each image pixel is in, and the
+    # indexes of the first and last edges of each segment
+    num_cells = []
+    cell_index = []
+    cuts = []
+    for length, segment_length, tile_length, pad in (
+            (height, segment_height, tile_height, top_border),
+            (width, segment_width, tile_width, left_border)):
+        starts = _np.arange(segments) * segment_length
+        edges = _np.unique(_np.concatenate((
+            starts, starts + tile_length, [0, length + 2 * pad]
+        )))
+        num_cells.append(len(edges) - 1)
+        cell_index.append(
+            _np.searchsorted(edges, _np.arange(length) + pad, side='right') - 1
+        )
+        cuts.append((
+            _np.searchsorted(edges, starts),
+            _np.searchsorted(edges, starts + tile_length),
+        ))
+    cell_index = 256 * (num_cells[1] * cell_index[0][:, None] + cell_index[1])
+
+    # Index into LUTs, and blending mask, of each overlapping segment that
+    # covers each pixel, in the order that segments are pasted
+    mask = (
+        _np.asarray(mask, dtype=_np.uint8) if mask is not None
+        else _np.full((tile_height, tile_width), 255, dtype=_np.uint8)
+    )
+    passes = []
+    for rows, row_offsets, valid_rows in _adaptive_cover(
+            height, segment_height, top_border, segments):
+        row_mask = mask.take(row_offsets, axis=0)
+        for columns, column_offsets, valid_columns in _adaptive_cover(
+                width, segment_width, left_border, segments):
+            tile_mask = row_mask.take(column_offsets, axis=1)
+            tile_mask *= valid_rows[:, None] & valid_columns
+            passes.append((
+                (256 * (segments * rows[:, None] + columns))
+                .astype(_np.uint16),
+                tile_mask,
+            ))
+
+    geometry = (
+        cell_index.astype(_np.int32),
+        tuple(num_cells),
+        cuts,
+        tile_width * tile_height,
+        tuple(passes),
+    )
+    with _PRECOMPUTED_LOCK:
+        return _PRECOMPUTED.setdefault(key, geometry)
+
+
+def _adaptive_auto_level(image, segments, border, mask, args):  # pylint: disable=too-many-locals
+    """Vectorised equivalent of adaptive_filter with auto_level as the method.
+       Histograms of every overlapping segment are calculated in one pass
+       using an integral histogram. Rather than levelling and pasting each
+       segment in turn, every pixel is blended with each overlapping levelled
+       segment that covers it, in the same order and with the same rounding
+       as the sequence of masked pastes done by adaptive_filter"""
+
+    data = _np.asarray(image)
+    geometry = _adaptive_geometry(image.size, segments, border, mask)
+    cell_index, num_cells, cuts, tile_area, passes = geometry
+    (top, bottom), (left, right) = cuts
+    top = top[:, None]
+    bottom = bottom[:, None]
+
+    # Histogram of each cell of the grid formed by all segment edges, summed
+    # into an integral histogram from which segment histograms are taken
+    integral = _np.zeros(
+        (num_cells[0] + 1, num_cells[1] + 1, 256), dtype=_np.int64
+    )
+    integral[1:, 1:] = _np.bincount(
+        (cell_index + data).ravel(),
+        minlength=256 * num_cells[0] * num_cells[1]
+    ).reshape((num_cells[0], num_cells[1], 256))
+    integral = integral.cumsum(axis=0).cumsum(axis=1)
+
+    histograms = (
+        integral[bottom, right]
+        - integral[top, right]
+        - integral[bottom, left]
+        + integral[top, left]
+    ).reshape(segments * segments, 256)
+    # Parts of segments outside of the image area are black
+    histograms[:, 0] += tile_area - histograms.sum(axis=1)
+
+    luts = _auto_level_luts(histograms, *args).astype(_np.uint16).ravel()
+
+    # Same rounding as alpha blending used by PIL when pasting a mask. Values
+    # are limited to 255 * 255 + 255 so fit in 16 bits
+    output = data.astype(_np.uint16)
+    for tile_index, tile_mask in passes:
+        tile = luts.take(tile_index + data)
+        tile *= tile_mask
+        output *= 255 - tile_mask
+        output += tile
+        output += 128
+        output += output >> 8
+        output >>= 8
+
+    return Image.fromarray(output.astype(_np.uint8))
+
+
 def _histogram_rank(input_data, percentile, skip_levels=0):
     if isinstance(input_data, Image.Image):
         total = input_data.size[0] * input_data.size[1]
@@ -157,13 +558,46 @@ def _histogram_rank(input_data, percentile, skip_levels=0):
     return target
 
 
+def _histogram_ranks(histograms, percentile, skip_levels=0):
+    """Vectorised equivalent of _histogram_rank for each row of a 2D array of
+       image histograms"""
+
+    histograms = histograms[:, skip_levels:]
+    targets = (histograms.sum(axis=1) * (percentile / 100)).astype(int)
+    exceeded = histograms.cumsum(axis=1) > targets[:, None]
+
+    ranks = exceeded.argmax(axis=1) + skip_levels
+    ranks[~exceeded.any(axis=1)] = 255
+    return ranks
+
+
+def _histograms(data):
+    """Histogram of each image in a stacked array of images"""
+
+    num_images = data.shape[0]
+    data = data.reshape(num_images, -1) + _np.arange(
+        0, 256 * num_images, 256, dtype=_np.int32
+    )[:, None]
+    return _np.bincount(
+        data.ravel(), minlength=256 * num_images
+    ).reshape(num_images, 256)
+
+
+def _points_of_interest_batch(data, percentile=50, skip_levels=0):
+    """Batch equivalent of points_of_interest for a stacked array of images"""
+
+    targets = _histogram_ranks(_histograms(data), 50)
+    data = _np.abs(data.astype(_np.int16) - targets[:, None, None])
+    targets = _histogram_ranks(_histograms(data), percentile, skip_levels)
+    return ((data > targets[:, None, None]) * 255).astype(_np.uint8)
+
+
 def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):
-    element = _PRECOMPUTED.get(method)
-    try:
-        if element and size == getattr(element, 'size', element.get('size')):
-            return element
-    except AttributeError:
-        pass
+    key = (method, size)
+    # Elements are never replaced once added, so are read without the lock
+    element = _PRECOMPUTED.get(key)
+    if element is not None:
+        return element
 
     element, _, args = method.partition(',')
     args = _to_numbers(args)
@@ -207,8 +641,10 @@ def _precompute(method, size=None, debug=SETTINGS.detector_debug_save):
             SETTINGS.detector_save_path, method
         ))
 
-    _PRECOMPUTED[method] = element
-    return element
+    # Lock is not held while the element is created, as creation can recurse.
+    # If another thread has already created the same element then use that.
+    with _PRECOMPUTED_LOCK:
+        return _PRECOMPUTED.setdefault(key, element)
 
 
 def _process_args(args, image, sentinel='~',
@@ -241,6 +677,28 @@ def _precision(number, decimal_places=3):
     return int(number * factor) / factor
 
 
+def _record_step(name, wall_time, cpu_time, output):
+    """Add timing and output size of a single process() step to statistics
+       for the step name"""
+
+    outputs = output if isinstance(output, (list, tuple)) else (output, )
+    output_size = 0
+    for item in outputs:
+        if isinstance(item, Image.Image):
+            output_size += (
+                item.width * item.height * len(item.getbands())
+                * (4 if item.mode in ('F', 'I') else 1)
+            )
+        elif _np and isinstance(item, _np.ndarray):
+            output_size += item.nbytes
+
+    with _PROCESS_STATS_LOCK:
+        step_stats = _PROCESS_STATS.get(name)
+        if not step_stats:
+            step_stats = _PROCESS_STATS.setdefault(name, _StepStats())
+        step_stats.add(wall_time, cpu_time, output_size)
+
+
 def _to_numbers(args, _int=int, _float=float, _split=_SPLIT):
     if not args:
         return []
@@ -252,6 +710,10 @@ def _to_numbers(args, _int=int, _float=float, _split=_SPLIT):
     ]
 
 
+def _tuple_of_tuples(items):
+    return tuple(tuple(item) for item in items)
+
+
 def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint: disable=too-many-locals
                     _crop=Image.Image.crop, _copy=Image.Image.copy,
                     _format=_FORMAT, _int=int, _paste=Image.Image.paste,
@@ -281,6 +743,15 @@ def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint:
         (segment_width + 2 * left_border, segment_height + 2 * top_border)
     ) if mask else None
 
+    if (_np and method is auto_level
+            and not (save_file and SETTINGS.detector_debug_save)):
+        output = _adaptive_auto_level(
+            cropped_image, segments, (left_border, top_border), mask, args
+        )
+        image = _copy(image)
+        _paste(image, output, box=crop_box)
+        return image
+
     for vertical_idx in _range(segments):
         for horizontal_idx in _range(segments):
             horizontal_position = horizontal_idx * segment_width
@@ -302,6 +773,8 @@ def adaptive_filter(image, sampling, method, args=(), save_file=None,  # pylint:
                     vertical_idx, horizontal_idx
                 ))
 
+    # Paste into copy of image, input image is not modified
+    image = _copy(image)
     _paste(image, output, box=crop_box)
     return image
 
@@ -348,9 +821,39 @@ def auto_level(image, min_value=0, max_value=100, clip=(0, None), _int=int):
     ])
 
 
+def _auto_threshold_target(histogram, sum_total):
+    """Vectorised equivalent of the Otsu threshold calculation in
+       auto_threshold"""
+
+    delta = _np.array(histogram) / sum_total
+    delta_integral = delta * _np.arange(256)
+
+    cum_sum = delta.cumsum()[:-1]
+    cum_sum_reversed = delta[::-1].cumsum()[::-1][1:]
+    cum_integral = delta_integral.cumsum()[:-1]
+    cum_integral_reversed = delta_integral[::-1].cumsum()[::-1][1:]
+
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        variance = cum_sum * cum_sum_reversed * (
+            (cum_integral / cum_sum)
+            - (cum_integral_reversed / cum_sum_reversed)
+        ) ** 2
+    variance[
+        (cum_sum == 0) | (cum_sum_reversed == 0)
+        | (cum_integral == 0) | (cum_integral_reversed == 0)
+    ] = 0
+
+    return 254 - int(variance[::-1].argmax())
+
+
 def auto_threshold(image):  # pylint: disable=too-many-locals
     histogram = image.histogram()
 
+    if _np:
+        target = _auto_threshold_target(histogram, image.size[0] * image.size[1])
+        target = target + 1
+        return image.point([255 if (i > target) else 0 for i in range(256)])
+
     cum_sum = [0] * 256
     cum_sum_reversed = [0] * 256
     cum_integral = [0] * 256
@@ -441,118 +944,104 @@ def apply_filter(image, method, extent=None, original=None, output_op=None):
     return image
 
 
-def conditional_filter(image, rules=((), ()), output=None,  # pylint: disable=too-many-locals
+def compile_queue(queue, save_file=None,
+                  debug=SETTINGS.detector_debug_save,
+                  stats=SETTINGS.detector_debug_stats,
+                  _callable=callable, _float=float, _format=_FORMAT, _int=int,
+                  _isinstance=isinstance, _list=list, _str=str, _tuple=tuple):
+    """Compiles a queue of [method, *args] steps into a plan that can be run
+       with the same result as process(), by calling plan(data, *inputs).
+       Queue is not modified. Arguments must not change between runs other
+       than through image_stack() and image_input() fetchers"""
+
+    debug = debug and save_file
+    prefix = _format('{0}.', save_file) if stats and save_file else ''
+    steps = []
+
+    for step, args in enumerate(queue):
+        method = args[0]
+        args = _list(args[1:])
+        step_file = None
+
+        if debug:
+            step_file = _format('{0}_{1}_{2}', debug, step, method.__name__)
+            if args:
+                step_file = _format('{1}{0}', [
+                    arg if _isinstance(
+                        arg, (_int, _float, _list, _str, _tuple)
+                    )
+                    else arg.__name__ if _callable(arg)
+                    else type(arg).__name__
+                    for arg in args
+                    if arg != 'DEBUG'
+                ], step_file)
+
+                args = [
+                    step_file if arg == 'DEBUG' else arg for arg in args
+                ]
+
+        fetchers = _tuple(
+            idx for idx, arg in enumerate(args)
+            if _callable(arg) and arg.__name__ in _FETCHERS
+        )
+
+        steps.append((
+            method,
+            _tuple(args),
+            fetchers,
+            step_file,
+            stats and _format('{0}{1}', prefix, method.__name__),
+        ))
+
+    return _ProcessPlan(_tuple(steps))
+
+
+def conditional_filter(image, rules=((), ()), output=None,
                        filter_args=(None, ), save_file=None,
-                       _draw=ImageDraw.Draw, _format=_FORMAT,
-                       _new=Image.new, _point=ImageDraw.ImageDraw.point,
-                       _save=Image.Image.save, _tuple=tuple):
+                       _composite=Image.composite, _format=_FORMAT,
+                       _new=Image.new, _save=Image.Image.save):
+    """Keep pixels where the pixel value and the value of the same pixel in
+       the filtered image satisfy any of the inclusion rules and none of the
+       exclusion rules. Each rule is (local_min, local_max, percent_lo,
+       percent_hi), and is satisfied if local_max >= filtered > local_min and
+       percent_hi >= pixel / filtered > percent_lo.
+       Kept pixels are set to the pixel value for THRESHOLD output, to the
+       filtered value for FILTER output, or to 255 for MASK output. Other
+       pixels are unchanged for FILTER output, otherwise set to 0"""
+
     aggregate_image = apply_filter(image, *filter_args)
-    data = enumerate(zip(image.getdata(), aggregate_image.getdata()))
-    inclusions = enumerate(rules[0])
-    exclusions = enumerate(rules[1])
-    width = image.size[0]
 
     if save_file and SETTINGS.detector_debug_save:
-        data = _tuple(data)
-        inclusions = _tuple(inclusions)
-        exclusions = _tuple(exclusions)
-        rules = inclusions + exclusions
-
         aggregate_image.save(_format(
             '{0}{1}[{2}].bmp',
             SETTINGS.detector_save_path, save_file,
             filter_args[0]
         ))
 
-        for idx, (local_min, local_max, percent_lo, percent_hi) in rules:
-            debug_output = _new('L', image.size, 0)
-            draw_canvas = _draw(debug_output)
-            _point(draw_canvas, [
-                (idx % width, idx // width)
-                for idx, (pixel, aggregate) in data
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
+        for rule in tuple(rules[0]) + tuple(rules[1]):
+            _save(
+                _condition_mask(image, aggregate_image, (rule, ), ()),
+                _format(
+                    '{0}{1}[{2}][{3}].bmp',
+                    SETTINGS.detector_save_path, save_file,
+                    filter_args[0],
+                    rule
                 )
-            ], fill=255)
-            _save(debug_output, _format(
-                '{0}{1}[{2}][{3}].bmp',
-                SETTINGS.detector_save_path, save_file,
-                filter_args[0],
-                rules[idx]
-            ))
+            )
 
-    if output != 'FILTER':
-        image = _new('L', image.size, 0)
+    mask = _condition_mask(image, aggregate_image, rules[0], rules[1])
 
     if output == 'THRESHOLD':
-        draw_canvas = _draw(image)
-        _ = [[
-            _point(draw_canvas, (idx % width, idx // width), fill=pixel)
-            for idx, (pixel, aggregate) in data
-            if (local_max >= aggregate > local_min)
-            and (
-                not aggregate
-                or percent_hi >= pixel / aggregate > percent_lo
-            )
-            and not [
-                1 for _, (local_min, local_max, percent_lo, percent_hi)
-                in exclusions
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-            ]
-        ] for _, (local_min, local_max, percent_lo, percent_hi) in inclusions]
-
-    elif output[:6] == 'FILTER':
-        draw_canvas = _draw(image)
-        _ = [[
-            _point(draw_canvas, (idx % width, idx // width), fill=aggregate)
-            for idx, (pixel, aggregate) in data
-            if (local_max >= aggregate > local_min)
-            and (
-                not aggregate
-                or percent_hi >= pixel / aggregate > percent_lo
-            )
-            and not [
-                1 for _, (local_min, local_max, percent_lo, percent_hi)
-                in exclusions
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-            ]
-        ] for _, (local_min, local_max, percent_lo, percent_hi) in inclusions]
-
-    else:  # if output == 'MASK':
-        draw_canvas = _draw(image)
-        _ = [
-            _point(draw_canvas, [
-                (idx % width, idx // width)
-                for idx, (pixel, aggregate) in data
-                if (local_max >= aggregate > local_min)
-                and (
-                    not aggregate
-                    or percent_hi >= pixel / aggregate > percent_lo
-                )
-                and not [
-                    1 for _, (local_min, local_max, percent_lo, percent_hi)
-                    in exclusions
-                    if (local_max >= aggregate > local_min)
-                    and (
-                        not aggregate
-                        or percent_hi >= pixel / aggregate > percent_lo
-                    )
-                ]
-            ], fill=255)
-            for _, (local_min, local_max, percent_lo, percent_hi) in inclusions
-        ]
+        return _composite(image, _new('L', image.size, 0), mask)
 
-    return image
+    if output == 'FILTER':
+        return _composite(aggregate_image, image, mask)
+
+    if output and output[:6] == 'FILTER':
+        return _composite(aggregate_image, _new('L', image.size, 0), mask)
+
+    # if output == 'MASK':
+    return mask
 
 
 def detail_reduce(image, base_image, reduction=25,
@@ -575,10 +1064,10 @@ def detail_reduce(image, base_image, reduction=25,
     return image
 
 
-def export_data(image):
+def export_bits(image, _int=int):
     lut = _precompute('BIT_DEPTH_LUT,1,0.0078125')
 
-    return tuple(image.point(lut).getdata())
+    return _int(image.point(lut).tobytes().translate(_BITS_TABLE), 2)
 
 
 def entropy_compare(image, filtered_image, threshold=1.10, save_file=None):
@@ -609,13 +1098,23 @@ def entropy_compare(image, filtered_image, threshold=1.10, save_file=None):
     return False, None
 
 
+def image_input(index=0):
+    """Fetch data that process() or a compiled plan was run with. Index 0 is
+       the data processed by the first step, and later indexes are any
+       additional inputs the plan was run with"""
+
+    def _image_input_fetch(context):
+        return context.inputs[index]
+    return _image_input_fetch
+
+
 def image_stack(index):
-    def _image_stack_fetch():
-        return _PRECOMPUTED['_STACK'][index]
+    def _image_stack_fetch(context):
+        return context.stack[index]
     return _image_stack_fetch
 
 
-def import_data(input_data, buffer_size=None, to_rgba=False):
+def import_data(input_data, buffer_size=None, to_rgba=False, mode='RGBA'):
     if isinstance(input_data, Image.Image):
         return input_data
 
@@ -625,7 +1124,7 @@ def import_data(input_data, buffer_size=None, to_rgba=False):
         input_data[0::4], input_data[2::4] = input_data[2::4], input_data[0::4]
 
     image = Image.frombuffer(
-        'RGBA', buffer_size, input_data, 'raw', 'RGBA', 0, 1
+        mode, buffer_size, input_data, 'raw', mode, 0, 1
     )
 
     return image
@@ -668,6 +1167,15 @@ def output_histogram(input_data, scale_to_max=False, save_file=None):
 def points_of_interest(image, percentile=50, skip_levels=0, _abs=abs):
     # Transform image to show absolute deviation from median pixel luma
     target = _histogram_rank(image, 50)
+
+    if _np:
+        data = _np.abs(_np.asarray(image, dtype=_np.int16) - target)
+        target = _histogram_rank(
+            _np.bincount(data.ravel(), minlength=256).tolist(),
+            percentile, skip_levels
+        )
+        return Image.fromarray(((data > target) * 255).astype(_np.uint8))
+
     image = image.point([_abs(i - target) for i in range(256)])
 
     # Calculate percentile of absolute deviation from the median to represent
@@ -686,63 +1194,73 @@ def posterise(image, bit_depth):
 
 
 def process(data, queue, save_file=None, debug=SETTINGS.detector_debug_save,
-            _append=list.append, _callable=callable, _copy=Image.Image.copy,
-            _enumerate=enumerate, _float=float, _format=_FORMAT, _int=int,
-            _isinstance=isinstance, _list=list, _pop=list.pop, _str=str,
-            _save=Image.Image.save, _tuple=tuple):
-    _PRECOMPUTED['_STACK'] = []
-    if _isinstance(data, Image.Image):
-        data = data.copy()
-    debug = debug and save_file
+            stats=SETTINGS.detector_debug_stats):
+    """Runs each step in the queue, with the output of the previous step as
+       input. Steps must return a new image rather than modifying their input
+       image, so that input data and intermediate images on the image stack
+       can be passed between steps without being copied.
+       If stats is enabled, time taken and output size of each step is
+       recorded, by step name prefixed with save_file if provided.
+       Queues that are run repeatedly should be compiled once with
+       compile_queue() and the returned plan run instead"""
+
+    return compile_queue(queue, save_file, debug, stats)(data)
+
+
+def process_batch(data, queue, stats=SETTINGS.detector_debug_stats):
+    """Runs the same queue of steps as process() for each of a batch of
+       images. Steps with a batch equivalent are run once on a stacked array
+       of the whole batch, other steps are run on each image in turn. Image
+       stack and debug output are not supported. If stats is enabled, time
+       taken by each step for the whole batch is recorded"""
+
+    if not _np:
+        return [
+            process(image, queue=[list(step) for step in queue], stats=stats)
+            for image in data
+        ]
 
-    for step, args in _enumerate(queue):
-        method = _pop(args, 0)
+    for method, args in ((step[0], step[1:]) for step in queue):
+        if stats:
+            wall_start = _timer()
+            cpu_start = _cpu_timer()
 
-        args_enum = _enumerate(args)
-        if debug:
-            args_enum = _tuple(args_enum)
-            save_file = _format('{0}_{1}_{2}', debug, step, method.__name__)
-            if args:
-                save_file = _format('{1}{0}', [
-                    arg if _isinstance(
-                        arg, (_int, _float, _list, _str, _tuple)
-                    )
-                    else arg.__name__ if _callable(arg)
-                    else type(arg).__name__
-                    for _, arg in args_enum
-                    if arg != 'DEBUG'
-                ], save_file)
-
-                for idx in [idx for idx, arg in args_enum if arg == 'DEBUG']:
-                    args[idx] = save_file
+        batch_method = _BATCH_METHODS.get(method)
+        if batch_method:
+            if not isinstance(data, _np.ndarray):
+                data = _np.stack([_np.asarray(image) for image in data])
+            data = batch_method(data, *args)
+        else:
+            if isinstance(data, _np.ndarray):
+                data = [Image.fromarray(image) for image in data]
+            data = [method(image, *args) for image in data]
 
-        for idx in [idx for idx, arg in args_enum  # pylint: disable=undefined-loop-variable
-                    if _callable(arg)
-                    and arg.__name__ == '_image_stack_fetch']:
-            args[idx] = args[idx]()
+        if stats:
+            _record_step('batch.' + method.__name__,
+                         _timer() - wall_start,
+                         _cpu_timer() - cpu_start,
+                         data)
 
-        output = method(data, *args)
-        _append(_PRECOMPUTED['_STACK'], output)
+    if isinstance(data, _np.ndarray):
+        return [Image.fromarray(image) for image in data]
+    return data
 
-        if _isinstance(output, Image.Image):
-            data = _copy(output)
-        elif output:
-            data = output
-            continue
-        else:
-            continue
 
-        if not debug:
-            continue
+def get_process_stats(reset=False):
+    """Summary of statistics recorded for each step run by process(), with
+       mean and percentile wall times in ms, mean CPU time in ms, mean output
+       size in bytes, and a histogram of recent wall times as a list of
+       [upper bound in ms, count] bins"""
 
-        try:
-            _save(data, _format(
-                '{0}{1}.bmp', SETTINGS.detector_save_path, save_file
-            ))
-        except (IOError, OSError):
-            pass
+    with _PROCESS_STATS_LOCK:
+        summary = {
+            name: step_stats.summary()
+            for name, step_stats in _PROCESS_STATS.items()
+        }
+        if reset:
+            _PROCESS_STATS.clear()
 
-    return output
+    return summary
 
 
 def replace_with_copy(image, replacement_image=None):
@@ -759,6 +1277,12 @@ def resize(image, size, method=None):
 
 
 def saturation(image):
+    if _np:
+        data = _np.asarray(image)
+        output = _np.maximum(data[:, :, 0], data[:, :, 1])
+        _np.maximum(output, data[:, :, 2], out=output)
+        return Image.fromarray(output)
+
     return image.convert('HSV').getchannel(2)
 
 
@@ -770,3 +1294,14 @@ def trim_to_bounding_box(image):
     image = image.crop(box)
 
     return image
+
+
+# Names of functions returned by image_input() and image_stack(), resolved
+# each time a compiled plan is run
+_FETCHERS = (image_input(0).__name__, image_stack(0).__name__)
+
+# Batch equivalents of process() steps, used by process_batch()
+_BATCH_METHODS = {
+    export_bits: _export_bits_batch,
+    points_of_interest: _points_of_interest_batch,
+}
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+"""Implements a persistent index of next-up episodes and movies, maintained by
+   the service and used by the plugin to populate widgets"""
+
+from __future__ import absolute_import, division, unicode_literals
+
+import copy
+import io
+import json
+import os
+from time import time
+
+import api
+import constants
+import file_utils
+import statichelper
+import utils
+from settings import SETTINGS
+
+
+# Index loaded by this process. Retained between plugin invocations as the
+# language invoker is reused
+_LOADED = [None]
+
+
+def _options():
+    return {
+        'next_season': SETTINGS.next_season,
+        'unwatched_only': SETTINGS.unwatched_only,
+        'movie_sets': SETTINGS.enable_movieset,
+    }
+
+
+def _movie_key(movie):
+    """Next-up movies are indexed by movie set, or by movie if the movie is
+       not part of a set"""
+
+    setid = utils.get_int(movie, 'setid')
+    if setid > 0:
+        return 'set.{0}'.format(setid)
+    return 'movie.{0}'.format(movie['movieid'])
+
+
+class UpNextLibraryIndex(object):
+    """Index mapping each tvshowid to its next-up episode and each movie set to
+       its next-up movie, stored in the addon profile"""
+
+    __slots__ = (
+        '_lock',
+        'complete',
+        'episodes',
+        'movies',
+        'options',
+        'stamp',
+    )
+
+    VERSION = 1
+    FILENAME = 'library_index.json'
+
+    def __init__(self):
+        # Index is built in a separate thread by the service and may be
+        # updated by library events at the same time
+        self._lock = utils.create_lock()
+        self.complete = {'episodes': True, 'movies': True}
+        self.episodes = {}
+        self.movies = {}
+        self.options = {}
+        self.stamp = None
+
+    @classmethod
+    def log(cls, msg, level=utils.LOGDEBUG):
+        utils.log(msg, name=cls.__name__, level=level)
+
+    @classmethod
+    def _target(cls):
+        path = file_utils.make_legal_path(utils.get_addon_info('profile'))
+        if not path:
+            return None
+        return os.path.join(path, cls.FILENAME)
+
+    def _store(self, db_type, entries, complete=True):
+        if len(entries) >= constants.LIBRARY_INDEX_SIZE:
+            complete = False
+        entries = utils.merge_iterable(entries.values(), sort='lastplayed')
+        entries = entries[:constants.LIBRARY_INDEX_SIZE]
+
+        if db_type == 'episodes':
+            self.episodes = {
+                str(episode['tvshowid']): episode for episode in entries
+            }
+        else:
+            self.movies = {_movie_key(movie): movie for movie in entries}
+        self.complete[db_type] = complete
+
+    def get_episodes(self, limit=25):
+        episodes = utils.merge_iterable(self.episodes.values(),
+                                        sort='lastplayed')
+        return copy.deepcopy(episodes[:limit])
+
+    def get_movies(self, limit=25):
+        movies = utils.merge_iterable(self.movies.values(), sort='lastplayed')
+        return copy.deepcopy(movies[:limit])
+
+    def matches(self, **options):
+        return all(
+            self.options.get(option) == value
+            for option, value in options.items()
+        )
+
+    def load(self):
+        target = self._target()
+        if not target:
+            return False
+
+        try:
+            with io.open(target, mode='r', encoding='utf-8') as target_file:
+                data = json.load(target_file)
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not load index from {0}'.format(target))
+            return False
+
+        if not data or data.get('version') != self.VERSION:
+            return False
+
+        self.complete = data['complete']
+        self.episodes = data['episodes']
+        self.movies = data['movies']
+        self.options = data['options']
+        self.stamp = data['stamp']
+        return True
+
+    def save(self):
+        target = self._target()
+        if not target:
+            return False
+
+        self.stamp = str(time())
+        data = {
+            'version': self.VERSION,
+            'stamp': self.stamp,
+            'options': self.options,
+            'complete': self.complete,
+            'episodes': self.episodes,
+            'movies': self.movies,
+        }
+
+        # Write to temporary file first to avoid corrupting stored index
+        try:
+            with io.open(target + '.tmp', mode='w',
+                         encoding='utf-8') as target_file:
+                # Python 2 json.dump writes str, io text file requires unicode
+                target_file.write(statichelper.from_bytes(json.dumps(data)))
+            file_utils.replace_file(target + '.tmp', target)
+        except (IOError, OSError, TypeError, ValueError):
+            self.log('Could not save index to {0}'.format(target),
+                     utils.LOGWARNING)
+            return False
+
+        # Flag to other processes that the stored index is now up to date
+        utils.set_property(constants.LIBRARY_INDEX_PROPERTY_NAME, self.stamp)
+        return True
+
+    def rebuild(self, episodes=True, movies=True):
+        """Rebuild index from the library using current settings"""
+
+        with self._lock:
+            return self._rebuild(episodes=episodes, movies=movies)
+
+    def _rebuild(self, episodes=True, movies=True):
+        # Index is out of date until it has been rebuilt and saved
+        utils.clear_property(constants.LIBRARY_INDEX_PROPERTY_NAME)
+
+        options = _options()
+        if options != self.options:
+            self.options = options
+            episodes = movies = True
+
+        if episodes:
+            self._store('episodes', {
+                str(episode['tvshowid']): episode
+                for episode in api.get_upnext_episodes_from_library(
+                    limit=constants.LIBRARY_INDEX_SIZE,
+                    next_season=options['next_season'],
+                    unwatched_only=options['unwatched_only']
+                )
+            })
+        if movies:
+            self._store('movies', {
+                _movie_key(movie): movie
+                for movie in api.get_upnext_movies_from_library(
+                    limit=constants.LIBRARY_INDEX_SIZE,
+                    movie_sets=options['movie_sets'],
+                    unwatched_only=options['unwatched_only']
+                )
+            })
+
+        self.log('Index rebuilt: {0} episodes, {1} movies'.format(
+            len(self.episodes), len(self.movies)
+        ))
+        return self.save()
+
+    def refresh(self):
+        """Rebuild index if settings used to build the index have changed"""
+
+        with self._lock:
+            if self.options == _options():
+                return False
+            return self._rebuild()
+
+    def update(self, db_type=None, db_id=constants.UNDEFINED, removed=False):
+        """Update index entry of the tvshow or movie set of an updated video.
+           Index is rebuilt if an entry is removed from an incomplete index, as
+           the next most recent entry would not otherwise be available"""
+
+        if db_type in ('episode', 'season', 'tvshow'):
+            index_type = 'episodes'
+        elif db_type == 'movie':
+            index_type = 'movies'
+        else:
+            return False
+
+        with self._lock:
+            # Index is out of date until it has been updated and saved
+            utils.clear_property(constants.LIBRARY_INDEX_PROPERTY_NAME)
+
+            if (removed or db_id == constants.UNDEFINED
+                    or self.options != _options()
+                    or not self._update_entry(index_type, db_type, db_id)):
+                return self._rebuild(episodes=index_type == 'episodes',
+                                     movies=index_type == 'movies')
+            return self.save()
+
+    def _update_entry(self, index_type, db_type, db_id):
+        if index_type == 'episodes':
+            key, entry = self._get_upnext_episode(db_type, db_id)
+            entries = self.episodes
+        else:
+            key, entry = self._get_upnext_movie(db_id)
+            entries = self.movies
+
+        if not key:
+            return False
+        if entry:
+            entries[key] = entry
+        elif entries.pop(key, None) and not self.complete[index_type]:
+            return False
+
+        self._store(index_type, entries, self.complete[index_type])
+        return True
+
+    def _get_upnext_episode(self, db_type, db_id):
+        if db_type == 'tvshow':
+            tvshowid = db_id
+        else:
+            details, _ = api.get_details_from_library(
+                db_type=db_type, db_id=db_id, properties=['tvshowid']
+            )
+            tvshowid = utils.get_int(details, 'tvshowid')
+            if tvshowid == constants.UNDEFINED:
+                return None, None
+
+        episodes = api.get_upnext_episodes_from_library(
+            limit=1,
+            next_season=self.options['next_season'],
+            unwatched_only=self.options['unwatched_only'],
+            tvshowid=tvshowid
+        )
+        return str(tvshowid), (episodes[0] if episodes else None)
+
+    def _get_upnext_movie(self, db_id):
+        details, _ = api.get_details_from_library(
+            db_type='movie', db_id=db_id, properties=['title', 'set', 'setid']
+        )
+        if not details:
+            return None, None
+
+        # Movies in a set are found by set title, other movies by title and
+        # are then matched by movieid
+        if utils.get_int(details, 'setid') > 0:
+            filters = api.filter_set(details['set'])
+        else:
+            filters = api.filter_title(details['title'])
+        key = _movie_key(dict(details, movieid=db_id))
+
+        movies = api.get_upnext_movies_from_library(
+            limit=constants.LIBRARY_INDEX_SIZE,
+            movie_sets=self.options['movie_sets'],
+            unwatched_only=self.options['unwatched_only'],
+            filters=filters
+        )
+        for movie in movies:
+            if _movie_key(movie) == key:
+                return key, movie
+        return key, None
+
+
+def load_index(**options):
+    """Returns the index saved by the service if it is up to date and was
+       built using the given options, otherwise returns None"""
+
+    stamp = utils.get_property(constants.LIBRARY_INDEX_PROPERTY_NAME)
+    if not stamp:
+        return None
+
+    index = _LOADED[0]
+    if not index or index.stamp != stamp:
+        index = UpNextLibraryIndex()
+        if not index.load() or index.stamp != stamp:
+            return None
+        _LOADED[0] = index
+
+    if not index.matches(**options):
+        return None
+    return index
+
+
+def get_upnext_episodes(limit=25, next_season=True, unwatched_only=False):
+    """Function to get next-up episodes from the index maintained by the
+       service, or from the library if the index is not up to date"""
+
+    index = load_index(next_season=next_season, unwatched_only=unwatched_only)
+    if index:
+        return index.get_episodes(limit)
+
+    return api.get_upnext_episodes_from_library(limit=limit,
+                                                next_season=next_season,
+                                                unwatched_only=unwatched_only)
+
+
+def get_upnext_movies(limit=25, movie_sets=True, unwatched_only=False):
+    """Function to get next-up movies from the index maintained by the
+       service, or from the library if the index is not up to date"""
+
+    index = load_index(movie_sets=movie_sets, unwatched_only=unwatched_only)
+    if index:
+        return index.get_movies(limit)
+
+    return api.get_upnext_movies_from_library(limit=limit,
+                                              movie_sets=movie_sets,
+                                              unwatched_only=unwatched_only)
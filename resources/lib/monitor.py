@@ -8,6 +8,7 @@ from time import time
 import api
 import constants
 import detector
+import library_index
 import player
 import popuphandler
 import simulation
@@ -27,8 +28,10 @@ class UpNextMonitor(xbmc.Monitor, object):
         '_queue_length',
         '_started',
         '_detector',
+        '_library_index',
         '_popuphandler',
         'detector',
+        'library_index',
         'player',
         'popuphandler',
         'state',
@@ -46,9 +49,11 @@ class UpNextMonitor(xbmc.Monitor, object):
         self._started = False
 
         self._detector = None
+        self._library_index = None
         self._popuphandler = None
 
         self.detector = None
+        self.library_index = None
         self.player = None
         self.popuphandler = None
         self.state = None
@@ -59,7 +64,7 @@ class UpNextMonitor(xbmc.Monitor, object):
     def log(cls, msg, level=utils.LOGDEBUG):
         utils.log(msg, name=cls.__name__, level=level)
 
-    def _check_video(self, plugin_data=None, player_data=None):  # pylint: disable=too-many-return-statements
+    def _check_video(self, plugin_data=None, player_data=None):  # pylint: disable=too-many-branches,too-many-return-statements
         # Only process one start at a time unless plugin data has been received
         if self.state.starting and not plugin_data:
             return
@@ -139,6 +144,10 @@ class UpNextMonitor(xbmc.Monitor, object):
             # Store popup time and check if cue point was provided
             self.state.set_popup_time(play_info['duration'])
 
+            # Load stored hashes in background if detector will be used
+            if self.state.get_detect_time() is not None:
+                detector.UpNextHashStore.prefetch(now_playing_item)
+
             # Handle sim mode functionality and notification
             skip_tracking = simulation.handle_sim_mode(
                 player=self.player,
@@ -154,6 +163,32 @@ class UpNextMonitor(xbmc.Monitor, object):
         if self.state.is_tracking():
             self.state.reset()
 
+    def _event_handler_library_update(self, **kwargs):
+        method = kwargs.get('method')
+        data, _ = utils.decode_data(serialised_json=kwargs.get('data'))
+
+        # Remove all cached details and rebuild index once scanning has
+        # completed, as updates during a scan are not handled individually
+        if method == 'VideoLibrary.OnScanFinished' or not data:
+            api.library_cache_invalidate()
+            if self.library_index:
+                self._update_library_index('rebuild')
+            return
+
+        # Kodi v18+ OnUpdate data contains details of the video in an item
+        item = data.get('item', data)
+        db_type = item.get('type')
+        db_id = utils.get_int(item, 'id')
+        api.library_cache_invalidate(db_type=db_type, db_id=db_id)
+
+        if self.library_index and not data.get('transaction'):
+            self._update_library_index(
+                'update',
+                db_type=db_type,
+                db_id=db_id,
+                removed=(method == 'VideoLibrary.OnRemove')
+            )
+
     def _event_handler_player_general(self, **_kwargs):
         # Delay event handler execution to allow events to queue up
         self.waitForAbort(1)
@@ -488,6 +523,21 @@ class UpNextMonitor(xbmc.Monitor, object):
                 self.popuphandler = None
                 self.log('Cleanup popuphandler')
 
+    def _update_library_index(self, method, **kwargs):
+        """Rebuild or update the library index in a separate thread, to avoid
+           blocking startup or event handling. Each thread waits for the
+           previous thread to finish, so updates are applied in order"""
+
+        index = self.library_index
+        previous_thread = self._library_index
+
+        def _update():
+            if previous_thread:
+                previous_thread.join()
+            getattr(index, method)(**kwargs)
+
+        self._library_index = utils.run_threaded(_update)
+
     def _widget_reload(self, init=False):
         if self._idle[0] != constants.IDLE_STATE['idle']:
             return 0
@@ -512,6 +562,10 @@ class UpNextMonitor(xbmc.Monitor, object):
 
         self.state = kwargs.get('state') or state.UpNextState()
         self.player = kwargs.get('player') or player.UpNextPlayer()
+        self.library_index = (kwargs.get('library_index')
+                              or library_index.UpNextLibraryIndex())
+        # Build index of next-up videos used by the plugin to populate widgets
+        self._update_library_index('rebuild')
 
         self._started = True
 
@@ -549,6 +603,18 @@ class UpNextMonitor(xbmc.Monitor, object):
         del self.player
         self.player = None
         self.log('Cleanup player')
+        # Wait for index to be updated before flagging it as out of date, as
+        # the update thread would otherwise flag it as up to date once saved
+        library_index_thread = getattr(self, '_library_index', None)
+        if library_index_thread:
+            library_index_thread.join()
+            del self._library_index
+            self._library_index = None
+        # Plugin will not use stored index unless it is updated by the service
+        utils.clear_property(constants.LIBRARY_INDEX_PROPERTY_NAME)
+        del self.library_index
+        self.library_index = None
+        self.log('Cleanup library index')
 
         self._started = False
 
@@ -580,6 +646,15 @@ class UpNextMonitor(xbmc.Monitor, object):
         'Player.OnStop': _event_handler_player_stop
     }
 
+    # Library events are handled immediately and are not queued, as they do not
+    # affect playback and can fire in large numbers during a library scan
+    LIBRARY_EVENTS_MAP = {
+        'VideoLibrary.OnUpdate': _event_handler_library_update,
+        'VideoLibrary.OnRemove': _event_handler_library_update,
+        'VideoLibrary.OnScanFinished': _event_handler_library_update,
+        'VideoLibrary.OnCleanFinished': _event_handler_library_update,
+    }
+
     def onNotification(self, sender, method, data=None):  # pylint: disable=invalid-name
         """Handler for Kodi events and data transfer from plugins"""
 
@@ -591,6 +666,11 @@ class UpNextMonitor(xbmc.Monitor, object):
         data = statichelper.from_bytes(data) if data else ''
         self.log(' - '.join([sender, method, data]))
 
+        handler = UpNextMonitor.LIBRARY_EVENTS_MAP.get(method)
+        if handler:
+            handler(self, method=method, data=data)
+            return
+
         handler = UpNextMonitor.EVENTS_MAP.get(method)
         if not handler:
             return
@@ -609,6 +689,7 @@ class UpNextMonitor(xbmc.Monitor, object):
             self.log('UpNext disabled', utils.LOGINFO)
             self.stop()
         elif self._started:
+            self._update_library_index('refresh')
             self._widget_reload()
         else:
             self.log('UpNext enabled', utils.LOGINFO)
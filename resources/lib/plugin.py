@@ -8,6 +8,7 @@ from random import shuffle as randshuffle
 
 import api
 import constants
+import library_index
 import upnext
 import utils
 import xbmcgui
@@ -68,7 +69,7 @@ def generate_listing(addon_handle, addon_id, items):  # pylint: disable=unused-a
 
 
 def generate_next_movies_list(addon_handle, addon_id, **kwargs):  # pylint: disable=unused-argument
-    movies = api.get_upnext_movies_from_library(
+    movies = library_index.get_upnext_movies(
         limit=SETTINGS.widget_list_limit,
         movie_sets=SETTINGS.enable_movieset,
         unwatched_only=SETTINGS.unwatched_only
@@ -142,7 +143,7 @@ def generate_similar_movies_list(addon_handle, addon_id, **kwargs):  # pylint: d
 
 
 def generate_next_episodes_list(addon_handle, addon_id, **kwargs):  # pylint: disable=unused-argument
-    episodes = api.get_upnext_episodes_from_library(
+    episodes = library_index.get_upnext_episodes(
         limit=SETTINGS.widget_list_limit,
         next_season=SETTINGS.next_season,
         unwatched_only=SETTINGS.unwatched_only
@@ -218,12 +219,12 @@ def generate_similar_tvshows_list(addon_handle, addon_id, **kwargs):  # pylint:
 
 
 def generate_next_media_list(addon_handle, addon_id, **kwargs):  # pylint: disable=unused-argument
-    episodes = api.get_upnext_episodes_from_library(
+    episodes = library_index.get_upnext_episodes(
         limit=SETTINGS.widget_list_limit,
         next_season=SETTINGS.next_season,
         unwatched_only=SETTINGS.unwatched_only
     )
-    movies = api.get_upnext_movies_from_library(
+    movies = library_index.get_upnext_movies(
         limit=SETTINGS.widget_list_limit,
         movie_sets=SETTINGS.enable_movieset,
         unwatched_only=SETTINGS.unwatched_only
@@ -298,7 +299,6 @@ def generate_similar_media_list(addon_handle, addon_id, **kwargs):  # pylint: di
         unwatched_only=SETTINGS.widget_unwatched_only,
         use_cast=SETTINGS.widget_enable_cast,
         use_tag=SETTINGS.widget_enable_tags,
-        return_all=True
     )
     original, similar_list[1] = api.get_similar_from_library(
         db_type=similar_list[1],
@@ -307,7 +307,6 @@ def generate_similar_media_list(addon_handle, addon_id, **kwargs):  # pylint: di
         unwatched_only=SETTINGS.widget_unwatched_only,
         use_cast=SETTINGS.widget_enable_cast,
         use_tag=SETTINGS.widget_enable_tags,
-        return_all=True
     )
     if original:
         title = original['title']
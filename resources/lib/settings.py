@@ -31,9 +31,13 @@ class UpNextSettings(object):
         'detector_data_limit',
         'detector_debug',
         'detector_debug_save',
+        'detector_debug_stats',
+        'detector_episode_limit',
         'detector_filter',
+        'detector_processes',
         'detector_resize_method',
         'detector_save_path',
+        'detector_storage_limit',
         'detector_threads',
         'disabled',
         'enable_movieset',
@@ -249,6 +253,12 @@ class UpNextSettings(object):
             self.get_string('detectorSavePath')
         )
         self.detector_threads = self.get_int('detectorThreads')
+        self.detector_processes = self.get_bool('detectorProcesses')
+        self.detector_episode_limit = self.get_int('detectorEpisodeLimit')
+        # Storage limit in MB, converted to bytes
+        self.detector_storage_limit = (
+            self.get_int('detectorStorageLimit') * 1024 * 1024
+        )
         data_limit = self.get_int('detectorDataLimit')
         self.detector_data_limit = data_limit - data_limit % 8
         self.detector_filter = self.get_bool('detectorFilter')
@@ -268,6 +278,7 @@ class UpNextSettings(object):
         self.detector_debug = self.get_bool('detectorDebug')
         self.detector_debug_save = (self.detector_save_path
                                     and self.get_bool('detectorDebugSave'))
+        self.detector_debug_stats = self.get_bool('detectorDebugStats')
         self.start_trigger = self.get_bool('startTrigger')
 
         self._store = None
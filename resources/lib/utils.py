@@ -8,9 +8,15 @@ import base64
 import binascii
 import json
 import threading
+from collections import OrderedDict, deque
 from itertools import chain
 from posixpath import split as posix_split
 
+try:
+    from time import monotonic as _timer
+except ImportError:
+    from time import time as _timer
+
 try:
     from urllib.parse import parse_qsl, urlparse
 except ImportError:
@@ -202,6 +208,73 @@ class Profiler(object):
         return output
 
 
+class ExpiringCache(object):
+    """Thread safe cache with a maximum number of entries, where each entry
+       expires after a time to live. The least recently used entry is evicted
+       when the cache is full"""
+
+    __slots__ = ('_entries', '_lock', 'maxsize', 'ttl', )
+
+    def __init__(self, maxsize=128, ttl=None):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if not entry:
+                return default
+            value, expires = entry
+            if expires is not None and expires <= _timer():
+                return default
+            # Re-insert entry to mark it as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        expires = _timer() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, condition=None):
+        """Remove entries for which condition(key, value) is True, or all
+           entries if no condition is provided. Returns number removed"""
+
+        with self._lock:
+            if not condition:
+                num_removed = len(self._entries)
+                self._entries.clear()
+                return num_removed
+
+            keys = [
+                key for key, (value, _) in self._entries.items()
+                if condition(key, value)
+            ]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def values(self, condition=None):
+        """Returns values of unexpired entries, for which condition(key, value)
+           is True if a condition is provided"""
+
+        now = _timer()
+        with self._lock:
+            return [
+                value for key, (value, expires) in self._entries.items()
+                if (expires is None or expires > now)
+                and (not condition or condition(key, value))
+            ]
+
+
 def wait(timeout=None):
     if not timeout:
         timeout = 0
@@ -214,8 +287,42 @@ def abort_requested():
     return xbmc.Monitor().abortRequested()
 
 
+class JSONParams(object):  # pylint: disable=too-few-public-methods
+    """Params of a JSONRPC call where some params have already been serialised
+       as JSON object members, so that serialised JSON can be cached and reused
+       for params that do not change"""
+
+    __slots__ = (
+        'cached',
+        'params',
+    )
+
+    def __init__(self, cached, params=None):
+        self.cached = cached
+        self.params = params
+
+    def dumps(self):
+        members = [self.cached] if self.cached else []
+        if self.params:
+            members.append(json.dumps(self.params, default=tuple)[1:-1])
+        return '{{{0}}}'.format(', '.join(members))
+
+
+def _jsonrpc_dumps(request):
+    params = request.get('params')
+    if not isinstance(params, JSONParams):
+        return json.dumps(request, default=tuple)
+
+    request = dict(request)
+    del request['params']
+    return '{0}, "params": {1}}}'.format(
+        json.dumps(request, default=tuple)[:-1], params.dumps()
+    )
+
+
 def jsonrpc(batch=None, **kwargs):
-    """Perform JSONRPC calls"""
+    """Perform JSONRPC calls. A batch of calls is sent as a single request and
+       the responses are returned as a list, in the same order as the calls"""
 
     if not batch and not kwargs:
         return None
@@ -227,9 +334,32 @@ def jsonrpc(batch=None, **kwargs):
             kwargs['id'] = request_id
         kwargs['jsonrpc'] = '2.0'
 
-    request = json.dumps(batch or kwargs, default=tuple)
+    if batch:
+        request = '[{0}]'.format(', '.join(
+            _jsonrpc_dumps(kwargs) for kwargs in batch
+        ))
+    else:
+        request = _jsonrpc_dumps(kwargs)
     response = xbmc.executeJSONRPC(request)
-    return json.loads(response) if do_response else None
+    if not do_response:
+        return None
+
+    response = json.loads(response)
+    if not batch:
+        return response
+
+    # Batch responses can be in any order so match them to calls by id. An
+    # invalid batch returns a single error response rather than a list
+    if not isinstance(response, list):
+        response = [response]
+    response = {
+        result.get('id'): result
+        for result in response if isinstance(result, dict)
+    }
+    return [
+        response.get(kwargs['id'], {}) if 'id' in kwargs else None
+        for kwargs in batch
+    ]
 
 
 def get_addon(addon_id=None, retry_attempts=3):
@@ -681,8 +811,6 @@ def merge_iterable(*iterables, **kwargs):
 
 
 if supports_python_api(19):
-    from collections import deque
-
     def modify_iterable(function, sequence):
         deque(map(function, sequence), maxlen=0)
 else:
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+# GNU General Public License v2.0 (see COPYING or https://www.gnu.org/licenses/gpl-2.0.txt)
+"""UpNext detector benchmark
+
+Replays synthetic or recorded frame sequences through UpNextDetector, using the
+xbmc.RenderCapture stub, and reports processing rate, per stage latency,
+credits detection latency and false positive rates. Frames are evaluated in
+simulated playback time, at the capture interval chosen by the detector, so
+results do not depend on real time waits.
+
+Example usage:
+    PYTHONPATH=resources/lib:tests python tests/benchmark_detector.py
+    PYTHONPATH=resources/lib:tests python tests/benchmark_detector.py \\
+        --json results.json --baseline baseline.json
+    PYTHONPATH=resources/lib:tests python tests/benchmark_detector.py \\
+        --frames recorded_frames/ --fps 1 --credits-start 1250
+"""
+
+from __future__ import (
+    absolute_import,
+    division,
+    print_function,
+    unicode_literals,
+)
+
+import argparse
+import json
+import os
+import random
+import timeit
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+import detector
+import state
+import xbmc
+
+STAGES = ('image', 'episodes', 'filtered', 'total')
+PERCENTILES = (50, 90, 99)
+SCENE_LENGTH = 6
+FADE_LENGTH = 4
+WORDS = (
+    'Directed', 'Produced', 'Written', 'Story', 'Editor', 'Music', 'Casting',
+    'Camera', 'Sound', 'Lighting', 'Costume', 'Design', 'Visual', 'Effects',
+    'Executive', 'Associate', 'Supervisor', 'Assistant', 'Script', 'Stunt',
+)
+
+
+def _scene(size, scene_idx, offset=0, brightness=1.0):
+    """Video content frame. Content changes every scene, and moves slightly
+       within each scene"""
+
+    scene_random = random.Random(scene_idx)
+    gradient = Image.radial_gradient('L').rotate(scene_random.randint(0, 359))
+    gradient = ImageChops.offset(gradient.resize(size), offset, 0)
+    bands = [
+        gradient.point(lambda i, k=scene_random.random(): int(k * i)),
+        Image.effect_noise(size, scene_random.randint(10, 60)),
+        gradient.point(lambda i, k=scene_random.random(): int(k * (255 - i))),
+    ]
+    if brightness != 1.0:
+        bands = [
+            band.point(lambda i: int(brightness * i)) for band in bands
+        ]
+    return Image.merge('RGB', bands)
+
+
+def content(size, play_time):
+    return _scene(size, int(play_time // SCENE_LENGTH), int(play_time))
+
+
+def dark_scenes(size, play_time):
+    return _scene(size, int(play_time // SCENE_LENGTH), int(play_time), 0.1)
+
+
+def fades(size, play_time):
+    """Scenes that fade to and from black between each scene"""
+
+    scene_idx, scene_time = divmod(play_time, 2 * SCENE_LENGTH)
+    if scene_time < SCENE_LENGTH:
+        brightness = min(1.0, scene_time / FADE_LENGTH)
+    else:
+        brightness = max(0.0, 1 - (scene_time - SCENE_LENGTH) / FADE_LENGTH)
+    return _scene(size, int(scene_idx), int(play_time), brightness)
+
+
+def title_card(size, play_time):  # pylint: disable=unused-argument
+    """Static title text on a black background"""
+
+    draw_size = (size[0] // 2, size[1] // 2)
+    image = Image.new('RGB', draw_size)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for line in range(3):
+        text = ' '.join(WORDS[line::7]).upper()
+        draw.text(
+            (draw_size[0] // 2 - 3 * len(text), draw_size[1] // 3 + 12 * line),
+            text, fill=(255, 255, 255), font=font
+        )
+    return image.resize(size)
+
+
+def credits_scroll(size, play_time, speed=5, spacing=16):
+    """Lines of white text scrolling up a black background. Text is drawn at
+       half size and scaled up to give legible text at capture size"""
+
+    draw_size = (size[0] // 2, size[1] // 2)
+    image = Image.new('RGB', draw_size)
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    offset = int(play_time * speed)
+    first_line = offset // spacing
+    for line in range(first_line, first_line + draw_size[1] // spacing + 1):
+        line_random = random.Random(line)
+        text = ' '.join(line_random.sample(WORDS, 4))
+        draw.text(
+            (draw_size[0] // 2 - 3 * len(text), line * spacing - offset),
+            text, fill=(255, 255, 255), font=font
+        )
+    return image.resize(size)
+
+
+def sequence(*parts):
+    """Join (duration, generator) parts into a single sequence returning the
+       frame for a play time"""
+
+    def frame(size, play_time):
+        part_start = 0
+        for duration, generator in parts[:-1]:
+            if play_time < part_start + duration:
+                return generator(size, play_time - part_start)
+            part_start += duration
+        return parts[-1][1](size, play_time - part_start)
+
+    return frame
+
+
+def recorded(path, fps=1):
+    """Sequence of recorded frames from image files in a directory, sorted by
+       file name and played at fps frames per second"""
+
+    files = sorted(
+        os.path.join(path, filename) for filename in os.listdir(path)
+        if os.path.splitext(filename)[1].lower() in ('.png', '.jpg', '.bmp')
+    )
+
+    def frame(size, play_time):
+        idx = min(int(play_time * fps), len(files) - 1)
+        return Image.open(files[idx]).convert('RGB').resize(size)
+
+    return frame, len(files) / fps
+
+
+# Synthetic sequences as (name, duration, credits start time, sequence)
+SEQUENCES = (
+    ('credits_scroll', 180, 120,
+     sequence((120, content), (60, credits_scroll))),
+    ('credits_after_dark', 150, 100,
+     sequence((100, dark_scenes), (50, credits_scroll))),
+    ('dark_scenes', 120, None, dark_scenes),
+    ('fades', 120, None, fades),
+    ('title_card', 120, None,
+     sequence((40, content), (20, title_card), (60, content))),
+)
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of a list of values"""
+
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, int(round(percent / 100 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def replay(name, duration, credits_start, frames, stop_on_detection=True):  # pylint: disable=too-many-locals
+    """Replay a sequence of frames through a new detector instance. Frames
+       are captured through the xbmc.RenderCapture stub"""
+
+    # Frames are hashed as an episode of a show, with no stored hashes from
+    # other episodes
+    test_state = state.UpNextState()
+    test_state.current_item = {'group_name': name, 'group_idx': 1}
+    test_detector = detector.UpNextDetector(player=None, state=test_state)
+    size = test_detector._get_video_capture_resolution(  # pylint: disable=protected-access
+        max_size=detector.SETTINGS.detector_data_limit
+    )
+    hash_size = test_detector.hashes.hash_size
+
+    play_time = [0]
+    xbmc.RenderCapture.frame_source = lambda width, height: bytearray(
+        frames((width, height), play_time[0]).convert('RGBA').tobytes()
+    )
+    capturer = xbmc.RenderCapture()
+    capturer.capture(*size)
+
+    stage_times = {stage: [] for stage in STAGES}
+    result = {
+        'name': name,
+        'frames': 0,
+        'process_time': 0,
+        'detected_at': None,
+        'credits_start': credits_start,
+        'false_positive': False,
+        'frame_hits': 0,
+        'frames_before_credits': 0,
+    }
+    try:
+        while play_time[0] < duration:
+            image_data = capturer.getImage()
+            hits = test_detector.match_counts['hits']
+
+            process_start = timeit.default_timer()
+            timings = test_detector._worker_evaluate(  # pylint: disable=protected-access
+                None, 0, (image_data, size, (play_time[0], duration))
+            )
+            timings['total'] = timeit.default_timer() - process_start
+
+            result['frames'] += 1
+            result['process_time'] += timings['total']
+            for stage, stage_time in timings.items():
+                stage_times[stage].append(stage_time)
+
+            if credits_start is None or play_time[0] < credits_start:
+                result['frames_before_credits'] += 1
+                if test_detector.match_counts['hits'] > hits:
+                    result['frame_hits'] += 1
+
+            if test_detector.credits_detected():
+                result['detected_at'] = play_time[0]
+                if stop_on_detection:
+                    break
+
+            play_time[0] += test_detector.capture_interval
+    finally:
+        xbmc.RenderCapture.frame_source = None
+
+    if result['detected_at'] is not None:
+        result['false_positive'] = (
+            credits_start is None or result['detected_at'] < credits_start
+        )
+        if not result['false_positive']:
+            result['detection_latency'] = result['detected_at'] - credits_start
+    result['hash_size'] = list(hash_size)
+    result['stages'] = {
+        stage: {
+            'p{0}'.format(percent): percentile(times, percent)
+            for percent in PERCENTILES
+        }
+        for stage, times in stage_times.items() if times
+    }
+    return result
+
+
+def summarise(results):
+    frames = sum(result['frames'] for result in results)
+    process_time = sum(result['process_time'] for result in results)
+    frames_before_credits = sum(
+        result['frames_before_credits'] for result in results
+    )
+    return {
+        'frames': frames,
+        'fps': frames / process_time if process_time else None,
+        'false_positive_rate': (
+            sum(result['false_positive'] for result in results) / len(results)
+        ),
+        'frame_false_positive_rate': (
+            sum(result['frame_hits'] for result in results)
+            / frames_before_credits
+        ) if frames_before_credits else None,
+    }
+
+
+def _format_ms(value):
+    return '-' if value is None else '{0:.2f}'.format(1000 * value)
+
+
+def report(results, summary, baseline=None):
+    print('{0:<20} {1:>6} {2:>8} {3:>9} {4:>8} {5:>8}  {6}'.format(
+        'Sequence', 'Frames', 'FPS', 'Detected', 'Latency', 'Frame FP',
+        'Stage latency p50/p90/p99 (ms)'
+    ))
+    for result in results:
+        print('{0:<20} {1:>6} {2:>8.1f} {3:>9} {4:>8} {5:>8}  {6}'.format(
+            result['name'],
+            result['frames'],
+            result['frames'] / result['process_time'],
+            '-' if result['detected_at'] is None else '{0:.0f}s{1}'.format(
+                result['detected_at'], ' FP' if result['false_positive'] else ''
+            ),
+            '-' if 'detection_latency' not in result else '{0:.0f}s'.format(
+                result['detection_latency']
+            ),
+            '{0}/{1}'.format(
+                result['frame_hits'], result['frames_before_credits']
+            ),
+            ', '.join(
+                '{0} {1}'.format(stage, '/'.join(
+                    _format_ms(result['stages'][stage]['p{0}'.format(percent)])
+                    for percent in PERCENTILES
+                ))
+                for stage in STAGES if stage in result['stages']
+            )
+        ))
+
+    print('Total: {0[frames]} frames, {0[fps]:.1f} frames/s, '
+          'false positive rate {0[false_positive_rate]:.2f}, '
+          'frame false positive rate {0[frame_false_positive_rate]:.3f}'
+          .format(summary))
+
+    if not baseline:
+        return
+    baseline_fps = baseline['summary']['fps']
+    print('Baseline: {0:.1f} frames/s ({1:+.1f}%)'.format(
+        baseline_fps, 100 * (summary['fps'] / baseline_fps - 1)
+    ))
+    baseline_results = {
+        result['name']: result for result in baseline['results']
+    }
+    for result in results:
+        baseline_result = baseline_results.get(result['name'])
+        if not baseline_result:
+            continue
+        print('{0:<20} detected {1} -> {2}, total p50 {3} -> {4}ms'.format(
+            result['name'],
+            baseline_result['detected_at'],
+            result['detected_at'],
+            _format_ms(baseline_result['stages']['total']['p50']),
+            _format_ms(result['stages']['total']['p50']),
+        ))
+
+
+def run(sequences=SEQUENCES, baseline=None, output=None):
+    """Replay sequences through the detector, print a report and optionally
+       save results for use as a baseline"""
+
+    # Debug output slows detection and evaluates all stages of every frame
+    detector_debug = detector.SETTINGS.detector_debug
+    detector.SETTINGS.detector_debug = False
+    save_path = detector.SETTINGS.detector_save_path
+    detector.SETTINGS.detector_save_path = None
+    try:
+        results = [replay(*args) for args in sequences]
+    finally:
+        detector.SETTINGS.detector_debug = detector_debug
+        detector.SETTINGS.detector_save_path = save_path
+    summary = summarise(results)
+
+    if baseline:
+        with open(baseline, mode='r', encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)
+    report(results, summary, baseline)
+
+    if output:
+        with open(output, mode='w', encoding='utf-8') as output_file:
+            json.dump({'summary': summary, 'results': results}, output_file,
+                      indent=4, sort_keys=True)
+    return summary, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='UpNext detector benchmark')
+    parser.add_argument('--json', help='save results to json file')
+    parser.add_argument('--baseline', help='compare with saved results')
+    parser.add_argument('--frames', help='directory of recorded frames')
+    parser.add_argument('--fps', type=float, default=1,
+                        help='frame rate of recorded frames')
+    parser.add_argument('--credits-start', type=float,
+                        help='credits start time of recorded frames')
+    args = parser.parse_args()
+
+    sequences = SEQUENCES
+    if args.frames:
+        frames, duration = recorded(args.frames, args.fps)
+        sequences = ((os.path.basename(os.path.normpath(args.frames)),
+                      duration, args.credits_start, frames),)
+    run(sequences, baseline=args.baseline, output=args.json)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,52 @@ from __future__ import (
     unicode_literals,
 )
 
+import io
+import json
 import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
 
 from PIL import Image
 
+try:
+    from importlib import reload
+except ImportError:
+    pass
+
+import benchmark_detector
 import detector
+import image_utils
+import state
+import statichelper
 
 SKIP_TEST_ALL = False
 SKIP_TEST_REP_HASH = False
 SKIP_TEST_HASH_COMPARE = False
+SKIP_TEST_PACKED_HASH = False
+SKIP_TEST_CREDITS_HASHES = False
+SKIP_TEST_NUMPY_BACKEND = False
+SKIP_TEST_CONCURRENT_PROCESS = False
+SKIP_TEST_PROCESS_INPUT = False
+SKIP_TEST_PROCESS_PLAN = False
+SKIP_TEST_CONDITIONAL_FILTER = False
+SKIP_TEST_ADAPTIVE_FILTER = False
+SKIP_TEST_BATCH_HASHES = False
+SKIP_TEST_PROCESS_STATS = False
+SKIP_TEST_PROCESS_WORKER = False
+SKIP_TEST_PROCESS_FALLBACK = False
+SKIP_TEST_HASH_STORE = False
+SKIP_TEST_HASH_WINDOW = False
+SKIP_TEST_HASH_JOURNAL = False
+SKIP_TEST_HASH_RETENTION = False
+SKIP_TEST_HASH_PREFETCH = False
+SKIP_TEST_CAPTURE_INTERVAL = False
+SKIP_TEST_EVALUATE_STAGES = False
+SKIP_TEST_BENCHMARK = False
 
 
 # Test comparisons sourced from:
@@ -233,6 +270,918 @@ def test_representative_hash():
     assert test_complete is True
 
 
+def _tuple_hash_similarity(baseline_hash, image_hash, filtered_hash=None):  # pylint: disable=too-many-locals
+    """Reference per-pixel implementation of hash similarity"""
+
+    compare_hash = filtered_hash or image_hash
+    num_pixels = len(baseline_hash)
+
+    bits_eq = sum(
+        (bit1 == bit2) * (1 if bit2 else 0.5)
+        for bit1, bit2 in zip(baseline_hash, compare_hash)
+    )
+    bits_xor = [0 if bit1 is None or bit1 == bit2 else 1
+                for bit1, bit2 in zip(baseline_hash, compare_hash)]
+    bits_xor_baseline = sum(1 for bit_xor, bit in zip(bits_xor, baseline_hash)
+                            if bit_xor and bit)
+    bits_xor_compare = sum(1 for bit_xor, bit in zip(bits_xor, compare_hash)
+                           if bit_xor and bit)
+
+    weighted_total = (
+        num_pixels
+        - baseline_hash.count(None)
+        - (min(baseline_hash.count(0), compare_hash.count(0)) / 2)
+    )
+    bit_compare = bits_eq - bits_xor_baseline - bits_xor_compare
+    similarity = max(0, 100 * bit_compare / weighted_total)
+
+    if not filtered_hash:
+        return similarity
+
+    masking_hash = filtered_hash if filtered_hash != image_hash else baseline_hash
+    mask = len(masking_hash) / masking_hash.count(0)
+    weights = [mask if bit == 0 else 0.25 for bit in masking_hash]
+    significant_bits = sum(bit * weight
+                           for bit, weight in zip(image_hash, weights))
+    significance = 100 * significant_bits / len(image_hash)
+    delta = significance - detector.SETTINGS.detect_significance
+    return similarity - 5 * delta / detector.SETTINGS.detect_significance
+
+
+def test_packed_hash():
+    if SKIP_TEST_ALL or SKIP_TEST_PACKED_HASH:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    num_pixels = hash_size[0] * hash_size[1]
+    credits_hash = detector.UpNextDetector._generate_initial_hash(*hash_size)  # pylint: disable=protected-access
+    packed_credits_hash = detector.PackedHash.from_tuple(credits_hash)
+    assert tuple(packed_credits_hash) == credits_hash
+
+    test_random = random.Random(0)
+    for _ in range(500):
+        image_hash = tuple(test_random.randint(0, 1)
+                           for _ in range(num_pixels))
+        filtered_hash = tuple(test_random.randint(0, 1)
+                              for _ in range(num_pixels))
+        packed_image_hash = detector.PackedHash.from_tuple(image_hash)
+        packed_filtered_hash = detector.PackedHash.from_tuple(filtered_hash)
+
+        for args, packed_args in (
+                ((credits_hash, image_hash),
+                 (packed_credits_hash, packed_image_hash)),
+                ((credits_hash, image_hash, filtered_hash),
+                 (packed_credits_hash, packed_image_hash, packed_filtered_hash)),
+                ((filtered_hash, image_hash, image_hash),
+                 (packed_filtered_hash, packed_image_hash, packed_image_hash)),
+        ):
+            similarity = detector.UpNextDetector._hash_similarity(*packed_args)  # pylint: disable=protected-access
+            assert abs(similarity - _tuple_hash_similarity(*args)) < 1e-9
+
+
+def test_credits_hashes():
+    if SKIP_TEST_ALL or SKIP_TEST_CREDITS_HASHES:
+        assert True
+        return
+
+    for hash_size in ([14, 8], [12, 8], [16, 8]):
+        credits_hashes = detector.UpNextDetector._get_credits_hashes(  # pylint: disable=protected-access
+            hash_size
+        )
+        assert credits_hashes == tuple(
+            detector.PackedHash.from_tuple(
+                detector.UpNextDetector._generate_initial_hash(  # pylint: disable=protected-access
+                    *hash_size,
+                    pad_height=pad_height
+                )
+            )
+            for pad_height in (hash_size[1] // 4, hash_size[1] // 8, 0)
+        )
+        # Same packed hashes are reused for subsequent requests
+        assert all(
+            cached_hash is credits_hash
+            for cached_hash, credits_hash in zip(
+                detector.UpNextDetector._get_credits_hashes(  # pylint: disable=protected-access
+                    tuple(hash_size)
+                ),
+                credits_hashes
+            )
+        )
+
+
+def test_numpy_backend():
+    numpy = image_utils._np  # pylint: disable=protected-access
+    if SKIP_TEST_ALL or SKIP_TEST_NUMPY_BACKEND or not numpy:
+        assert True
+        return
+
+    capture_size = (341, 192)
+    hash_size = (14, 8)
+    gradient = Image.radial_gradient('L').resize(capture_size)
+    blank = Image.new('L', capture_size, 0)
+
+    test_random = random.Random(0)
+    for idx in range(10):
+        noise = Image.frombytes('L', capture_size, bytes(bytearray(
+            test_random.getrandbits(8)
+            for _ in range(capture_size[0] * capture_size[1])
+        )))
+        noise = noise.point(
+            lambda i, scale=test_random.randint(1, 16): i // scale
+        )
+        frame = Image.merge('RGBA', (
+            Image.blend(gradient, noise, 0.1 * idx),
+            noise,
+            gradient if idx % 2 else blank,
+            blank,
+        ))
+        frame = bytearray(frame.tobytes())
+
+        hashes = []
+        for backend in (numpy, None):
+            image_utils._np = backend  # pylint: disable=protected-access
+            try:
+                images = detector.UpNextDetector._create_images(  # pylint: disable=protected-access
+                    bytearray(frame), capture_size
+                )
+                hashes.append([
+                    detector.UpNextDetector._create_hash(image, hash_size)  # pylint: disable=protected-access
+                    for image in images
+                ] + [image.tobytes() for image in images])
+            finally:
+                image_utils._np = numpy  # pylint: disable=protected-access
+
+        assert hashes[0] == hashes[1]
+
+
+def test_concurrent_process():
+    if SKIP_TEST_ALL or SKIP_TEST_CONCURRENT_PROCESS:
+        assert True
+        return
+
+    def _process(image, bit_depth):
+        return image_utils.process(
+            image,
+            queue=[
+                [image_utils.posterise, bit_depth],
+                [image_utils.auto_level],
+                [image_utils.resize, (64, 36)],
+                [image_utils.replace_with_copy, image_utils.image_stack(1)],
+            ]
+        ).tobytes()
+
+    image = Image.radial_gradient('L')
+    expected = [_process(image, bit_depth) for bit_depth in range(1, 9)]
+    results = [[] for _ in expected]
+
+    def _worker(bit_depth):
+        for _ in range(25):
+            results[bit_depth - 1].append(_process(image, bit_depth))
+
+    workers = [threading.Thread(target=_worker, args=(bit_depth, ))
+               for bit_depth in range(1, 9)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    for expected_output, outputs in zip(expected, results):
+        assert outputs == [expected_output] * 25
+
+
+def test_process_input():
+    if SKIP_TEST_ALL or SKIP_TEST_PROCESS_INPUT:
+        assert True
+        return
+
+    capture_size = (341, 192)
+    gradient = Image.radial_gradient('L').resize(capture_size)
+    frame = bytearray(Image.merge('RGBA', (
+        gradient,
+        Image.effect_noise(capture_size, 40),
+        gradient.point(lambda i: 255 - i),
+        Image.new('L', capture_size, 255),
+    )).tobytes())
+    expected_frame = bytes(frame)
+
+    # Captured data is not copied on import, or modified by processing
+    image = detector.UpNextDetector._create_image(frame, capture_size)  # pylint: disable=protected-access
+    assert bytes(frame) == expected_frame
+    imported_image = image_utils.import_data(frame, capture_size)
+    frame[0] = 255 - frame[0]
+    assert imported_image.getpixel((0, 0))[0] == frame[0]
+    frame[0] = expected_frame[0]
+
+    # Steps return new images rather than modifying input or stacked images
+    expected_image = image.tobytes()
+    filtered_image = detector.UpNextDetector._create_filtered_image(image)  # pylint: disable=protected-access
+    assert image.tobytes() == expected_image
+    assert filtered_image is not image
+
+    stacked_image = image_utils.process(
+        image,
+        queue=[
+            [image_utils.posterise, 3],
+            [image_utils.adaptive_filter, (8, 1, True),
+             image_utils.auto_level, (5, 95, (0.33, None))],
+            [image_utils.replace_with_copy, image_utils.image_stack(0)],
+        ]
+    )
+    assert image.tobytes() == expected_image
+    assert stacked_image.tobytes() == image_utils.posterise(image, 3).tobytes()
+
+
+def test_batch_hashes():
+    if SKIP_TEST_ALL or SKIP_TEST_BATCH_HASHES:
+        assert True
+        return
+
+    capture_size = (341, 192)
+    hash_size = (14, 8)
+    frames = []
+    for idx in range(4):
+        gradient = Image.radial_gradient('L').rotate(90 * idx)
+        gradient = gradient.resize(capture_size)
+        frames.append((bytes(Image.merge('RGBA', (
+            gradient,
+            Image.effect_noise(capture_size, 20 + 10 * idx),
+            gradient.point(lambda i: 255 - i),
+            Image.new('L', capture_size, 255),
+        )).tobytes()), capture_size))
+
+    # Batch of frames produces the same images and hashes as single frames
+    created = detector.UpNextDetector._create_image_hashes(frames, hash_size)  # pylint: disable=protected-access
+    assert len(created) == len(frames)
+    for (image, image_hash), frame in zip(created, frames):
+        expected_image = detector.UpNextDetector._create_image(*frame)  # pylint: disable=protected-access
+        expected_hash = detector.UpNextDetector._create_hash(  # pylint: disable=protected-access
+            expected_image, hash_size
+        )
+        assert image.tobytes() == expected_image.tobytes()
+        assert image_hash == expected_hash
+
+
+@contextmanager
+def _temp_save_path():
+    """Set detector save path to a temporary directory, removed on exit"""
+
+    save_path = detector.SETTINGS.detector_save_path
+    detector.SETTINGS.detector_save_path = os.path.join(tempfile.mkdtemp(), '')
+    try:
+        yield detector.SETTINGS.detector_save_path
+    finally:
+        shutil.rmtree(detector.SETTINGS.detector_save_path)
+        detector.SETTINGS.detector_save_path = save_path
+
+
+def test_process_stats():
+    if SKIP_TEST_ALL or SKIP_TEST_PROCESS_STATS:
+        assert True
+        return
+
+    image_utils.get_process_stats(reset=True)
+    image = Image.radial_gradient('L')
+    queue = [
+        [image_utils.resize, (32, 16)],
+        [image_utils.auto_level, 5, 95],
+        [image_utils.resize, (14, 8)],
+    ]
+    for _ in range(3):
+        image_utils.process(image, queue=[list(step) for step in queue],
+                            save_file='test', stats=True)
+    image_utils.process(image, queue=[list(step) for step in queue])
+
+    # Steps are recorded by name, only when enabled
+    process_stats = image_utils.get_process_stats()
+    assert set(process_stats) == {'test.resize', 'test.auto_level'}
+    assert process_stats['test.resize']['count'] == 6
+    assert process_stats['test.auto_level']['count'] == 3
+    assert process_stats['test.auto_level']['output_size'] == 32 * 16
+    assert sum(
+        count for _, count in process_stats['test.resize']['histogram']
+    ) == 6
+    # Total and mean times are both reported in ms
+    assert abs(process_stats['test.resize']['total_time']
+               - 6 * process_stats['test.resize']['wall_time']) < 1e-6
+
+    with _temp_save_path() as save_path:
+        # Summary is saved as json and recorded stats are reset
+        test_detector = detector.UpNextDetector(player=None,
+                                                state=state.UpNextState())
+        test_detector._save_process_stats()  # pylint: disable=protected-access
+        with io.open(os.path.join(save_path, 'process_stats.json'),
+                     mode='r', encoding='utf-8') as stats_file:
+            assert json.load(stats_file) == json.loads(
+                json.dumps(process_stats)
+            )
+        assert not image_utils.get_process_stats()
+
+
+def test_process_plan():
+    if SKIP_TEST_ALL or SKIP_TEST_PROCESS_PLAN:
+        assert True
+        return
+
+    queue = [
+        [image_utils.posterise, 3],
+        [image_utils.detail_reduce, image_utils.image_input(0), 50],
+        [image_utils.detail_reduce, image_utils.image_input(1), 25],
+        [image_utils.replace_with_copy, image_utils.image_stack(1)],
+    ]
+    expected_queue = [list(step) for step in queue]
+    plan = image_utils.compile_queue(queue)
+    assert queue == expected_queue
+
+    # Compiled plan gives the same output as process() for different inputs
+    gradient = Image.radial_gradient('L')
+    for angle in (0, 90, 180):
+        image = gradient.rotate(angle)
+        other_image = Image.effect_noise(image.size, angle)
+        expected_image = image_utils.process(
+            image,
+            queue=[
+                [image_utils.posterise, 3],
+                [image_utils.detail_reduce, image, 50],
+                [image_utils.detail_reduce, other_image, 25],
+                [image_utils.replace_with_copy, image_utils.image_stack(1)],
+            ]
+        )
+        assert plan(image, other_image).tobytes() == expected_image.tobytes()
+
+
+def test_conditional_filter():
+    if SKIP_TEST_ALL or SKIP_TEST_CONDITIONAL_FILTER:
+        assert True
+        return
+
+    size = (64, 36)
+    image = Image.blend(Image.radial_gradient('L').resize(size),
+                        Image.effect_noise(size, 50), 0.5)
+    filter_args = ('GaussianBlur,3', )
+    aggregate_image = image_utils.apply_filter(image, *filter_args)
+    rules = (
+        ((10, 200, 0.8, 1.2), (0, 30, 0, 10)),
+        ((100, 150, 0.9, 1.1), ),
+    )
+
+    def _kept(pixel, aggregate):
+        return [
+            any((local_max >= aggregate > local_min) and (
+                not aggregate or percent_hi >= pixel / aggregate > percent_lo
+            ) for local_min, local_max, percent_lo, percent_hi in rule_set)
+            for rule_set in rules
+        ] == [True, False]
+
+    expected = {'THRESHOLD': [], 'FILTER': [], 'MASK': []}
+    for pixel, aggregate in zip(bytearray(image.tobytes()),
+                                bytearray(aggregate_image.tobytes())):
+        kept = _kept(pixel, aggregate)
+        expected['THRESHOLD'].append(pixel if kept else 0)
+        expected['FILTER'].append(aggregate if kept else pixel)
+        expected['MASK'].append(255 if kept else 0)
+
+    assert 0 < expected['MASK'].count(255) < len(expected['MASK'])
+    for output, expected_data in expected.items():
+        filtered_image = image_utils.conditional_filter(
+            image, rules, output, filter_args
+        )
+        assert filtered_image.tobytes() == bytes(bytearray(expected_data))
+
+
+def test_adaptive_filter():
+    numpy = image_utils._np  # pylint: disable=protected-access
+    if SKIP_TEST_ALL or SKIP_TEST_ADAPTIVE_FILTER or not numpy:
+        assert True
+        return
+
+    test_random = random.Random(0)
+    for size in ((64, 36), (131, 77)):
+        image = Image.blend(
+            Image.radial_gradient('L').resize(size),
+            Image.frombytes('L', size, bytes(bytearray(
+                test_random.getrandbits(8) for _ in range(size[0] * size[1])
+            ))),
+            0.3
+        )
+        for sampling in ((8, 1, True), (4, 0.5, True), (5, 0.3, False)):
+            for args in ((), (10, 90), (0, 100, (2, 250))):
+                images = []
+                for backend in (numpy, None):
+                    image_utils._np = backend  # pylint: disable=protected-access
+                    try:
+                        images.append(image_utils.adaptive_filter(
+                            image, sampling, image_utils.auto_level, args
+                        ).tobytes())
+                    finally:
+                        image_utils._np = numpy  # pylint: disable=protected-access
+
+                assert images[0] == images[1]
+
+
+def test_process_worker():
+    fork_context = detector._FORK_CONTEXT  # pylint: disable=protected-access
+    if SKIP_TEST_ALL or SKIP_TEST_PROCESS_WORKER or not fork_context:
+        assert True
+        return
+
+    capture_size = (341, 192)
+    hash_size = (14, 8)
+    gradient = Image.radial_gradient('L').resize(capture_size)
+    frame = Image.merge('RGBA', (
+        gradient,
+        Image.effect_noise(capture_size, 40),
+        gradient.point(lambda i: 255 - i),
+        Image.new('L', capture_size, 255),
+    )).tobytes()
+
+    frames = [detector.RawArray('B', 2 * len(frame))]
+    pool = fork_context.Pool(
+        processes=1,
+        initializer=detector._process_worker_init,  # pylint: disable=protected-access
+        initargs=(frames, )
+    )
+    try:
+        memoryview(frames[0]).cast('B')[:len(frame)] = frame
+        hashes, stored_size = pool.apply(
+            detector._process_worker,  # pylint: disable=protected-access
+            (0, len(frame), capture_size, hash_size)
+        )
+        assert stored_size is None
+
+        # Image created by the image stage is reused by the filtered stage
+        memoryview(frames[0]).cast('B')[:len(frame)] = frame
+        image_hashes, stored_size = pool.apply(
+            detector._process_worker,  # pylint: disable=protected-access
+            (0, len(frame), capture_size, hash_size, 'image')
+        )
+        assert stored_size
+        filtered_hashes, stored_size = pool.apply(
+            detector._process_worker,  # pylint: disable=protected-access
+            (0, len(frame), capture_size, hash_size, 'filtered', stored_size)
+        )
+        assert stored_size is None
+        assert bytes(frames[0][:len(frame)]) != frame
+    finally:
+        pool.terminate()
+        pool.join()
+
+    expected_hashes = detector.UpNextDetector._create_hashes(  # pylint: disable=protected-access
+        bytearray(frame), capture_size, hash_size
+    )
+    expected_hashes = tuple(
+        None if image_hash is None else image_hash.value
+        for image_hash in expected_hashes
+    )
+    assert hashes == expected_hashes
+    assert image_hashes + filtered_hashes == expected_hashes
+
+
+def test_process_fallback():
+    if SKIP_TEST_ALL or SKIP_TEST_PROCESS_FALLBACK:
+        assert True
+        return
+
+    # Reload detector as if multiprocessing could not be imported, as with
+    # Python 2. Names imported from multiprocessing are removed first, as
+    # reload would otherwise retain them
+    multiprocessing = sys.modules.get('multiprocessing')
+    sys.modules['multiprocessing'] = None
+    try:
+        for name in ('get_all_start_methods', 'get_context', 'PoolTimeout',
+                     'RawArray'):
+            vars(detector).pop(name, None)
+        reload(detector)
+        assert detector._FORK_CONTEXT is None  # pylint: disable=protected-access
+
+        # Errors evaluating a frame are raised rather than hidden by the
+        # handler for worker process timeouts
+        test_detector = detector.UpNextDetector(player=None,
+                                                state=state.UpNextState())
+        try:
+            test_detector._worker_evaluate(  # pylint: disable=protected-access
+                None, 0, (b'', (16, 8), (10, 100))
+            )
+        except ValueError:
+            pass
+        else:
+            assert False
+    finally:
+        if multiprocessing is None:
+            del sys.modules['multiprocessing']
+        else:
+            sys.modules['multiprocessing'] = multiprocessing
+        reload(detector)
+
+
+def test_hash_store():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_STORE:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    test_random = random.Random(0)
+    hashes = {
+        (test_random.randint(0, 3000), test_random.randint(0, 3000), idx):
+            test_random.getrandbits(hash_size[0] * hash_size[1])
+        for idx in range(1, 6)
+        for _ in range(100)
+    }
+    timestamps = {idx: None if idx % 2 else 1000.5 + idx for idx in range(6)}
+
+    with _temp_save_path() as save_path:
+        # Stored hashes in old JSON format are migrated to binary format
+        with io.open(os.path.join(save_path, 'Test_show-1.json'), mode='w',
+                     encoding='utf-8') as json_file:
+            json_file.write(statichelper.from_bytes(json.dumps({
+                'version': 0.2,
+                'hash_size': hash_size,
+                'data': {str(key): value for key, value in hashes.items()},
+                'timestamps': timestamps,
+            })))
+
+        for expected_files in (['Test_show-1.bin'], ['Test_show-1.bin']):
+            store = detector.UpNextHashStore()
+            assert store.load('Test_show-1')
+            assert os.listdir(save_path) == expected_files
+            assert store.hash_size == list(hash_size)
+            assert store.timestamps == timestamps
+            assert {
+                key: image_hash.value for key, image_hash in store.data.items()
+            } == hashes
+
+
+def _scan_hash_window(store, hash_index, size, all_episodes=False):
+    """Reference implementation of hash window, scanning all hashes"""
+
+    end_time, start_time, episode = hash_index
+    if all_episodes:
+        excluded_episodes = [detector.constants.UNDEFINED]
+        selected_episodes = store.timestamps.keys()
+    else:
+        excluded_episodes = [detector.constants.UNDEFINED, episode]
+        selected_episodes = {min(store.timestamps), max(store.timestamps)}
+
+    return {
+        key: image_hash
+        for key, image_hash in store.data.items()
+        if key[2] in selected_episodes
+        and key[2] not in excluded_episodes
+        and (
+            start_time - size <= key[1] <= start_time + size
+            or end_time - size <= key[0] <= end_time + size
+        )
+    }
+
+
+def test_hash_window():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_WINDOW:
+        assert True
+        return
+
+    test_random = random.Random(0)
+    store = detector.UpNextHashStore(timestamps={})
+    for episode in range(-1, 8):
+        if episode != 3:
+            store.set_timestamp(episode, None)
+        store.update(hashes={
+            (test_random.randint(0, 600), test_random.randint(0, 600), episode):
+                detector.PackedHash(test_random.getrandbits(32), size=32)
+            for _ in range(200)
+        })
+
+        for _ in range(50):
+            hash_index = (
+                test_random.randint(-10, 610),
+                test_random.randint(-10, 610),
+                test_random.randint(-1, 8)
+            )
+            size = test_random.randint(0, 10)
+            for all_episodes in (False, True):
+                assert store.window(hash_index, size, all_episodes) == (
+                    _scan_hash_window(store, hash_index, size, all_episodes)
+                )
+
+        store.add((0, 0, episode), detector.PackedHash(size=32))
+
+
+def test_hash_journal():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_JOURNAL:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    num_pixels = hash_size[0] * hash_size[1]
+    test_random = random.Random(0)
+
+    with _temp_save_path() as save_path:
+        journal = os.path.join(save_path, 'Test_show-1.journal')
+        store_file = os.path.join(save_path, 'Test_show-1.bin')
+
+        expected_hashes = {}
+        expected_timestamps = {detector.constants.UNDEFINED: None}
+        for episode in range(1, 40):
+            store = detector.UpNextHashStore(hash_size=hash_size)
+            store.load('Test_show-1')
+            assert store.data == expected_hashes
+            assert store.timestamps == expected_timestamps
+
+            hashes = {}
+            for _ in range(100):
+                hash_index = (test_random.randint(0, 3000),
+                              test_random.randint(0, 3000),
+                              episode)
+                hashes[hash_index] = detector.PackedHash(
+                    test_random.getrandbits(num_pixels), size=num_pixels
+                )
+            timestamps = {episode: 1000.5 + episode}
+            store.update(hashes=hashes, timestamps=timestamps)
+            assert store.append('Test_show-1', hashes, timestamps)
+            expected_hashes.update(hashes)
+            expected_timestamps.update(timestamps)
+
+            # Incomplete write is ignored, and then overwritten by next append
+            if episode % 3 == 0:
+                with open(journal, mode='ab') as journal_file:
+                    journal_file.write(b'UNHJ' + b'0' * 100)
+
+            # Journal is merged into store file once it grows too large
+            if os.path.exists(journal):
+                assert os.path.getsize(journal) <= max(
+                    detector._STORE_JOURNAL_MIN_SIZE,  # pylint: disable=protected-access
+                    os.path.getsize(store_file)
+                    if os.path.exists(store_file) else 0
+                ) + 200
+
+        assert os.path.exists(store_file)
+
+        # Store and journal are also saved and loaded using Python 2 fallbacks
+        os_replace = vars(os).pop('replace', None)
+        try:
+            store = detector.UpNextHashStore(hash_size=hash_size)
+            assert store.load('Test_show-1')
+            assert store.append('Test_show-1', hashes, timestamps)
+            assert store.compact('Test_show-1')
+            assert not os.path.exists(journal)
+        finally:
+            if os_replace is not None:
+                os.replace = os_replace
+        store = detector.UpNextHashStore(hash_size=hash_size)
+        assert store.load('Test_show-1')
+        assert store.data == expected_hashes
+        assert store.timestamps == expected_timestamps
+
+
+def test_hash_retention():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_RETENTION:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    num_pixels = hash_size[0] * hash_size[1]
+    test_random = random.Random(0)
+
+    with _temp_save_path() as save_path:
+        store = detector.UpNextHashStore(hash_size=hash_size)
+        store.load('Test_show-1')
+        for episode in range(1, 11):
+            hashes = {}
+            for index in range(10):
+                hashes[(test_random.randint(0, 3000), index, episode)] = (
+                    detector.PackedHash(
+                        test_random.getrandbits(num_pixels), size=num_pixels
+                    )
+                )
+            timestamps = {episode: 1000.5 + episode}
+            store.update(hashes=hashes, timestamps=timestamps)
+            store.prune(episode, 4)
+            assert store.append('Test_show-1', hashes, timestamps)
+
+        # Only episodes nearest to last stored episode are retained
+        expected_episodes = {7, 8, 9, 10}
+        assert {hash_index[2] for hash_index in store.data} == expected_episodes
+        store = detector.UpNextHashStore(hash_size=hash_size)
+        store.load('Test_show-1')
+        assert {hash_index[2] for hash_index in store.data} == expected_episodes
+        assert set(store.timestamps) - {detector.constants.UNDEFINED} == (
+            expected_episodes
+        )
+
+        # Rewatching earlier episode prefers later episodes when equidistant
+        assert not store.prune(8, 0)
+        assert store.prune(2, 3)
+        assert {hash_index[2] for hash_index in store.data} == {7, 8, 9}
+
+        # Least recently used groups are evicted when over storage limit
+        for group in range(2, 6):
+            store.save('Test_show-{0}'.format(group))
+            target = os.path.join(save_path,
+                                  'Test_show-{0}.bin'.format(group))
+            os.utime(target, (1000 + group, 1000 + group))
+        group_size = os.path.getsize(target)
+        os.utime(os.path.join(save_path, 'Test_show-1.bin'), (1000, 1000))
+        store.load('Test_show-3')
+
+        assert not detector.UpNextHashStore.evict(0)
+        assert detector.UpNextHashStore.evict(
+            3 * group_size, retain='Test_show-2'
+        ) == 2
+        assert sorted(os.listdir(save_path)) == [
+            'Test_show-2.bin', 'Test_show-3.bin', 'Test_show-5.bin'
+        ]
+
+
+def test_hash_prefetch():
+    if SKIP_TEST_ALL or SKIP_TEST_HASH_PREFETCH:
+        assert True
+        return
+
+    hash_size = (14, 8)
+    num_pixels = hash_size[0] * hash_size[1]
+
+    with _temp_save_path() as save_path:
+        try:
+            store = detector.UpNextHashStore(hash_size=hash_size)
+            store.update(
+                hashes={(100, 200, 1): detector.PackedHash(12345, size=num_pixels)},
+                timestamps={1: 1234.5}
+            )
+            assert store.save('Test_show-1')
+
+            # Items without episode details are not loaded
+            assert not detector.UpNextHashStore.prefetch(
+                {'group_name': 'Test_show-1',
+                 'group_idx': detector.constants.UNDEFINED}
+            )
+
+            item = {'group_name': 'Test_show-1', 'group_idx': 2}
+            prefetched = detector.UpNextHashStore.prefetch(item)
+            assert detector.UpNextHashStore.prefetch(item) is prefetched
+            fetched = detector.UpNextHashStore.fetch('Test_show-1', (8, 8))
+            assert fetched is prefetched
+            assert fetched.data == store.data
+            assert fetched.timestamps == store.timestamps
+            assert fetched.hash_size == list(hash_size)
+
+            # Cached store is used for next episode, without loading from disk
+            os.remove(os.path.join(save_path, 'Test_show-1.bin'))
+            item = {'group_name': 'Test_show-1', 'group_idx': 3}
+            assert detector.UpNextHashStore.prefetch(item) is fetched
+            assert detector.UpNextHashStore.fetch('Test_show-1', (8, 8)) is fetched
+
+            # Store for new group replaces cached store
+            fetched = detector.UpNextHashStore.fetch('Test_show-2', (8, 8))
+            assert not fetched.data
+            assert fetched.hash_size == (8, 8)
+            assert detector.UpNextHashStore.prefetch(item) is not store
+            assert not detector.UpNextHashStore.fetch('Test_show-1', (8, 8)).data
+        finally:
+            detector._STORE_CACHE.clear()  # pylint: disable=protected-access
+
+
+def test_capture_interval():
+    if SKIP_TEST_ALL or SKIP_TEST_CAPTURE_INTERVAL:
+        assert True
+        return
+
+    test_detector = detector.UpNextDetector(player=None,
+                                            state=state.UpNextState())
+    min_interval = detector._CAPTURE_INTERVAL_MIN  # pylint: disable=protected-access
+    max_interval = detector._CAPTURE_INTERVAL_MAX  # pylint: disable=protected-access
+    detect_level = detector.SETTINGS.detect_level
+    detect_matches = detector.SETTINGS.detect_matches
+    assert test_detector.capture_interval == min_interval
+
+    stats = {
+        'credits': 0,
+        'detected': 0,
+        'previous': 0,
+        'episodes': detector.constants.UNDEFINED
+    }
+    # Dissimilar frames are captured at maximum interval
+    test_detector._update_capture_interval(stats, 0.1)  # pylint: disable=protected-access
+    assert test_detector.capture_interval == max_interval
+    assert test_detector.match_number == max(
+        1, int(detect_matches / max_interval)
+    )
+
+    # Capture interval decreases as similarity approaches detect level
+    stats['previous'] = detect_level - 1
+    test_detector._update_capture_interval(stats, 0.1)  # pylint: disable=protected-access
+    assert min_interval < test_detector.capture_interval < max_interval
+
+    # Matched frames are captured at minimum interval
+    test_detector._hash_match_hit()  # pylint: disable=protected-access
+    test_detector._update_capture_interval(stats, 0.1)  # pylint: disable=protected-access
+    assert test_detector.capture_interval == min_interval
+    assert test_detector.match_number == int(detect_matches / min_interval)
+
+    # Minimum interval is limited by average processing time
+    for _ in range(50):
+        test_detector._update_capture_interval(stats, 10)  # pylint: disable=protected-access
+    assert test_detector.capture_interval > max_interval
+    assert test_detector.match_number == max(1, int(
+        detect_matches / test_detector.capture_interval
+    ))
+
+
+def test_evaluate_stages():
+    if SKIP_TEST_ALL or SKIP_TEST_EVALUATE_STAGES:
+        assert True
+        return
+
+    test_detector = detector.UpNextDetector(player=None,
+                                            state=state.UpNextState())
+    hash_size = test_detector.hashes.hash_size
+    num_pixels = hash_size[0] * hash_size[1]
+    test_random = random.Random(0)
+    image_hash = detector.PackedHash(
+        test_random.getrandbits(num_pixels), size=num_pixels
+    )
+    filtered_hashes = (
+        detector.PackedHash(test_random.getrandbits(num_pixels),
+                            size=num_pixels),
+        None
+    )
+    test_detector.hash_index['current'] = (100, 1000, 2)
+    created = []
+
+    def create_hashes():
+        created.append(True)
+        return filtered_hashes
+
+    detector_debug = detector.SETTINGS.detector_debug
+    detector.SETTINGS.detector_debug = False
+    try:
+        # Blank frame is matched without comparison to other hashes
+        timings = {}
+        stats, _, _ = test_detector._evaluate_similarity(  # pylint: disable=protected-access
+            detector.PackedHash(0, size=num_pixels), create_hashes, timings
+        )
+        assert not created and not timings
+        assert stats['previous'] == detector.constants.UNDEFINED
+        assert test_detector.match_counts['hits'] == 1
+
+        # Other episode hashes are matched without creating filtered hashes
+        test_detector.past_hashes.update(
+            hashes={(100, 1000, 1): image_hash}, timestamps={1: None}
+        )
+        stats, _, _ = test_detector._evaluate_similarity(  # pylint: disable=protected-access
+            image_hash, create_hashes, timings
+        )
+        assert not created and list(timings) == ['episodes']
+        assert stats['episodes'] == 100
+        assert test_detector.match_counts['hits'] == 2
+
+        # Filtered hashes only created if no match found by earlier stages
+        test_detector.past_hashes.data.clear()
+        test_detector.past_hashes.update()
+        stats, filtered_hash, expanded_hash = (
+            test_detector._evaluate_similarity(  # pylint: disable=protected-access
+                image_hash, create_hashes, timings
+            )
+        )
+        assert created and set(timings) == {'episodes', 'filtered'}
+        assert (filtered_hash, expanded_hash) == filtered_hashes
+        assert test_detector.match_counts['misses'] == 1
+
+        # All stages evaluated and recorded when debugging
+        detector.SETTINGS.detector_debug = True
+        del created[:]
+        timings = {'image': 0.001}
+        test_detector._evaluate_similarity(  # pylint: disable=protected-access
+            detector.PackedHash(0, size=num_pixels), create_hashes, timings
+        )
+        assert created and set(timings) == set(detector._STAGES)  # pylint: disable=protected-access
+        assert test_detector.stage_stats['image'][:2] == [1, 1]
+        assert test_detector.stage_stats['filtered'][:2] == [1, 0]
+    finally:
+        detector.SETTINGS.detector_debug = detector_debug
+
+
+def test_benchmark():
+    if SKIP_TEST_ALL or SKIP_TEST_BENCHMARK:
+        assert True
+        return
+
+    summary, results = benchmark_detector.run(sequences=(
+        ('credits_scroll', 60, 30, benchmark_detector.sequence(
+            (30, benchmark_detector.content),
+            (30, benchmark_detector.credits_scroll)
+        )),
+    ))
+    assert summary['frames'] == results[0]['frames']
+    assert summary['fps'] > 0
+    assert summary['false_positive_rate'] == 0
+
+    # Credits detected after credits start, within time allowed for matches
+    assert results[0]['detected_at'] >= 30
+    assert results[0]['detection_latency'] <= 3 * (
+        detector.SETTINGS.detect_matches + detector.SETTINGS.detect_mismatches
+    )
+    assert set(results[0]['stages']) >= {'image', 'episodes', 'total'}
+
+
 def test_hash_compare():  # pylint: disable=too-many-locals,too-many-statements
     if SKIP_TEST_ALL or SKIP_TEST_HASH_COMPARE:
         assert True
@@ -4,17 +4,32 @@
 
 from __future__ import absolute_import, division, unicode_literals
 
+import json
+import os
+import threading
+import time
+from itertools import islice
+
 import api
+import constants
 import dummydata
+import library_index
+import monitor
 import plugin
 import script
 import upnext
 import utils
+import xbmc
 
 SKIP_TEST_ALL = False
 SKIP_TEST_POPUP = False
 SKIP_TEST_PLUGIN = False
 SKIP_TEST_WIDGET = False
+SKIP_TEST_WIDGET_BATCH = False
+SKIP_TEST_LIBRARY_QUERY = False
+SKIP_TEST_LIBRARY_CACHE = False
+SKIP_TEST_LIBRARY_INDEX = False
+SKIP_TEST_SIMILAR = False
 SKIP_TEST_OVERALL = False
 
 
@@ -87,11 +102,288 @@ def test_widget():
     assert test_complete is True
 
 
+def test_widget_batch():
+    if SKIP_TEST_ALL or SKIP_TEST_WIDGET_BATCH:
+        assert True
+        return
+
+    execute_jsonrpc = xbmc.executeJSONRPC
+    calls = []
+
+    def _execute_jsonrpc(command):
+        calls.append(command)
+        return execute_jsonrpc(command)
+
+    xbmc.executeJSONRPC = _execute_jsonrpc
+    try:
+        num_calls = set()
+        for limit in (2, 25):
+            del calls[:]
+            episodes = api.get_upnext_episodes_from_library(limit=limit)
+            num_calls.add(len(calls))
+            del calls[:]
+            movies = api.get_upnext_movies_from_library(limit=limit)
+            num_calls.add(len(calls))
+    finally:
+        xbmc.executeJSONRPC = execute_jsonrpc
+
+    assert episodes and movies
+    assert all('totalepisodes' in episode for episode in episodes)
+    assert max(num_calls) <= 2
+
+
+def test_library_query():
+    if SKIP_TEST_ALL or SKIP_TEST_LIBRARY_QUERY:
+        assert True
+        return
+
+    episode = dummydata.LIBRARY['episodes'][0]
+    query = api.LibraryQuery('VideoLibrary.GetEpisodes',
+                             {'properties': ['title', 'season']})
+    for params in ({}, {'filter': api.filter_upnext_aired(episode)},
+                   {'properties': ['title'], 'limits': {'end': 1}}):
+        request = query.request(**params)
+        request['id'] = 1
+        expected = json.dumps({'id': 1, 'method': query.method,
+                               'params': dict(query.params, **params)})
+        request = utils._jsonrpc_dumps(request)  # pylint: disable=protected-access
+        assert json.loads(request) == json.loads(expected)
+    assert api.filter_upnext_aired(episode) is not api.filter_upnext_aired(episode)
+
+    episodes = [dict(item) for item in dummydata.LIBRARY['episodes']] * 4
+    expected = [
+        api.get_next_episode_from_library(item, next_season=bool(idx % 2))
+        for idx, item in enumerate(episodes)
+    ]
+    results = [None] * len(episodes)
+
+    def _get_next(idx):
+        results[idx] = api.get_next_episode_from_library(
+            episodes[idx], next_season=bool(idx % 2)
+        )
+
+    threads = [
+        threading.Thread(target=_get_next, args=(idx, ))
+        for idx in range(len(episodes))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == expected
+
+
+def test_library_cache():
+    if SKIP_TEST_ALL or SKIP_TEST_LIBRARY_CACHE:
+        assert True
+        return
+
+    cache = utils.ExpiringCache(maxsize=2, ttl=0.05)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1
+    time.sleep(0.1)
+    assert cache.get('a') is None and cache.get('c') is None
+
+    execute_jsonrpc = xbmc.executeJSONRPC
+    calls = []
+
+    def _execute_jsonrpc(command):
+        calls.append(command)
+        return execute_jsonrpc(command)
+
+    episode = dummydata.LIBRARY['episodes'][0]
+    episodeid = episode['episodeid']
+    tvshowid = episode['tvshowid']
+    upnext_monitor = monitor.UpNextMonitor()
+    xbmc.executeJSONRPC = _execute_jsonrpc
+    try:
+        api.library_cache_invalidate()
+        details = api.get_from_library(db_type='episode', db_id=episodeid)
+        num_calls = len(calls)
+        details['title'] = None
+        assert api.get_from_library(db_type='episode',
+                                    db_id=episodeid) == dict(details,
+                                                             title=episode['title'])
+        assert len(calls) == num_calls
+
+        # Uncached details are fetched again, as are all details after the
+        # service updates the library
+        api.get_details_from_library(db_type='episode', db_id=episodeid,
+                                     properties=['title'])
+        assert len(calls) == num_calls + 1
+
+        upnext_monitor.onNotification('xbmc', 'VideoLibrary.OnUpdate', json.dumps(
+            {'item': {'id': episodeid, 'type': 'episode'}, 'playcount': 1}
+        ))
+        del calls[:]
+        api.get_details_from_library(db_type='tvshow', db_id=tvshowid)
+        api.get_details_from_library(db_type='episode', db_id=episodeid)
+        assert len(calls) == 2
+
+        upnext_monitor.onNotification('xbmc', 'VideoLibrary.OnRemove', json.dumps(
+            {'id': tvshowid + 1, 'type': 'tvshow'}
+        ))
+        del calls[:]
+        api.get_details_from_library(db_type='tvshow', db_id=tvshowid)
+        assert not calls
+
+        utils.set_property(constants.LIBRARY_UPDATE_PROPERTY_NAME, 'plugin')
+        api.get_details_from_library(db_type='tvshow', db_id=tvshowid)
+        assert len(calls) == 1
+    finally:
+        xbmc.executeJSONRPC = execute_jsonrpc
+
+
+def _remove_library_index():
+    """Remove index saved to the test profile by the service"""
+
+    target = library_index.UpNextLibraryIndex._target()  # pylint: disable=protected-access
+    if target and os.path.exists(target):
+        os.remove(target)
+
+
+def test_library_index():
+    if SKIP_TEST_ALL or SKIP_TEST_LIBRARY_INDEX:
+        assert True
+        return
+
+    execute_jsonrpc = xbmc.executeJSONRPC
+    calls = []
+
+    def _execute_jsonrpc(command):
+        calls.append(command)
+        return execute_jsonrpc(command)
+
+    index = library_index.UpNextLibraryIndex()
+    assert index.rebuild()
+    episode_options = {
+        'next_season': index.options['next_season'],
+        'unwatched_only': index.options['unwatched_only'],
+    }
+    movie_options = {
+        'movie_sets': index.options['movie_sets'],
+        'unwatched_only': index.options['unwatched_only'],
+    }
+    expected = json.loads(json.dumps([
+        api.get_upnext_episodes_from_library(limit=25, **episode_options),
+        api.get_upnext_movies_from_library(limit=25, **movie_options),
+    ]))
+    assert expected[0] and expected[1]
+
+    def _get_upnext(index_options=None):
+        del calls[:]
+        result = [
+            library_index.get_upnext_episodes(
+                limit=25, **(index_options or episode_options)
+            ),
+            library_index.get_upnext_movies(limit=25, **movie_options),
+        ]
+        return result, len(calls)
+
+    xbmc.executeJSONRPC = _execute_jsonrpc
+    try:
+        # Index is used without querying the library
+        assert _get_upnext() == (expected, 0)
+
+        # Updated entries are the same as entries of a full rebuild
+        for video in (dummydata.LIBRARY['episodes'][0],
+                      dummydata.LIBRARY['movies'][0]):
+            db_type = 'episode' if 'episodeid' in video else 'movie'
+            assert index.update(db_type=db_type, db_id=video[db_type + 'id'])
+            assert _get_upnext() == (expected, 0)
+
+        # Index is not used if index settings differ or index is not current
+        result, num_calls = _get_upnext(dict(
+            episode_options, next_season=not episode_options['next_season']
+        ))
+        assert result[1] == expected[1] and num_calls
+        utils.clear_property(constants.LIBRARY_INDEX_PROPERTY_NAME)
+        assert _get_upnext()[0] == expected and calls
+
+        # Library events do not wait for index updates already in progress
+        upnext_monitor = monitor.UpNextMonitor()
+        upnext_monitor.library_index = index
+        with index._lock:  # pylint: disable=protected-access
+            upnext_monitor.onNotification(
+                'xbmc', 'VideoLibrary.OnScanFinished', json.dumps({})
+            )
+            assert not utils.get_property(
+                constants.LIBRARY_INDEX_PROPERTY_NAME
+            )
+        upnext_monitor._library_index.join()  # pylint: disable=protected-access
+        assert _get_upnext() == (expected, 0)
+    finally:
+        xbmc.executeJSONRPC = execute_jsonrpc
+        _remove_library_index()
+
+
+def test_similar():
+    if SKIP_TEST_ALL or SKIP_TEST_SIMILAR:
+        assert True
+        return
+
+    filters = api.filter_field('playcount', 'greaterthan', '-1')
+    movies, _ = api.get_videos_from_library(db_type='movies',
+                                            limit=None,
+                                            sort=api.SORT_RATING,
+                                            filters=filters)
+    assert len(movies) > 3
+    assert [
+        movie for movie, _ in api.iter_videos_from_library(
+            db_type='movies', chunk_size=3, sort=api.SORT_RATING,
+            filters=filters
+        )
+    ] == movies
+
+    # Next chunk is not requested early if stop() returns True, and is then
+    # not requested at all if processing stops within the current chunk
+    execute_jsonrpc = xbmc.executeJSONRPC
+    calls = []
+
+    def _execute_jsonrpc(command):
+        calls.append(command)
+        return execute_jsonrpc(command)
+
+    xbmc.executeJSONRPC = _execute_jsonrpc
+    try:
+        movie_iter = api.iter_videos_from_library(
+            db_type='movies', chunk_size=3, sort=api.SORT_RATING,
+            filters=filters, stop=lambda: True
+        )
+        checked = [movie for movie, _ in islice(movie_iter, 3)]
+        movie_iter.close()
+        assert checked == movies[:3]
+        assert len(calls) == 1
+    finally:
+        xbmc.executeJSONRPC = execute_jsonrpc
+
+    for db_type, id_name in (('movies', 'movieid'), ('tvshows', 'tvshowid')):
+        videos, _ = api.get_videos_from_library(db_type=db_type,
+                                                limit=None,
+                                                filters=filters)
+        for video, limit in zip(videos, (1, 2, 25) * len(videos)):
+            _, expected = api.get_similar_from_library(
+                db_type, limit=limit, db_id=video[id_name], return_all=True
+            )
+            expected = utils.merge_iterable(expected, sort='__similarity__')
+            _, similar = api.get_similar_from_library(
+                db_type, limit=limit, db_id=video[id_name]
+            )
+            assert len(similar) <= limit
+            assert similar == expected[:limit]
+
+
 def test_overall():
     if SKIP_TEST_ALL or SKIP_TEST_OVERALL:
         assert True
         return
 
     test_run = script.run(['', 'test_upnext', 'upnext'])
-    test_complete = test_run.waitForAbort()
-    assert test_complete is True
+    try:
+        test_complete = test_run.waitForAbort()
+        assert test_complete is True
+    finally:
+        _remove_library_index()
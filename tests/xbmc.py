@@ -531,6 +531,11 @@ class InfoTagVideo(object):  # pylint: disable=too-many-public-methods
 class RenderCapture(object):
     ''' A stub implementation of the xbmc RenderCapture class '''
 
+    # Optional callable used to replay frames, called with the capture width
+    # and height and returning captured image data. Random data is captured
+    # if not set
+    frame_source = None
+
     def __init__(self):
         ''' A stub constructor for the xbmc RenderCapture class '''
         self._width = 0
@@ -543,6 +548,8 @@ class RenderCapture(object):
 
     def getImage(self, msecs=None):  # pylint: disable=unused-argument
         ''' A stub implementation for the xbmc RenderCapture class getImage() method '''
+        if RenderCapture.frame_source:
+            return RenderCapture.frame_source(self._width, self._height)
         return bytearray((
             random.getrandbits(8) if i % 4 != 3 else 255
             for i in range(self._width * self._height * 4)
@@ -717,18 +724,22 @@ def _videolibrary_getepisodes(params):
     inprogress = filters.get('inprogress')
 
     episodes = []
-    if tvshowid is None:
+    if tvshowid is None or episode_number is None and not air_date:
         if watched is not None and watched.get('operator') == 'greaterthan':
             episodes = [
                 episode for episode in LIBRARY['episodes']
                 if episode.get('playcount', 0) > int(watched.get('value'))
+                and tvshowid in (None, episode.get('tvshowid', -1))
             ]
         elif inprogress is not None:
             episodes = [
                 episode for episode in LIBRARY['episodes']
                 if episode.get('resume', {}).get('position', 0) > 0
                 and episode.get('playcount', 0) < 1
+                and tvshowid in (None, episode.get('tvshowid', -1))
             ]
+        elif tvshowid is not None:
+            return False
     elif season is not None and episode_number is not None:
         episodes = [
             episode for episode in LIBRARY['episodes']
@@ -774,43 +785,39 @@ def _videolibrary_getmovies(params):
 
     filters, _ = _filter_walker(
         filters,
-        ['set', 'year', 'playcount', 'inprogress', 'genre']
+        ['set', 'title', 'year', 'playcount', 'inprogress', 'genre']
     )
     _set = filters.get('set')
+    title = filters.get('title')
     year = filters.get('year')
     watched = filters.get('playcount', {'operator': 'greaterthan', 'value': -1})
     inprogress = filters.get('inprogress')
     genres = filters.get('genre', {})
 
-    movies = []
-    if not _set:
-        if inprogress:
-            movies = [
-                movie for movie in LIBRARY['movies']
-                if movie.get('resume', {}).get('position', 0) > 0
-                and movie.get('playcount', 0) < 1
-            ]
-        elif watched:
-            movies = [
-                movie for movie in LIBRARY['movies']
-                if (watched.get('operator') == 'greaterthan' and movie.get('playcount', 0) > int(watched.get('value'))
-                    or watched.get('operator') == 'lessthan' and movie.get('playcount', 0) < int(watched.get('value')))
-                and (not genres.get('value') or not set(genres.get('value')).isdisjoint(movie.get('genre', [])))
-            ]
-        else:
-            return False
-    elif year:
+    movies = [
+        movie for movie in LIBRARY['movies']
+        if (not _set or movie.get('set', '') == _set.get('value'))
+        and (not title or movie.get('title', '') == title.get('value'))
+    ]
+    if _set and year:
         movies = [
-            movie for movie in LIBRARY['movies']
-            if movie.get('set', '') == _set.get('value')
-            and movie.get('year', 0) >= int(year.get('value'))
+            movie for movie in movies
+            if movie.get('year', 0) >= int(year.get('value'))
         ]
         if movies and year.get('operator') == 'after':
             movies = movies[1:]
-    else:
+    elif inprogress:
+        movies = [
+            movie for movie in movies
+            if movie.get('resume', {}).get('position', 0) > 0
+            and movie.get('playcount', 0) < 1
+        ]
+    elif watched:
         movies = [
-            movie for movie in LIBRARY['movies']
-            if movie.get('set', '') == _set.get('value')
+            movie for movie in movies
+            if (watched.get('operator') == 'greaterthan' and movie.get('playcount', 0) > int(watched.get('value'))
+                or watched.get('operator') == 'lessthan' and movie.get('playcount', 0) < int(watched.get('value')))
+            and (not genres.get('value') or not set(genres.get('value')).isdisjoint(movie.get('genre', [])))
         ]
 
     if limits and movies:
@@ -1015,9 +1022,7 @@ _JSONRPC_announcer_map = {
 }
 
 
-def executeJSONRPC(jsonrpccommand):
-    ''' A reimplementation of the xbmc executeJSONRPC() function '''
-    command = json.loads(jsonrpccommand)
+def _execute_jsonrpc(command):
     method = _JSONRPC_methods.get(command.get('method')) if command else None
     params = command.get('params', {}) if command else {}
 
@@ -1039,6 +1044,23 @@ def executeJSONRPC(jsonrpccommand):
     })
 
 
+def executeJSONRPC(jsonrpccommand):
+    ''' A reimplementation of the xbmc executeJSONRPC() function '''
+    command = json.loads(jsonrpccommand)
+    if not isinstance(command, list):
+        return _execute_jsonrpc(command)
+
+    # Batch requests get a list of responses, in reverse order to check that
+    # responses are matched to requests by id, with none for notifications
+    responses = []
+    for request in reversed(command):
+        response = json.loads(_execute_jsonrpc(request))
+        if 'id' in request:
+            response['id'] = request['id']
+            responses.append(response)
+    return json.dumps(responses)
+
+
 def getCondVisibility(string):
     ''' A reimplementation of the xbmc getCondVisibility() function '''
     if string == 'system.platform.android':
@@ -282,10 +282,17 @@ class Window(object):
     ''' A reimplementation of the xbmcgui Window '''
 
     __window_properties__ = {}
+    __existing_windows__ = {}
 
     def __init__(self, existingwindowId=-1):
         ''' A stub constructor for the xbmcgui Window class '''
-        self.__window_properties__ = {}
+        # Properties of existing windows, e.g. Home, persist between instances
+        if existingwindowId == -1:
+            self.__window_properties__ = {}
+        else:
+            self.__window_properties__ = Window.__existing_windows__.setdefault(
+                existingwindowId, {}
+            )
         try:
             getattr(self, 'onInit')()
         except (AttributeError, TypeError):